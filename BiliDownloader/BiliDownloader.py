@@ -1,73 +1,1154 @@
 import requests
 import re
 import json
+import sqlite3
 import os
+import sys
 import time
-from urllib.parse import urlparse, parse_qs
-import subprocess
-from typing import Optional, Dict, Any, List
-import qrcode
-from PIL import Image
+from urllib.parse import urlparse, parse_qs, urlencode
+import hashlib
+import tempfile
+import shutil
+import errno
+import functools
+import random
+from typing import Optional, Dict, Any, List, Iterable, Iterator, TYPE_CHECKING
 import threading
+import weakref
+import argparse
+import queue
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta  # 添加 timedelta 导入
+from requests.adapters import HTTPAdapter
+from BiliDownloader_Remux import remux_dash, RemuxError
+from BiliDownloader_Danmaku import iter_protobuf_comments, iter_xml_comments, sort_comments, write_ass
+
+# 只在登录、生成图片、调用ffmpeg时才需要的模块在使用时导入，缩短命令行的启动时间
+if TYPE_CHECKING:
+    import subprocess
+
+
+MIRROR_RACE_BYTES = 256 * 1024   # 竞速时每个镜像下载的数据量
+MIRROR_RACE_LIMIT = 4            # 同时参与竞速的镜像数
+MIRROR_RACE_TIMEOUT = 10         # 竞速超时（秒）
+MIRROR_CHECK_INTERVAL = 3        # 下载中统计吞吐量的时间窗口（秒）
+MIRROR_COLLAPSE_RATIO = 0.2      # 窗口速度低于最佳速度的该比例时切换镜像
+MIRROR_MAX_SWITCHES = 6          # 每个分段最多切换镜像的次数
+
+WRITE_BLOCK_SIZE = 1024 * 1024   # 合并后单次写入文件的大小，写入偏移按该大小对齐
+READ_SIZE = 256 * 1024           # 单次从连接读取的最大数据量
+FSYNC_POLICIES = ('none', 'end', 'always')  # 不主动同步 / 下载完成时同步 / 每次写入后同步
+
+
+def _response_readinto(response):
+    """返回将响应体读入缓冲区的函数；未压缩时直接使用http.client的readinto，数据从socket写入缓冲区而不产生中间对象"""
+    raw = response.raw
+    fp = getattr(raw, '_fp', None)
+    if fp is not None and hasattr(fp, 'readinto') and not response.headers.get('content-encoding'):
+        return fp.readinto
+    return raw.readinto
+
+
+def iter_response_blocks(response, buffer: bytearray, offset: int = 0, limit: Optional[int] = None,
+                         on_read=None) -> Iterator[memoryview]:
+    """将响应体读入复用的缓冲区，攒满一块后产出 memoryview（只在下一次迭代前有效）
+
+    offset 为数据在文件中的起始位置，第一块的长度使之后每次写入的偏移都与缓冲区大小对齐；
+    limit 为最多读取的字节数；on_read(n) 在每次读取后调用（用于限速）
+    """
+    readinto = _response_readinto(response)
+    view = memoryview(buffer)
+    block_size = len(buffer)
+    target = block_size - offset % block_size
+    filled = 0
+    remaining = limit
+    while remaining is None or remaining > 0:
+        size = min(READ_SIZE, target - filled)
+        if remaining is not None:
+            size = min(size, remaining)
+        n = readinto(view[filled:filled + size])
+        if not n:
+            if remaining:
+                raise Exception(f"连接提前关闭，还有 {remaining} 字节未接收")
+            break
+        if on_read:
+            on_read(n)
+        filled += n
+        if remaining is not None:
+            remaining -= n
+        if filled >= target:
+            yield view[:filled]
+            filled = 0
+            target = block_size
+    if filled:
+        yield view[:filled]
+
+
+def _preallocate(fd: int, size: int):
+    """预分配文件空间，减少碎片并提前发现磁盘空间不足；文件系统不支持时只设置文件长度"""
+    os.ftruncate(fd, size)
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+
+
+def _parse_range_response(response) -> tuple:
+    """从响应头解析文件总大小及是否支持Range请求"""
+    if response.status_code == 206:
+        # Content-Range: bytes 0-0/总大小
+        content_range = response.headers.get('content-range', '')
+        total = content_range.rsplit('/', 1)[-1]
+        return (int(total) if total.isdigit() else 0), True
+    total_size = int(response.headers.get('content-length', 0))
+    accept_ranges = response.headers.get('accept-ranges', '').lower() == 'bytes'
+    return total_size, accept_ranges
+
+
+def _merge_ranges(ranges) -> List[list]:
+    """合并重叠或相邻的字节范围 [start, end)"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def _missing_ranges(completed: List[list], total_size: int) -> List[list]:
+    """根据已完成的字节范围计算缺失的范围"""
+    missing = []
+    position = 0
+    for start, end in _merge_ranges(completed):
+        if start > position:
+            missing.append([position, start])
+        position = max(position, end)
+    if position < total_size:
+        missing.append([position, total_size])
+    return missing
+
+
+def _split_ranges(ranges: List[list], pieces: int, min_size: int = 1024 * 1024) -> List[list]:
+    """将字节范围切分为至少 pieces 段（每段不小于 min_size），用于多连接下载"""
+    ranges = [list(r) for r in ranges]
+    while ranges and len(ranges) < pieces:
+        largest = max(range(len(ranges)), key=lambda i: ranges[i][1] - ranges[i][0])
+        start, end = ranges[largest]
+        if end - start < 2 * min_size:
+            break
+        middle = start + (end - start) // 2
+        ranges[largest:largest + 1] = [[start, middle], [middle, end]]
+    return ranges
+
+
+# fnval 标志位: 16=DASH, 64=HDR, 128=4K, 256=杜比音频, 512=杜比视界, 1024=8K, 2048=AV1
+DASH_FNVAL_ALL = 16 | 64 | 128 | 256 | 512 | 1024 | 2048
+API_BASE = "https://api.bilibili.com"            # 可替换为本地测试服务器，见 BiliDownloader_MockServer.py
+PASSPORT_BASE = "https://passport.bilibili.com"
+COMMENT_BASE = "https://comment.bilibili.com"
+
+MAX_QUALITY = 127  # 请求最高清晰度，接口会返回不高于该清晰度的所有DASH流
+AVC_CODEC_ID = 7   # H.264编码，兼容性最好
+
+
+def select_video_stream(video_streams: List[Dict[str, Any]], quality: Optional[int]) -> Optional[Dict[str, Any]]:
+    """从DASH视频流列表中选择指定清晰度的流；不可用时选择低于该清晰度的最高清晰度，同清晰度优先H.264"""
+    if not video_streams:
+        return None
+    available = sorted({stream['id'] for stream in video_streams})
+    if quality:
+        lower = [qn for qn in available if qn <= quality]
+        chosen = lower[-1] if lower else available[0]
+    else:
+        chosen = available[-1]
+    candidates = [stream for stream in video_streams if stream['id'] == chosen]
+    for stream in candidates:
+        if stream.get('codecid') == AVC_CODEC_ID:
+            return stream
+    return candidates[0]
+
+
+def select_audio_stream(audio_streams: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """选择码率最高的DASH音频流"""
+    if not audio_streams:
+        return None
+    return max(audio_streams, key=lambda stream: stream.get('bandwidth', 0))
+
+
+def extract_bvid(input_str: str) -> Optional[str]:
+    """从输入中提取BV号"""
+    # 如果是URL
+    if input_str.startswith('http'):
+        parsed_url = urlparse(input_str)
+        path = parsed_url.path
+        # 匹配BV号模式
+        bv_match = re.search(r'BV[0-9A-Za-z]{10}', path)
+        if bv_match:
+            return bv_match.group()
+        return None
+    # 如果是纯BV号
+    elif input_str.startswith('BV'):
+        return input_str
+    else:
+        return None
+
+
+def parse_collection_url(input_str: str) -> Optional[Dict[str, Any]]:
+    """识别UP主空间、收藏夹、合集、系列的URL，返回 {'kind': 类型, 'mid': UP主ID, 'id': 列表ID}，其他输入返回None"""
+    if not input_str.startswith('http'):
+        return None
+    parsed_url = urlparse(input_str)
+    host = parsed_url.hostname or ''
+    query = parse_qs(parsed_url.query)
+    
+    # 收藏夹播放页: www.bilibili.com/medialist/detail/ml123
+    match = re.search(r'/medialist/detail/ml(\d+)', parsed_url.path)
+    if match:
+        return {'kind': 'favlist', 'mid': None, 'id': match.group(1)}
+    if host != 'space.bilibili.com':
+        return None
+    
+    match = re.match(r'/(\d+)(/.*)?$', parsed_url.path)
+    if not match:
+        return None
+    mid, rest = match.group(1), match.group(2) or ''
+    if rest.startswith('/favlist') and query.get('fid'):
+        return {'kind': 'favlist', 'mid': mid, 'id': query['fid'][0]}
+    if rest.startswith('/channel/collectiondetail') and query.get('sid'):
+        return {'kind': 'season', 'mid': mid, 'id': query['sid'][0]}
+    if rest.startswith('/channel/seriesdetail') and query.get('sid'):
+        return {'kind': 'series', 'mid': mid, 'id': query['sid'][0]}
+    # 新版空间页: /{mid}/lists/{id}?type=season|series
+    match = re.match(r'/lists/(\d+)', rest)
+    if match:
+        kind = 'series' if query.get('type', ['season'])[0] == 'series' else 'season'
+        return {'kind': kind, 'mid': mid, 'id': match.group(1)}
+    return {'kind': 'space', 'mid': mid, 'id': None}
+
+
+# WBI签名使用的混淆表，见 /x/web-interface/nav 返回的 wbi_img
+WBI_MIXIN_KEY_ENC_TAB = [
+    46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49,
+    33, 9, 42, 19, 29, 28, 14, 39, 12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40,
+    61, 26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11,
+    36, 20, 34, 44, 52,
+]
+
+
+def wbi_sign(params: Dict[str, Any], img_key: str, sub_key: str) -> Dict[str, Any]:
+    """为需要WBI签名的接口参数添加 wts 和 w_rid"""
+    mixin_key = ''.join((img_key + sub_key)[i] for i in WBI_MIXIN_KEY_ENC_TAB)[:32]
+    params = dict(params, wts=int(time.time()))
+    # 参数按键排序，值中去掉 !'()* 字符后计算签名
+    params = {k: ''.join(c for c in str(v) if c not in "!'()*") for k, v in sorted(params.items())}
+    params['w_rid'] = hashlib.md5((urlencode(params) + mixin_key).encode('utf-8')).hexdigest()
+    return params
+
+
+def extract_page(input_str: str) -> Optional[str]:
+    """从视频URL的 p 参数中提取分P编号"""
+    if not input_str.startswith('http'):
+        return None
+    values = parse_qs(urlparse(input_str).query).get('p')
+    return values[0] if values else None
+
+
+def page_jobs(bvid: str, safe_title: str, page_list: list, selected_pages: list) -> List[tuple]:
+    """生成 (分P, 文件名前缀) 列表：单P视频保持原有文件名，多P视频每P使用独立文件名（同步和异步下载器共用）"""
+    jobs = []
+    for page in selected_pages:
+        if len(page_list) > 1:
+            safe_part = re.sub(r'[\\/*?:"<>|]', "", page.get('part', ''))
+            base_name = f"{safe_title}_{bvid}_p{page['page']}_{safe_part}".rstrip('_')
+        else:
+            base_name = f"{safe_title}_{bvid}"
+        jobs.append((page, base_name))
+    return jobs
+
+
+def parse_page_selection(selection: Optional[str], page_count: int) -> List[int]:
+    """解析分P选择，支持 "all"、单个编号、范围及逗号分隔的组合，如 "1-3,5"；为空时返回 [1]"""
+    if not selection:
+        return [1]
+    selection = selection.strip().lower()
+    if selection == 'all':
+        return list(range(1, page_count + 1))
+    
+    pages = []
+    seen = set()
+    for part in selection.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                start, end = part.split('-', 1)
+                start = int(start) if start.strip() else 1
+                end = int(end) if end.strip() else page_count
+            else:
+                start = end = int(part)
+        except ValueError:
+            raise ValueError(f"无法解析分P选择: {part}")
+        for page in range(max(start, 1), min(end, page_count) + 1):
+            if page not in seen:
+                seen.add(page)
+                pages.append(page)
+    if not pages:
+        raise ValueError(f"分P选择超出范围: {selection} (共 {page_count} P)")
+    return pages
+
+
+def read_cookie_file(cookies_file: str) -> Optional[Dict[str, Any]]:
+    """读取保存的Cookie文件，文件不存在或Cookie已过期时返回None（同步和异步下载器共用）"""
+    if not os.path.exists(cookies_file):
+        return None
+    with open(cookies_file, 'r', encoding='utf-8') as f:
+        cookie_data = json.load(f)
+    
+    # 检查Cookie是否过期
+    if 'expiry_time' in cookie_data:
+        expiry_time = datetime.fromisoformat(cookie_data['expiry_time'])
+        if expiry_time < datetime.now():
+            print("Cookie已过期，需要重新登录")
+            return None
+    return cookie_data
+
+
+LOGIN_COOKIE = 'SESSDATA'  # 决定登录状态的Cookie，其过期时间即为登录的过期时间
+
+
+def cookie_expiry_times(jar) -> Dict[str, int]:
+    """从CookieJar中读取各Cookie的过期时间（Unix时间戳），会话Cookie不包含在内"""
+    return {cookie.name: cookie.expires for cookie in jar if cookie.expires}
+
+
+def write_cookie_file(cookies_file: str, cookies: Dict[str, str], user_info: Optional[Dict[str, Any]],
+                      expires: Optional[Dict[str, int]] = None, verified_time: Optional[datetime] = None):
+    """保存Cookie及用户信息到文件（同步和异步下载器共用）
+
+    expires 为各Cookie的真实过期时间，登录过期时间取 SESSDATA 的过期时间，没有时按保存后7天计算；
+    verified_time 为最近一次通过nav接口确认登录有效的时间
+    """
+    expires = {name: int(t) for name, t in (expires or {}).items() if name in cookies}
+    if LOGIN_COOKIE in expires:
+        expiry_time = datetime.fromtimestamp(expires[LOGIN_COOKIE])
+    elif expires:
+        expiry_time = datetime.fromtimestamp(min(expires.values()))
+    else:
+        expiry_time = datetime.now() + timedelta(days=7)
+    cookie_data = {
+        'cookies': cookies,
+        'cookie_expires': expires,
+        'user_info': user_info,
+        'save_time': datetime.now().isoformat(),
+        'expiry_time': expiry_time.isoformat(),
+        'verified_time': verified_time.isoformat() if verified_time else None,
+    }
+    # 后台验证线程也会写入该文件，先写临时文件再替换
+    temp_file = cookies_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(cookie_data, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, cookies_file)
+
+
+def parse_nav_user_info(data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """从 /x/web-interface/nav 的返回中提取用户信息，未登录时返回None"""
+    if data['code'] == 0 and data['data']['isLogin']:
+        return {
+            'uid': data['data']['mid'],
+            'uname': data['data']['uname'],
+            'face': data['data']['face'],
+            'vipStatus': data['data']['vipStatus'],
+        }
+    return None
+
+
+def parse_rate(value: str) -> Optional[float]:
+    """解析限速值（字节/秒），支持 K/M/G 后缀，如 "500K"、"2.5M"；0 表示不限速"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B?(?:/s)?)?\s*', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError(f"无效的限速值: {value}")
+    rate = float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2).upper() or ' ')
+    return rate or None
+
+
+class BandwidthLimiter:
+    """令牌桶限速器，rate 为字节/秒（None为不限速），可被多个线程共享，运行中可随时修改速率"""
+
+    def __init__(self, rate: Optional[float] = None):
+        self.rate = rate
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._cond = threading.Condition()
+
+    def set_rate(self, rate: Optional[float]):
+        """修改速率，正在等待的线程按新速率重新计算等待时间"""
+        with self._cond:
+            self._refill()
+            self.rate = rate or None
+            if self.rate:
+                self._tokens = min(self._tokens, self.rate)
+            self._cond.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            # 桶容量为1秒的流量，空闲后最多突发1秒
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def consume(self, amount: int):
+        """写入 amount 字节之前调用，超出速率时阻塞等待"""
+        with self._cond:
+            while self.rate:
+                self._refill()
+                if self._tokens >= 0:
+                    # 允许透支一个数据块，下一次写入前补足
+                    self._tokens -= amount
+                    return
+                self._cond.wait(-self._tokens / self.rate)
+
+
+# 进程内所有下载共享的全局限速
+global_bandwidth_limiter = BandwidthLimiter()
+
+
+class ProgressReporter:
+    """下载事件分发：阶段开始/结束、传输进度（字节数、瞬时和平均速度、剩余时间）以及合并耗时
+
+    事件为dict，'type' 为 'stage_start'、'progress' 或 'stage_end'，'stage' 为 'download' 或 'merge'，
+    'item' 为文件名。进度事件按监听器限频，同一文件每秒最多投递 max_rate 次；阶段开始/结束和最后一次进度总是投递
+    """
+
+    def __init__(self):
+        self._listeners = []  # [回调, 最小间隔, {文件名: 上次投递时间}]
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback, max_rate: float = 10):
+        """添加监听器，callback(event) 在下载线程中调用，不应长时间阻塞"""
+        with self._lock:
+            self._listeners.append([callback, 1.0 / max_rate if max_rate else 0, {}])
+        return callback
+
+    def remove_listener(self, callback):
+        """移除监听器"""
+        with self._lock:
+            self._listeners = [l for l in self._listeners if l[0] is not callback]
+
+    def emit(self, event: Dict[str, Any]):
+        """投递事件给所有到期的监听器"""
+        now = time.monotonic()
+        item = event['item']
+        force = event['type'] != 'progress' or event.get('final')
+        targets = []
+        with self._lock:
+            for callback, interval, last_times in self._listeners:
+                if event['type'] == 'stage_end':
+                    last_times.pop(item, None)
+                elif not force and now - last_times.get(item, 0) < interval:
+                    continue
+                else:
+                    last_times[item] = now
+                targets.append(callback)
+        for callback in targets:
+            try:
+                callback(event)
+            except Exception as e:
+                print(f"事件监听器出错: {str(e)}")
+
+    def stage_start(self, stage: str, item: str, **fields) -> float:
+        """发送阶段开始事件，返回开始时间"""
+        self.emit(dict(fields, type='stage_start', stage=stage, item=item))
+        return time.monotonic()
+
+    def stage_end(self, stage: str, item: str, start_time: float, success: bool, **fields):
+        """发送阶段结束事件，包含耗时"""
+        self.emit(dict(fields, type='stage_end', stage=stage, item=item, success=success,
+                       elapsed=time.monotonic() - start_time))
+
+
+class TransferTracker:
+    """统计单个文件的传输进度，通过 ProgressReporter 发送下载阶段的事件，可被多个分段线程同时更新"""
+
+    SPEED_WINDOW = 1.0  # 计算瞬时速度的时间窗口（秒）
+
+    def __init__(self, reporter: ProgressReporter, item: str, file_type: str, total: int, downloaded: int = 0):
+        self.reporter = reporter
+        self.item = item
+        self.file_type = file_type
+        self.total = total
+        self.downloaded = downloaded
+        self._initial = downloaded  # 续传时已有的数据不计入平均速度
+        self._speed = 0.0
+        self._lock = threading.Lock()
+        self._start = reporter.stage_start('download', item, file_type=file_type, total=total,
+                                           downloaded=downloaded)
+        self._window_start = self._start
+        self._window_bytes = 0
+
+    def update(self, amount: int):
+        """记录新写入的数据量"""
+        now = time.monotonic()
+        with self._lock:
+            self.downloaded += amount
+            self._window_bytes += amount
+            if now - self._window_start >= self.SPEED_WINDOW:
+                self._speed = self._window_bytes / (now - self._window_start)
+                self._window_start = now
+                self._window_bytes = 0
+            event = self._progress_event(now)
+        self.reporter.emit(event)
+
+    def _progress_event(self, now: float) -> Dict[str, Any]:
+        elapsed = now - self._start
+        average_speed = (self.downloaded - self._initial) / elapsed if elapsed > 0 else 0.0
+        speed = self._speed or average_speed
+        remaining = self.total - self.downloaded if self.total > 0 else None
+        return {
+            'type': 'progress',
+            'stage': 'download',
+            'item': self.item,
+            'file_type': self.file_type,
+            'downloaded': self.downloaded,
+            'total': self.total,
+            'speed': speed,
+            'average_speed': average_speed,
+            'eta': remaining / speed if remaining is not None and speed > 0 else None,
+            'final': remaining is not None and remaining <= 0,
+        }
+
+    def finish(self, success: bool, error: Optional[str] = None):
+        """发送下载阶段结束事件"""
+        elapsed = time.monotonic() - self._start
+        self.reporter.stage_end('download', self.item, self._start, success, file_type=self.file_type,
+                                downloaded=self.downloaded, total=self.total, error=error,
+                                average_speed=(self.downloaded - self._initial) / elapsed if elapsed > 0 else 0.0)
+
+
+def format_eta(seconds: Optional[float]) -> str:
+    """格式化剩余时间"""
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+def print_progress_event(event: Dict[str, Any]):
+    """命令行的事件监听器：单行刷新显示进度、速度和剩余时间，合并结束时显示耗时"""
+    if event['type'] == 'progress':
+        speed = f"{event['speed'] / (1024 * 1024):.1f} MB/s"
+        if event['total'] > 0:
+            percent = event['downloaded'] / event['total'] * 100
+            print(f"\r下载{event['file_type']}进度: {percent:.1f}%  {speed}  剩余 {format_eta(event['eta'])}",
+                  end='', flush=True)
+        else:
+            print(f"\r下载{event['file_type']}: {event['downloaded'] / (1024 * 1024):.1f} MB  {speed}",
+                  end='', flush=True)
+    elif event['type'] == 'stage_end' and event['stage'] == 'merge':
+        print(f"合并用时: {event['elapsed']:.1f}s")
+
+
+_ffmpeg_lock = threading.Lock()
+
+
+def find_ffmpeg() -> Optional[Dict[str, Any]]:
+    """查找ffmpeg并检测其版本和支持的封装格式，结果在进程内缓存，未找到时返回None"""
+    # 加锁保证多个线程同时首次调用时也只检测一次
+    with _ffmpeg_lock:
+        return _detect_ffmpeg()
+
+
+@functools.lru_cache(maxsize=None)
+def _detect_ffmpeg() -> Optional[Dict[str, Any]]:
+    import subprocess
+    path = shutil.which('ffmpeg')
+    if not path:
+        return None
+    try:
+        version = subprocess.run([path, '-version'], capture_output=True, text=True, check=True)
+        muxers = subprocess.run([path, '-hide_banner', '-muxers'], capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    # -muxers 的输出格式为 " E mp4             MP4 (MPEG-4 Part 14)"
+    formats = set()
+    for line in muxers.stdout.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].startswith('E'):
+            formats.update(fields[1].split(','))
+    return {
+        'path': path,
+        'version': version.stdout.splitlines()[0] if version.stdout else '',
+        'muxers': frozenset(formats),
+    }
+
+
+class CdnHostStats:
+    """按CDN主机记录下载吞吐量（指数加权平均），持久化到JSON文件，用于之后选择镜像"""
+
+    def __init__(self, stats_file: Optional[str], alpha: float = 0.3):
+        self.stats_file = stats_file
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.hosts = {}
+        if stats_file and os.path.exists(stats_file):
+            try:
+                with open(stats_file, 'r', encoding='utf-8') as f:
+                    self.hosts = json.load(f)
+            except Exception as e:
+                print(f"读取CDN统计失败: {str(e)}")
+
+    def record(self, host: Optional[str], size: int, seconds: float):
+        """记录一次传输的字节数和耗时"""
+        if not host or size <= 0 or seconds <= 0:
+            return
+        speed = size / seconds
+        with self._lock:
+            entry = self.hosts.get(host)
+            if entry is None:
+                entry = self.hosts[host] = {'speed': speed, 'samples': 0}
+            else:
+                entry['speed'] = self.alpha * speed + (1 - self.alpha) * entry['speed']
+            entry['samples'] += 1
+            entry['updated'] = time.time()
+            self._dirty = True
+
+    def expected_speed(self, host: Optional[str]) -> Optional[float]:
+        """返回主机的历史平均速度（字节/秒），无记录时返回None"""
+        with self._lock:
+            entry = self.hosts.get(host)
+            return entry['speed'] if entry else None
+
+    def save(self):
+        """将统计写入文件"""
+        if not self.stats_file:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self.hosts, indent=2)
+            self._dirty = False
+        try:
+            temp_file = self.stats_file + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(temp_file, self.stats_file)
+        except Exception as e:
+            print(f"保存CDN统计失败: {str(e)}")
+
+
+THROTTLE_STATUS_CODES = {412, 429}     # B站风控和限流返回的HTTP状态码
+THROTTLE_API_CODES = {-412, -799}      # 接口返回的风控/请求过于频繁错误码
+THROTTLE_MAX_RETRIES = 5               # 被限流的请求最多重试次数
+THROTTLE_BACKOFF_BASE = 1.0            # 退避时间基数（秒），按重试次数指数增长
+THROTTLE_BACKOFF_MAX = 30.0            # 单次退避的最长时间（秒）
+
+
+class AdaptiveConcurrency:
+    """AIMD并发控制：请求正常时逐步增加允许同时进行的请求数，遇到限流时减半并让所有请求暂停一段时间"""
+
+    def __init__(self, name: str, initial: int, minimum: int = 1, maximum: int = 32):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(initial)
+        self.in_flight = 0
+        self._resume_at = 0.0  # 退避结束的时间
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """等待退避结束且有空闲名额"""
+        with self._cond:
+            while True:
+                delay = self._resume_at - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                elif self.in_flight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    def release(self, throttled: bool = False, backoff: float = 0.0, completed: bool = True):
+        """请求结束：正常时加性增加并发数，被限流时乘性减少并暂停 backoff 秒；completed 为False（连接出错）时不调整"""
+        with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                # 同一批并发请求同时被限流时只减半一次
+                if now - self._last_decrease >= backoff:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+                    print(f"\n{self.name}请求被限流，并发数降为 {int(self.limit)}，等待 {backoff:.1f}s 后重试")
+                self._resume_at = max(self._resume_at, now + backoff)
+            elif completed:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+def _is_throttled(response: requests.Response, stream: bool) -> bool:
+    """判断响应是否为限流/风控：HTTP 412/429，或接口返回 -412/-799（流式响应不读取内容）"""
+    if response.status_code in THROTTLE_STATUS_CODES:
+        return True
+    if stream or 'json' not in response.headers.get('content-type', ''):
+        return False
+    try:
+        return response.json().get('code') in THROTTLE_API_CODES
+    except (ValueError, AttributeError):
+        return False
+
+
+class AdaptiveSession(requests.Session):
+    """所有请求经过并发控制的Session：API和CDN分别控制并发，被限流时退避并重试"""
+
+    def __init__(self, api_concurrency: int = 4, cdn_concurrency: int = 8):
+        super().__init__()
+        self.api_control = AdaptiveConcurrency("API", api_concurrency, maximum=16)
+        self.cdn_control = AdaptiveConcurrency("CDN", cdn_concurrency, maximum=32)
+        self.api_hosts = set()  # 其他按API控制并发的主机（host:port），用于本地测试服务器
+
+    def _control_for(self, url: str) -> AdaptiveConcurrency:
+        parsed = urlparse(url)
+        host = parsed.hostname or ''
+        if host.endswith('bilibili.com') or parsed.netloc in self.api_hosts:
+            return self.api_control
+        return self.cdn_control
+
+    def request(self, method, url, *args, **kwargs):
+        control = self._control_for(url)
+        for attempt in range(THROTTLE_MAX_RETRIES + 1):
+            control.acquire()
+            throttled = False
+            completed = False
+            backoff = 0.0
+            try:
+                # 流式响应在收到响应头后即释放名额，下载数据期间不占用
+                response = super().request(method, url, *args, **kwargs)
+                completed = True
+                throttled = _is_throttled(response, kwargs.get('stream', False))
+                if throttled:
+                    # 指数退避加随机抖动，避免所有请求同时重试
+                    backoff = random.uniform(0.5, 1.0) * min(THROTTLE_BACKOFF_MAX,
+                                                             THROTTLE_BACKOFF_BASE * 2 ** attempt)
+            finally:
+                control.release(throttled, backoff, completed)
+            if not throttled or attempt == THROTTLE_MAX_RETRIES:
+                return response
+            response.close()
+        return response
+
+
+class DownloadArchive:
+    """下载记录：只追加的文本文件，每行一个已完成项的键，打开时读入内存集合，查询为O(1)"""
+
+    def __init__(self, archive_file: str):
+        self.archive_file = archive_file
+        self._keys = set()
+        self._lock = threading.Lock()
+        needs_newline = False
+        if os.path.exists(archive_file):
+            with open(archive_file, 'r', encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    needs_newline = not line.endswith('\n')
+                    line = line.strip()
+                    if line:
+                        self._keys.add(line)
+        # 每条记录用一次 O_APPEND 写入，多个进程同时追加时行也不会交错
+        self._fd = os.open(archive_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if needs_newline:
+            # 上次写入中断留下的不完整行，另起一行避免与新记录连在一起
+            os.write(self._fd, b'\n')
+
+    @staticmethod
+    def item_key(bvid: str, pages: Optional[str], quality: int, download_type: str) -> str:
+        """一次下载请求（BV号+分P选择+清晰度+类型）的键，下载前不需要网络请求即可查询"""
+        pages = re.sub(r'\s+', '', pages) if pages else '1'
+        return f"{bvid} p{pages} q{quality} t{download_type}"
+
+    @staticmethod
+    def page_key(bvid: str, cid: int, quality: int, download_type: str) -> str:
+        """单个分P的键"""
+        return f"{bvid} cid{cid} q{quality} t{download_type}"
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: str):
+        """记录已完成的项，写入并同步到磁盘后才加入内存集合"""
+        with self._lock:
+            if key in self._keys:
+                return
+            os.write(self._fd, (key + '\n').encode('utf-8'))
+            os.fsync(self._fd)
+            self._keys.add(key)
+
+    def add_when_done(self, key: str, futures: List[Future]):
+        """所有合并任务都成功后再记录；没有待完成的任务时立即记录"""
+        if not futures:
+            self.add(key)
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+        
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            if all(not f.exception() and f.result() for f in futures):
+                self.add(key)
+        
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class MetadataCache:
+    """基于SQLite的元数据缓存：按键设置TTL，超出容量时按最近访问时间(LRU)淘汰，同一键的并发查询共享一次请求"""
+
+    def __init__(self, db_file: str, max_entries: int = 10000):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._inflight = {}  # 键 -> 正在进行的请求
+        self._inflight_lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(db_file, timeout=10, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key: str) -> Optional[Any]:
+        """读取缓存，不存在或已过期时返回None"""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: float):
+        """写入缓存，ttl 为有效秒数"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + ttl, now),
+            )
+            self._writes += 1
+            # 每写入一定次数检查一次容量，避免每次写入都统计行数
+            if self._writes % 64 == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        """删除过期条目，并按LRU淘汰超出容量的条目（调用方需持有锁）"""
+        self._conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+        count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def get_or_fetch(self, key: str, ttl: float, fetch):
+        """优先返回缓存；未命中时调用 fetch()，同一键同时只有一个请求在进行，其他调用者等待其结果"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        
+        with self._inflight_lock:
+            entry = self._inflight.get(key)
+            is_owner = entry is None
+            if is_owner:
+                entry = {'event': threading.Event()}
+                self._inflight[key] = entry
+        
+        if not is_owner:
+            entry['event'].wait()
+            if 'error' in entry:
+                raise entry['error']
+            return entry['value']
+        
+        try:
+            value = fetch()
+            entry['value'] = value
+            self.set(key, value, ttl)
+            return value
+        except Exception as e:
+            entry['error'] = e
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            entry['event'].set()
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache")
+
+
+DANMAKU_SOURCES = ('protobuf', 'xml')  # 分段protobuf接口 / 完整XML
+DANMAKU_SEGMENT_SECONDS = 360          # protobuf弹幕每段覆盖的时长
+EXTRA_WORKERS = 4                      # 弹幕等附加内容的下载线程数，与视频/音频同时进行
+
+SUBTITLE_FORMATS = ('srt', 'vtt')
+
+
+def format_subtitle(body: List[Dict[str, Any]], fmt: str = 'srt') -> str:
+    """将B站字幕JSON的 body（[{from, to, content}]）转换为SRT或VTT文本"""
+    separator = '.' if fmt == 'vtt' else ','
+    
+    def timestamp(seconds: float) -> str:
+        milliseconds = int(round(seconds * 1000))
+        hours, milliseconds = divmod(milliseconds, 3600000)
+        minutes, milliseconds = divmod(milliseconds, 60000)
+        seconds, milliseconds = divmod(milliseconds, 1000)
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{milliseconds:03d}"
+    
+    lines = ['WEBVTT', ''] if fmt == 'vtt' else []
+    for index, line in enumerate(body, 1):
+        if fmt == 'srt':
+            lines.append(str(index))
+        lines.append(f"{timestamp(line['from'])} --> {timestamp(line['to'])}")
+        lines.append(line.get('content', '').strip())
+        lines.append('')
+    return '\n'.join(lines)
+
+
+COVER_FORMATS = ('jpg', 'webp', 'png', 'avif')  # 图片CDN支持输出的封面格式
+
+
+def parse_cover_size(value: str):
+    """解析封面尺寸，如 640x360、640x（只限制宽度）、x360，返回 (宽, 高)"""
+    match = re.fullmatch(r'\s*(\d*)\s*[xX*]?\s*(\d*)\s*', value or '')
+    if not match or not (match.group(1) or match.group(2)):
+        raise ValueError(f"无效的封面尺寸: {value}")
+    width = int(match.group(1)) if match.group(1) else None
+    height = int(match.group(2)) if match.group(2) else None
+    return width, height
+
+
+def cover_variant_url(url: str, width: Optional[int] = None, height: Optional[int] = None,
+                      fmt: Optional[str] = None) -> str:
+    """生成图片CDN缩放/转码后的封面地址，如 xxx.jpg@640w_360h_1c.webp；都未指定时返回原图地址"""
+    url = url.split('@', 1)[0]
+    if not (width or height or fmt):
+        return url
+    params = []
+    if width:
+        params.append(f"{width}w")
+    if height:
+        params.append(f"{height}h")
+    if width and height:
+        params.append("1c")  # 同时指定宽高时裁剪填满，与本地转换一致
+    return f"{url}@{'_'.join(params)}.{fmt or 'jpg'}"
+
+
+def convert_cover(source: str, outputs: List[tuple]) -> List[str]:
+    """在进程池中运行：将封面缩放/转换为 outputs 中的每个 (文件名, 宽, 高, 格式)，返回生成的文件名"""
+    from PIL import Image, ImageOps
+    save_formats = {'jpg': 'JPEG', 'webp': 'WEBP', 'png': 'PNG', 'avif': 'AVIF'}
+    created = []
+    with Image.open(source) as image:
+        image.load()
+        for filename, width, height, fmt in outputs:
+            result = image
+            if width and height:
+                result = ImageOps.fit(image, (width, height), Image.LANCZOS)
+            elif width or height:
+                scale = (width / image.width) if width else (height / image.height)
+                size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+                result = image.resize(size, Image.LANCZOS)
+            if fmt == 'jpg' and result.mode not in ('RGB', 'L'):
+                result = result.convert('RGB')
+            part_file = filename + '.part'
+            result.save(part_file, save_formats[fmt])
+            os.replace(part_file, filename)
+            created.append(filename)
+    return created
+
+
+COLLECTION_PAGE_WORKERS = 4  # 枚举合集/收藏夹时同时请求的页数
+WBI_KEYS_TTL = 3600           # WBI密钥每天更换，缓存1小时
+
 
 class BilibiliVideoDownloader:
-    def __init__(self, cookies_file: str = "bilibili_cookies.json"):
-        self.session = requests.Session()
+    VIDEO_INFO_TTL = 3600  # 视频信息缓存有效期（秒）
+    PLAY_URL_TTL = 600     # 播放地址为带时效签名的URL，缓存有效期较短
+    LOGIN_VERIFY_TTL = 12 * 3600  # 登录验证结果的有效期（秒），期间恢复登录状态不请求nav接口
+    LOGIN_FREE_QUALITY = 64       # 未登录可用的最高清晰度，请求更高清晰度前需要确认登录有效
+
+    def __init__(self, cookies_file: str = "bilibili_cookies.json", connections: int = 1,
+                 cache_file: Optional[str] = "bilibili_cache.db",
+                 cdn_stats_file: Optional[str] = "bilibili_cdn_stats.json",
+                 api_base: str = API_BASE, passport_base: str = PASSPORT_BASE, comment_base: str = COMMENT_BASE):
+        # 接口地址可以指向本地测试服务器
+        self.api_base = api_base.rstrip('/')
+        self.passport_base = passport_base.rstrip('/')
+        self.comment_base = comment_base.rstrip('/')
+        self.session = AdaptiveSession()
+        self.session.api_hosts = {urlparse(base).netloc for base in
+                                  (self.api_base, self.passport_base, self.comment_base)}
+        # 分段下载时多个连接同时访问同一CDN主机，需要增大连接池
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
             'Referer': 'https://www.bilibili.com/',
         }
         self.session.headers.update(self.headers)
-        self.is_logged_in = False
+        self._logged_in = False
+        self._login_unverified = False  # 从文件恢复的Cookie尚未在有效期内验证过
+        self._login_lock = threading.Lock()
+        self._verified_time = None      # 最近一次nav接口确认登录有效的时间
         self.cookies = None
-        self.cookies_file = cookies_file
+        self.cookies_file = os.path.abspath(cookies_file)  # 后台验证可能在切换下载目录之后写入
         self.user_info = None
+        self.connections = max(1, connections)  # 每个文件的分段下载连接数，1为单连接
+        self.page_workers = 4  # 多P视频同时下载的分P数
+        self.stream_merge = False  # 边下载边通过命名管道送入ffmpeg合并，不保存临时文件
+        self.merge_engine = 'auto'  # 合并方式: auto(优先内置remux，失败回退ffmpeg)、ffmpeg、python
+        self.merge_workers = os.cpu_count() or 1  # 后台合并线程数，合并与后续下载同时进行
+        self._merge_executor = None
+        self._merge_executor_lock = threading.Lock()
+        self.danmaku = False              # 同时下载弹幕并转换为ASS字幕
+        self.danmaku_source = 'protobuf'  # DANMAKU_SOURCES 之一
+        self.subtitles = False            # 同时下载所有字幕轨道（CC/AI字幕）
+        self.subtitle_format = 'srt'      # SUBTITLE_FORMATS 之一
+        self._extras_executor = None
+        self._extras_executor_lock = threading.Lock()
+        self.cover_size = None       # (宽, 高)，由图片CDN缩放，None为原图
+        self.cover_format = None     # COVER_FORMATS 之一，None为原图格式
+        self.cover_thumbnails = []   # 额外生成的缩略图尺寸 [(宽, 高)]，在本地进程池中生成
+        self._cover_executor = None
+        self._cover_executor_lock = threading.Lock()
+        self.bandwidth_limiter = global_bandwidth_limiter  # 进程内所有下载共享的限速
+        self.per_download_rate = None  # 单个文件的限速（字节/秒），None为不限速
+        self._download_limiters = weakref.WeakSet()
+        self.fsync_policy = 'none'  # 写入同步策略，见 FSYNC_POLICIES
+        self._buffers = threading.local()  # 每个线程复用一个写入缓冲区
+        
+        # 下载事件，默认在命令行显示进度
+        self.events = ProgressReporter()
+        self.events.add_listener(print_progress_event, max_rate=4)
+        self._progress_callback_listener = None
+        self.archive = None  # 下载记录，见 set_archive
+        self._wbi_keys = None  # (img_key, sub_key, 获取时间)
+        
+        # 元数据缓存，cache_file 为None时不使用缓存；使用其他接口地址时缓存键加上前缀，与B站的数据分开
+        self.metadata_cache = None
+        self._cache_prefix = '' if self.api_base == API_BASE else f"{self.api_base}|"
+        if cache_file:
+            try:
+                self.metadata_cache = MetadataCache(os.path.abspath(cache_file))
+            except Exception as e:
+                print(f"打开元数据缓存失败，将不使用缓存: {str(e)}")
+        
+        # 各CDN主机的历史吞吐量
+        self.cdn_stats = CdnHostStats(os.path.abspath(cdn_stats_file) if cdn_stats_file else None)
         
-        # 尝试从文件加载Cookie
+        # 尝试从文件加载Cookie（不请求网络，登录状态在需要时才验证）
         self.load_cookies()
 
+    @property
+    def is_logged_in(self) -> bool:
+        """是否已登录；从文件恢复的登录状态在后台验证，读取时不等待验证结果"""
+        return self._logged_in
+
+    @is_logged_in.setter
+    def is_logged_in(self, value: bool):
+        self._logged_in = value
+        self._login_unverified = False
+
+    def ensure_login_verified(self) -> bool:
+        """需要登录才能获取的内容（高清晰度）请求前调用：等待并确认恢复的登录状态有效"""
+        if self._login_unverified:
+            with self._login_lock:
+                if self._login_unverified:
+                    self._verify_restored_login()
+        return self._logged_in
+
     def load_cookies(self):
-        """从文件加载保存的Cookie"""
+        """从文件加载保存的Cookie，返回是否恢复了Cookie
+
+        验证结果在 LOGIN_VERIFY_TTL 内时直接沿用，否则在后台线程中请求nav接口验证，不阻塞启动
+        """
         try:
-            if os.path.exists(self.cookies_file):
-                with open(self.cookies_file, 'r', encoding='utf-8') as f:
-                    cookie_data = json.load(f)
-                    
-                    # 检查Cookie是否过期
-                    if 'expiry_time' in cookie_data:
-                        expiry_time = datetime.fromisoformat(cookie_data['expiry_time'])
-                        if expiry_time < datetime.now():
-                            print("Cookie已过期，需要重新登录")
-                            return False
-                    
-                    # 加载Cookie到session
-                    cookies = cookie_data.get('cookies', {})
-                    for name, value in cookies.items():
-                        self.session.cookies.set(name, value)
-                    
-                    # 加载用户信息
-                    self.user_info = cookie_data.get('user_info', None)
-                    self.is_logged_in = True
-                    self.cookies = cookies
-                    
-                    # 验证Cookie是否仍然有效
-                    if self.verify_login():
-                        print(f"✓ 已从 {self.cookies_file} 恢复登录状态")
-                        if self.user_info:
-                            print(f"   用户: {self.user_info.get('uname', '未知用户')}")
-                        return True
-                    else:
-                        print("Cookie已失效，需要重新登录")
-                        self.is_logged_in = False
-                        self.cookies = None
-                        self.user_info = None
-                        return False
-            return False
+            cookie_data = read_cookie_file(self.cookies_file)
+            if not cookie_data:
+                return False
+            
+            # 加载Cookie到session，旧版文件没有 cookie_expires
+            cookies = cookie_data.get('cookies', {})
+            expires = cookie_data.get('cookie_expires') or {}
+            for name, value in cookies.items():
+                self.session.cookies.set(name, value, expires=expires.get(name))
+            
+            # 加载用户信息
+            self.user_info = cookie_data.get('user_info', None)
+            self.cookies = cookies
+            self._logged_in = True
+            verified_time = cookie_data.get('verified_time')
+            self._verified_time = datetime.fromisoformat(verified_time) if verified_time else None
+            print(f"✓ 已从 {self.cookies_file} 恢复登录状态")
+            if self.user_info:
+                print(f"   用户: {self.user_info.get('uname', '未知用户')}")
+            if (self._verified_time and
+                    (datetime.now() - self._verified_time).total_seconds() < self.LOGIN_VERIFY_TTL):
+                return True
+            
+            self._login_unverified = True
+            threading.Thread(target=self.ensure_login_verified, name='verify-login', daemon=True).start()
+            return True
         except Exception as e:
             print(f"加载Cookie失败: {str(e)}")
             return False
 
+    def _verify_restored_login(self):
+        """验证从文件恢复的Cookie是否仍然有效：失效时清除登录状态，网络错误时沿用保存的状态（下次启动时再验证）"""
+        try:
+            user_info = self._fetch_nav_user_info()
+        except Exception as e:
+            print(f"无法验证登录状态，暂时沿用保存的登录状态: {str(e)}")
+            return
+        finally:
+            # 网络错误时本次运行不再重试
+            self._login_unverified = False
+        if user_info:
+            self.user_info = user_info
+            self._verified_time = datetime.now()
+            self._write_cookie_file()
+            return
+        print("Cookie已失效，需要重新登录")
+        self._logged_in = False
+        self.cookies = None
+        self.user_info = None
+
+    def _write_cookie_file(self):
+        """按当前Cookie、各Cookie的过期时间和验证时间写入Cookie文件"""
+        write_cookie_file(self.cookies_file, self.cookies, self.user_info,
+                          cookie_expiry_times(self.session.cookies), self._verified_time)
+
     def save_cookies(self):
         """保存Cookie到文件"""
         try:
@@ -78,51 +1159,34 @@ class BilibiliVideoDownloader:
             if not self.user_info:
                 self.get_user_info()
             
-            # 准备保存的数据
-            cookie_data = {
-                'cookies': self.cookies,
-                'user_info': self.user_info,
-                'save_time': datetime.now().isoformat(),
-                'expiry_time': (datetime.now() + timedelta(days=7)).isoformat(),  # 7天后过期
-            }
-            
-            with open(self.cookies_file, 'w', encoding='utf-8') as f:
-                json.dump(cookie_data, f, ensure_ascii=False, indent=2)
-            
+            self._write_cookie_file()
             print(f"✓ Cookie已保存到 {self.cookies_file}")
             return True
         except Exception as e:
             print(f"保存Cookie失败: {str(e)}")
             return False
 
+    def _fetch_nav_user_info(self) -> Optional[Dict[str, Any]]:
+        """请求nav接口，已登录时返回用户信息，未登录返回None，网络错误时抛出异常"""
+        response = self.session.get(f"{self.api_base}/x/web-interface/nav")
+        response.raise_for_status()
+        return parse_nav_user_info(response.json())
+
     def verify_login(self) -> bool:
         """验证登录状态是否有效"""
         try:
             # 调用一个需要登录的API来验证
-            api_url = "https://api.bilibili.com/x/web-interface/nav"
-            response = self.session.get(api_url)
-            data = response.json()
-            
-            if data['code'] == 0 and data['data']['isLogin']:
-                return True
-            return False
+            return self._fetch_nav_user_info() is not None
         except:
             return False
 
     def get_user_info(self):
         """获取用户信息"""
         try:
-            api_url = "https://api.bilibili.com/x/web-interface/nav"
-            response = self.session.get(api_url)
-            data = response.json()
-            
-            if data['code'] == 0 and data['data']['isLogin']:
-                self.user_info = {
-                    'uid': data['data']['mid'],
-                    'uname': data['data']['uname'],
-                    'face': data['data']['face'],
-                    'vipStatus': data['data']['vipStatus'],
-                }
+            user_info = self._fetch_nav_user_info()
+            if user_info:
+                self.user_info = user_info
+                self._verified_time = datetime.now()
                 return self.user_info
             return None
         except Exception as e:
@@ -131,24 +1195,18 @@ class BilibiliVideoDownloader:
 
     def extract_bvid(self, input_str: str) -> Optional[str]:
         """从输入中提取BV号"""
-        # 如果是URL
-        if input_str.startswith('http'):
-            parsed_url = urlparse(input_str)
-            path = parsed_url.path
-            # 匹配BV号模式
-            bv_match = re.search(r'BV[0-9A-Za-z]{10}', path)
-            if bv_match:
-                return bv_match.group()
-            return None
-        # 如果是纯BV号
-        elif input_str.startswith('BV'):
-            return input_str
-        else:
-            return None
+        return extract_bvid(input_str)
 
     def get_video_info(self, bvid: str) -> Dict[str, Any]:
-        """获取视频信息"""
-        api_url = f"https://api.bilibili.com/x/web-interface/view"
+        """获取视频信息（优先使用缓存）"""
+        if self.metadata_cache:
+            return self.metadata_cache.get_or_fetch(
+                f"{self._cache_prefix}view:{bvid}", self.VIDEO_INFO_TTL, lambda: self._fetch_video_info(bvid))
+        return self._fetch_video_info(bvid)
+
+    def _fetch_video_info(self, bvid: str) -> Dict[str, Any]:
+        """请求视频信息接口"""
+        api_url = f"{self.api_base}/x/web-interface/view"
         params = {'bvid': bvid}
         
         try:
@@ -167,7 +1225,7 @@ class BilibiliVideoDownloader:
         """扫码登录B站"""
         try:
             # 获取登录二维码
-            qr_url = "https://passport.bilibili.com/x/passport-login/web/qrcode/generate"
+            qr_url = f"{self.passport_base}/x/passport-login/web/qrcode/generate"
             response = self.session.get(qr_url)
             qr_data = response.json()
             
@@ -179,6 +1237,7 @@ class BilibiliVideoDownloader:
             qrcode_key = qr_data['data']['qrcode_key']
             
             # 生成二维码图片
+            import qrcode
             qr = qrcode.QRCode(version=1, box_size=10, border=5)
             qr.add_data(qr_code_url)
             qr.make(fit=True)
@@ -208,7 +1267,7 @@ class BilibiliVideoDownloader:
 
     def _check_login_status(self, qrcode_key: str) -> bool:
         """检查登录状态"""
-        check_url = "https://passport.bilibili.com/x/passport-login/web/qrcode/poll"
+        check_url = f"{self.passport_base}/x/passport-login/web/qrcode/poll"
         params = {'qrcode_key': qrcode_key}
         
         for i in range(180):  # 最多等待3分钟
@@ -268,14 +1327,32 @@ class BilibiliVideoDownloader:
             print(f"退出登录失败: {str(e)}")
             return False
 
-    def get_video_play_url(self, bvid: str, cid: str, quality: int = 80) -> Dict[str, Any]:
-        """获取视频播放地址"""
-        api_url = "https://api.bilibili.com/x/player/playurl"
+    def get_video_play_url(self, bvid: str, cid: str, quality: int = 80,
+                           wanted_quality: Optional[int] = None) -> Dict[str, Any]:
+        """获取视频播放地址（优先使用缓存）
+
+        一次请求所有清晰度时 quality 为 MAX_QUALITY，wanted_quality 为实际要下载的清晰度（默认与 quality 相同）
+        """
+        if (wanted_quality or quality) > self.LOGIN_FREE_QUALITY:
+            # 需要登录才能获取的清晰度：等待恢复的登录状态验证完成
+            self.ensure_login_verified()
+        # 登录状态尚未验证时不读写缓存，避免以失效的用户ID作为缓存键
+        if self.metadata_cache and not self._login_unverified:
+            # 登录状态不同时可用的清晰度不同，缓存键中包含用户ID
+            uid = (self.user_info or {}).get('uid', 0) if self.is_logged_in else 0
+            return self.metadata_cache.get_or_fetch(
+                f"{self._cache_prefix}playurl:{bvid}:{cid}:{quality}:{uid}", self.PLAY_URL_TTL,
+                lambda: self._fetch_video_play_url(bvid, cid, quality))
+        return self._fetch_video_play_url(bvid, cid, quality)
+
+    def _fetch_video_play_url(self, bvid: str, cid: str, quality: int = 80) -> Dict[str, Any]:
+        """请求播放地址接口"""
+        api_url = f"{self.api_base}/x/player/playurl"
         params = {
             'bvid': bvid,
             'cid': cid,
             'qn': quality,  # 视频质量
-            'fnval': 16,    # 支持dash格式
+            'fnval': DASH_FNVAL_ALL,  # dash格式，并请求所有格式和清晰度
             'fourk': 1,     # 支持4K
         }
         
@@ -291,36 +1368,512 @@ class BilibiliVideoDownloader:
         except Exception as e:
             raise Exception(f"获取播放地址时出错: {str(e)}")
 
-    def download_file(self, url: str, filename: str, file_type: str = "文件") -> bool:
-        """下载文件"""
+    def set_rate_limit(self, rate: Optional[float] = None, per_download_rate: Optional[float] = None):
+        """设置全局限速和单个下载的限速（字节/秒，None为不限速），对正在进行的下载立即生效"""
+        self.bandwidth_limiter.set_rate(rate)
+        self.per_download_rate = per_download_rate or None
+        for limiter in list(self._download_limiters):
+            limiter.set_rate(self.per_download_rate)
+
+    def _new_download_limiter(self) -> BandwidthLimiter:
+        """为单个下载创建限速器，同一文件的多个分段共享"""
+        limiter = BandwidthLimiter(self.per_download_rate)
+        self._download_limiters.add(limiter)
+        return limiter
+
+    def _throttle(self, limiter: Optional[BandwidthLimiter], amount: int):
+        """写入前先从单个下载的限速器、再从全局限速器获取令牌"""
+        if limiter:
+            limiter.consume(amount)
+        self.bandwidth_limiter.consume(amount)
+
+    def set_archive(self, archive_file: Optional[str]):
+        """设置下载记录文件，已记录的项不再请求接口和下载；None为不使用"""
+        if self.archive:
+            self.archive.close()
+        self.archive = DownloadArchive(archive_file) if archive_file else None
+        if self.archive:
+            print(f"下载记录: {archive_file} ({len(self.archive)} 条)")
+
+    def _write_buffer(self) -> bytearray:
+        """当前线程复用的写入缓冲区"""
+        buffer = getattr(self._buffers, 'buffer', None)
+        if buffer is None:
+            buffer = self._buffers.buffer = bytearray(WRITE_BLOCK_SIZE)
+        return buffer
+
+    def _write_block(self, f, block: memoryview):
+        """将一块数据完整写入无缓冲文件，按同步策略决定是否立即同步到磁盘"""
+        written = 0
+        while written < len(block):
+            written += f.write(block[written:])
+        if self.fsync_policy == 'always':
+            os.fsync(f.fileno())
+
+    def download_file(self, url: str, filename: str, file_type: str = "文件",
+                      connections: Optional[int] = None, backup_urls: Optional[List[str]] = None) -> bool:
+        """下载文件（先写入 .part 文件，支持断点续传；提供备用地址时选择最快的CDN镜像）"""
+        connections = connections or self.connections
+        part_file = filename + '.part'
+        
+        mirrors = [url] + [u for u in (backup_urls or []) if u and u != url]
+        if len(mirrors) > 1:
+            mirrors, total_size, accept_ranges = self._race_mirrors(mirrors)
+            if not mirrors:
+                print(f"\n{file_type}下载失败: 所有CDN地址均不可用")
+                return False
+        else:
+            total_size, accept_ranges = self._probe_range_support(url)
+        limiter = self._new_download_limiter()
+        if total_size > 0 and accept_ranges:
+            return self._download_file_ranges(url, filename, file_type, total_size, connections, mirrors,
+                                              limiter)
+        url = mirrors[0]
+        
+        if connections > 1:
+            print(f"服务器不支持分段下载，{file_type}使用单连接下载")
+        else:
+            print(f"服务器不支持Range请求，{file_type}无法断点续传")
+        
+        tracker = None
         try:
-            response = self.session.get(url, stream=True)
-            response.raise_for_status()
+            # 出错时也立即关闭流式响应，释放连接
+            with self.session.get(url, stream=True) as response:
+                response.raise_for_status()
+                
+                total_size = int(response.headers.get('content-length', 0))
+                downloaded_size = 0
+                tracker = TransferTracker(self.events, filename, file_type, total_size)
+                
+                with open(part_file, 'wb', buffering=0) as f:
+                    if total_size > 0:
+                        _preallocate(f.fileno(), total_size)
+                    for block in iter_response_blocks(response, self._write_buffer(),
+                                                      on_read=lambda n: self._throttle(limiter, n)):
+                        self._write_block(f, block)
+                        downloaded_size += len(block)
+                        tracker.update(len(block))
+                    if self.fsync_policy == 'end':
+                        os.fsync(f.fileno())
             
-            total_size = int(response.headers.get('content-length', 0))
-            downloaded_size = 0
+            if total_size > 0 and downloaded_size != total_size:
+                raise Exception(f"数据不完整: {downloaded_size}/{total_size} 字节")
+            os.replace(part_file, filename)
+            tracker.finish(True)
             
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded_size += len(chunk)
-                        if total_size > 0:
-                            progress = (downloaded_size / total_size) * 100
-                            print(f"\r下载{file_type}进度: {progress:.1f}%", end='', flush=True)
+            print(f"\n{file_type}下载完成: {filename}")
+            return True
+            
+        except Exception as e:
+            if tracker:
+                tracker.finish(False, str(e))
+            print(f"\n{file_type}下载失败: {str(e)}")
+            return False
+
+    def _probe_range_support(self, url: str):
+        """探测文件大小及服务器是否支持Range请求，返回 (总大小, 是否支持Range)"""
+        try:
+            response = self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True)
+            try:
+                response.raise_for_status()
+                return _parse_range_response(response)
+            finally:
+                response.close()
+        except Exception:
+            return 0, False
+
+    def _race_mirrors(self, urls: List[str]):
+        """让主地址和备用地址同时下载一小段数据，按实测速度和历史速度排序，返回 (排序后的地址, 总大小, 是否支持Range)"""
+        candidates = urls[:MIRROR_RACE_LIMIT]
+        results = {}
+        
+        def probe(url: str):
+            start_time = time.time()
+            response = self.session.get(url, headers={'Range': f'bytes=0-{MIRROR_RACE_BYTES - 1}'},
+                                        stream=True, timeout=MIRROR_RACE_TIMEOUT)
+            try:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # 忽略Range的镜像会返回整个文件，不参与竞速
+                    raise Exception(f"镜像不支持Range请求: HTTP {response.status_code}")
+                total_size, accept_ranges = _parse_range_response(response)
+                received = 0
+                for chunk in response.iter_content(chunk_size=65536):
+                    received += len(chunk)
+                    if received >= MIRROR_RACE_BYTES:
+                        break
+            finally:
+                response.close()
+            # 竞速样本很小，主要反映建立连接的耗时，不计入主机的历史速度（历史只记录完整分段的吞吐量）
+            elapsed = max(time.time() - start_time, 1e-3)
+            return received / elapsed, total_size, accept_ranges
+        
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        futures = {executor.submit(probe, url): url for url in candidates}
+        try:
+            for future in as_completed(futures, timeout=MIRROR_RACE_TIMEOUT):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception:
+                    pass
+        except Exception:
+            pass  # 超时未完成的镜像视为不可用
+        finally:
+            executor.shutdown(wait=False)
+        
+        if not results:
+            # 竞速全部失败（可能只是一次连接中断），依次探测各地址，可用的排在最前
+            for i, url in enumerate(urls):
+                total_size, accept_ranges = self._probe_range_support(url)
+                if total_size > 0:
+                    return urls[i:] + urls[:i], total_size, accept_ranges
+            return [], 0, False
+        
+        def score(url: str) -> float:
+            # 本次实测速度与该主机的历史平均速度各占一半
+            measured = results[url][0]
+            history = self.cdn_stats.expected_speed(urlparse(url).hostname)
+            return measured if history is None else (measured + history) / 2
+        
+        ranked = sorted(results, key=score, reverse=True)
+        # 未参与竞速的地址排在其后，竞速失败的地址（可能只是偶发错误）放在最后，都作为中途切换的备选
+        ranked += [url for url in urls if url not in candidates]
+        ranked += [url for url in candidates if url not in results]
+        best = ranked[0]
+        print(f"选择CDN节点: {urlparse(best).hostname} ({results[best][0] / (1024 * 1024):.1f} MB/s)")
+        _, total_size, accept_ranges = results[best]
+        return ranked, total_size, accept_ranges
+
+    def _load_download_state(self, state_file: str, part_file: str, url: str, total_size: int) -> List[list]:
+        """读取断点续传状态，返回已完成的字节范围；状态与当前下载不匹配时返回空列表"""
+        try:
+            if not (os.path.exists(state_file) and os.path.exists(part_file)):
+                return []
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            # 签名URL每次请求都会变化，使用URL路径作为流的标识
+            if state.get('url_id') != urlparse(url).path or state.get('total_size') != total_size:
+                print("断点续传状态与当前文件不匹配，重新下载")
+                return []
+            if os.path.getsize(part_file) != total_size:
+                return []
+            return _merge_ranges(state.get('completed', []))
+        except Exception as e:
+            print(f"读取断点续传状态失败: {str(e)}")
+            return []
+
+    def _save_download_state(self, state_file: str, url: str, total_size: int, completed: List[list]):
+        """原子地写入断点续传状态文件"""
+        state = {
+            'url_id': urlparse(url).path,
+            'total_size': total_size,
+            'completed': _merge_ranges(completed),
+            'update_time': datetime.now().isoformat(),
+        }
+        temp_file = state_file + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(temp_file, state_file)
+
+    def _download_file_ranges(self, url: str, filename: str, file_type: str, total_size: int,
+                              connections: int, mirrors: Optional[List[str]] = None,
+                              limiter: Optional[BandwidthLimiter] = None) -> bool:
+        """按字节范围下载缺失部分，多连接并发写入预分配的 .part 文件，完成后校验并重命名"""
+        mirrors = mirrors or [url]
+        part_file = filename + '.part'
+        state_file = part_file + '.json'
+        
+        completed = self._load_download_state(state_file, part_file, url, total_size)
+        missing = _missing_ranges(completed, total_size)
+        done_size = total_size - sum(end - start for start, end in missing)
+        if done_size > 0:
+            print(f"发现未完成的{file_type}下载，已完成 {done_size / total_size * 100:.1f}%，继续下载剩余部分")
+        
+        pieces = _split_ranges(missing, connections)
+        if connections > 1:
+            print(f"{file_type}大小 {total_size / (1024 * 1024):.1f} MB，使用 {min(connections, len(pieces))} 个连接分段下载")
+        
+        # 每个分段的当前进度 [起始, 已写入位置)，用于持久化状态
+        segments = [[start, start] for start, end in pieces]
+        progress = {'downloaded': done_size, 'last_save': time.time(),
+                    'tracker': TransferTracker(self.events, filename, file_type, total_size, done_size)}
+        lock = threading.Lock()
+        cancel_event = threading.Event()
+        
+        def save_state():
+            self._save_download_state(state_file, url, total_size,
+                                      completed + [list(seg) for seg in segments if seg[1] > seg[0]])
+        
+        try:
+            if not completed:
+                # 预分配输出文件
+                with open(part_file, 'wb') as f:
+                    _preallocate(f.fileno(), total_size)
+                save_state()
+            
+            with ThreadPoolExecutor(max_workers=max(1, min(connections, len(pieces)))) as executor:
+                futures = [
+                    executor.submit(self._download_range, mirrors, part_file, start, end, segments[i],
+                                    file_type, total_size, progress, lock, cancel_event, save_state, limiter)
+                    for i, (start, end) in enumerate(pieces)
+                ]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except Exception:
+                    # 任一分段失败时通知其他分段尽快停止
+                    cancel_event.set()
+                    raise
+            
+            if self.fsync_policy == 'end':
+                with open(part_file, 'r+b') as f:
+                    os.fsync(f.fileno())
+            
+            # 校验文件大小后再重命名为最终文件
+            actual_size = os.path.getsize(part_file)
+            if actual_size != total_size:
+                raise Exception(f"文件大小校验失败: {actual_size}/{total_size} 字节")
+            os.replace(part_file, filename)
+            if os.path.exists(state_file):
+                os.remove(state_file)
+            self.cdn_stats.save()
+            progress['tracker'].finish(True)
             
             print(f"\n{file_type}下载完成: {filename}")
             return True
             
         except Exception as e:
+            progress['tracker'].finish(False, str(e))
+            try:
+                with lock:
+                    save_state()
+                print(f"\n{file_type}下载中断，已保存进度，重新下载时将继续")
+            except Exception:
+                pass
             print(f"\n{file_type}下载失败: {str(e)}")
             return False
 
+    def _download_range(self, mirrors: List[str], part_file: str, start: int, end: int, segment: list,
+                        file_type: str, total_size: int, progress: dict, lock: threading.Lock,
+                        cancel_event: threading.Event, save_state, limiter: Optional[BandwidthLimiter] = None):
+        """下载单个字节范围 [start, end) 并写入文件对应偏移；速度骤降或连接出错时切换到下一个CDN镜像"""
+        mirror_index = 0
+        switches = 0
+        
+        while segment[1] < end:
+            url = mirrors[mirror_index % len(mirrors)]
+            try:
+                if not self._fetch_range(url, part_file, end, segment, file_type, total_size,
+                                         progress, lock, cancel_event, save_state,
+                                         check_collapse=len(mirrors) > 1, limiter=limiter):
+                    continue
+                reason = "速度骤降"
+            except Exception as e:
+                if cancel_event.is_set() or len(mirrors) < 2 or switches >= MIRROR_MAX_SWITCHES:
+                    raise
+                reason = f"连接出错 ({str(e)})"
+            
+            mirror_index += 1
+            switches += 1
+            if switches > MIRROR_MAX_SWITCHES:
+                raise Exception(f"分段 {start}-{end - 1} 在所有CDN节点上速度过低")
+            next_host = urlparse(mirrors[mirror_index % len(mirrors)]).hostname
+            print(f"\nCDN节点 {urlparse(url).hostname} {reason}，切换到 {next_host}")
+        
+        if segment[1] != end:
+            raise Exception(f"分段 {start}-{end - 1} 数据不完整: {segment[1] - start}/{end - start} 字节")
+
+    def _fetch_range(self, url: str, part_file: str, end: int, segment: list, file_type: str,
+                     total_size: int, progress: dict, lock: threading.Lock, cancel_event: threading.Event,
+                     save_state, check_collapse: bool = False,
+                     limiter: Optional[BandwidthLimiter] = None) -> bool:
+        """从单个地址下载 [segment[1], end)，返回True表示吞吐量骤降需要切换镜像"""
+        position = segment[1]
+        host = urlparse(url).hostname
+        response = self.session.get(url, headers={'Range': f'bytes={position}-{end - 1}'}, stream=True)
+        fetch_start = time.time()
+        window_start = fetch_start
+        window_bytes = 0
+        best_speed = 0.0
+        try:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise Exception(f"服务器未返回分段内容 (HTTP {response.status_code})")
+            
+            # 无缓冲写入，保证状态文件记录的进度都已交给操作系统
+            with open(part_file, 'r+b', buffering=0) as f:
+                f.seek(position)
+                for block in iter_response_blocks(response, self._write_buffer(), position, end - position,
+                                                  on_read=lambda n: self._throttle(limiter, n)):
+                    if cancel_event.is_set():
+                        raise Exception("下载已取消")
+                    self._write_block(f, block)
+                    window_bytes += len(block)
+                    with lock:
+                        segment[1] += len(block)
+                        progress['downloaded'] += len(block)
+                        now = time.time()
+                        if now - progress['last_save'] >= 1:
+                            progress['last_save'] = now
+                            save_state()
+                    progress['tracker'].update(len(block))
+                    if segment[1] >= end:
+                        break
+                    
+                    # 按时间窗口统计吞吐量，低于该连接最佳速度的一定比例时放弃当前镜像
+                    elapsed = now - window_start
+                    if elapsed >= MIRROR_CHECK_INTERVAL:
+                        speed = window_bytes / elapsed
+                        best_speed = max(best_speed, speed)
+                        window_start = now
+                        window_bytes = 0
+                        if check_collapse and speed < best_speed * MIRROR_COLLAPSE_RATIO:
+                            return True
+            return False
+        finally:
+            response.close()
+            elapsed = time.time() - fetch_start
+            if segment[1] > position and elapsed > 0:
+                self.cdn_stats.record(host, segment[1] - position, elapsed)
+
+    def _submit_extra(self, func, *args) -> Future:
+        """提交弹幕等附加内容的下载任务，与视频/音频的下载同时进行"""
+        with self._extras_executor_lock:
+            if self._extras_executor is None:
+                self._extras_executor = ThreadPoolExecutor(max_workers=EXTRA_WORKERS,
+                                                           thread_name_prefix='extras')
+            return self._extras_executor.submit(func, *args)
+
+    def _iter_danmaku_segments(self, cid: int, duration: Optional[float]) -> Iterator[tuple]:
+        """逐段请求protobuf弹幕，每段在内存中排序后按时间顺序产出；时长未知时请求到空段为止"""
+        segments = max(1, -(-int(duration) // DANMAKU_SEGMENT_SECONDS)) if duration else None
+        index = 1
+        while segments is None or index <= segments:
+            response = self.session.get(f"{self.api_base}/x/v2/dm/web/seg.so",
+                                        params={'type': 1, 'oid': cid, 'segment_index': index}, stream=True)
+            try:
+                response.raise_for_status()
+                # 每段只包含6分钟内的弹幕，段内排序后各段依次相接即为全局有序
+                comments = sorted(iter_protobuf_comments(response.iter_content(READ_SIZE)), key=lambda c: c[0])
+            finally:
+                response.close()
+            if segments is None and not comments:
+                return
+            yield from comments
+            index += 1
+
+    def _iter_xml_danmaku(self, cid: int) -> Iterator[tuple]:
+        """流式解析XML弹幕"""
+        response = self.session.get(f"{self.comment_base}/{cid}.xml", stream=True)
+        try:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            yield from iter_xml_comments(response.raw)
+        finally:
+            response.close()
+
+    def download_danmaku(self, cid: int, filename: str, duration: Optional[float] = None) -> bool:
+        """下载分P的弹幕并边解析边转换为ASS字幕，duration 为视频时长（秒），用于确定protobuf分段数"""
+        try:
+            print(f"开始下载弹幕: {filename}")
+            if self.danmaku_source == 'xml':
+                # XML弹幕不保证按时间排序，超过一定数量时使用外部排序
+                comments = sort_comments(self._iter_xml_danmaku(cid))
+            else:
+                comments = self._iter_danmaku_segments(cid, duration)
+            stats = write_ass(comments, filename)
+            print(f"弹幕转换完成: {filename} (共 {stats['total']} 条，"
+                  f"显示 {stats['written']} 条，重叠丢弃 {stats['dropped']} 条)")
+            return True
+        except Exception as e:
+            print(f"下载弹幕失败: {str(e)}")
+            return False
+
+    def get_subtitle_tracks(self, bvid: str, cid: int) -> List[Dict[str, Any]]:
+        """获取分P的字幕轨道列表（含AI字幕），每项包含 lan、lan_doc、subtitle_url"""
+        params = wbi_sign({'bvid': bvid, 'cid': cid}, *self._get_wbi_keys())
+        response = self.session.get(f"{self.api_base}/x/player/wbi/v2", params=params)
+        response.raise_for_status()
+        data = response.json()
+        if data['code'] != 0:
+            raise Exception(f"获取字幕列表失败: {data.get('message')}")
+        return ((data['data'] or {}).get('subtitle') or {}).get('subtitles') or []
+
+    def download_subtitles(self, bvid: str, cid: int, base_name: str) -> bool:
+        """下载分P的所有字幕轨道并转换为SRT/VTT，文件名为 {base_name}.{语言}.{格式}；没有字幕时也返回True"""
+        try:
+            tracks = self.get_subtitle_tracks(bvid, cid)
+            if not tracks:
+                print(f"没有字幕: {base_name}")
+                return True
+            for track in tracks:
+                url = track.get('subtitle_url')
+                if not url:
+                    # AI字幕需要登录后才返回地址，跳过不算失败
+                    print(f"字幕 {track.get('lan_doc', track.get('lan'))} 没有下载地址（可能需要登录），跳过")
+                    continue
+                if url.startswith('//'):
+                    url = 'https:' + url
+                response = self.session.get(url)
+                response.raise_for_status()
+                filename = f"{base_name}.{track.get('lan', 'unknown')}.{self.subtitle_format}"
+                part_file = filename + '.part'
+                # 一个轨道转换为一次写入
+                with open(part_file, 'w', encoding='utf-8') as f:
+                    f.write(format_subtitle(response.json().get('body') or [], self.subtitle_format))
+                os.replace(part_file, filename)
+                print(f"字幕下载完成: {filename}")
+            return True
+        except Exception as e:
+            print(f"下载字幕失败: {str(e)}")
+            return False
+
+    def set_cover_options(self, size=None, fmt: Optional[str] = None, thumbnails: Optional[List[tuple]] = None):
+        """设置封面尺寸 (宽, 高)、格式和额外缩略图尺寸列表"""
+        if fmt is not None and fmt not in COVER_FORMATS:
+            raise ValueError(f"不支持的封面格式: {fmt}")
+        self.cover_size = size
+        self.cover_format = fmt
+        self.cover_thumbnails = list(thumbnails or [])
+
+    def _convert_cover(self, source: str, outputs: List[tuple]) -> List[str]:
+        """在封面转换进程池中缩放/转换封面，CPU密集的图片处理不占用下载线程"""
+        with self._cover_executor_lock:
+            if self._cover_executor is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self._cover_executor = ProcessPoolExecutor(max_workers=max(1, self.merge_workers))
+            future = self._cover_executor.submit(convert_cover, source, outputs)
+        return future.result()
+
     def download_cover(self, cover_url: str, filename: str) -> bool:
-        """下载封面图片"""
+        """下载封面图片；设置了尺寸或格式时直接请求图片CDN缩放/转码后的版本，CDN不支持时下载原图在本地转换"""
+        width, height = self.cover_size or (None, None)
+        fmt = self.cover_format
+        if fmt:
+            filename = os.path.splitext(filename)[0] + '.' + fmt
         try:
             print(f"开始下载封面图片: {filename}")
-            return self.download_file(cover_url, filename, "封面")
+            variant_url = cover_variant_url(cover_url, width, height, fmt)
+            success = self.download_file(variant_url, filename, "封面")
+            if not success and variant_url != cover_url:
+                print("图片CDN未返回指定尺寸/格式的封面，下载原图后在本地转换")
+                original_file = filename + '.orig'
+                if not self.download_file(cover_url, original_file, "封面"):
+                    return False
+                try:
+                    self._convert_cover(original_file, [(filename, width, height, fmt or 'jpg')])
+                    success = True
+                finally:
+                    os.remove(original_file)
+            if success and self.cover_thumbnails:
+                base, ext = os.path.splitext(filename)
+                thumb_format = fmt or {'.webp': 'webp', '.png': 'png', '.avif': 'avif'}.get(ext.lower(), 'jpg')
+                outputs = [(f"{base}_{w or 'auto'}x{h or 'auto'}.{thumb_format}", w, h, thumb_format)
+                           for w, h in self.cover_thumbnails]
+                # 缩略图从已下载的封面生成，不再请求CDN
+                for thumbnail in self._convert_cover(filename, outputs):
+                    print(f"已生成缩略图: {thumbnail}")
+            return success
         except Exception as e:
             print(f"下载封面图片失败: {str(e)}")
             return False
@@ -379,21 +1932,208 @@ class BilibiliVideoDownloader:
         print("3: 视频+音频 (合并)")
         print("4: 仅封面图片")
         print("5: 视频+音频+封面 (合并视频和音频)")
+        print("6: 仅字幕")
         
         while True:
-            choice = input("请选择下载类型 (1/2/3/4/5): ").strip()
-            if choice in ['1', '2', '3', '4', '5']:
+            choice = input("请选择下载类型 (1/2/3/4/5/6): ").strip()
+            if choice in ['1', '2', '3', '4', '5', '6']:
                 return choice
             else:
                 print("无效的选择，请重新输入")
 
-    def merge_video_audio(self, video_file: str, audio_file: str, output_file: str) -> bool:
-        """合并视频和音频文件"""
+    def choose_pages(self, page_list: list) -> str:
+        """选择要下载的分P"""
+        print("\n分P列表:")
+        for page in page_list[:50]:
+            print(f"P{page['page']}: {page.get('part', '')}")
+        if len(page_list) > 50:
+            print(f"... 共 {len(page_list)} P")
+        
+        while True:
+            choice = input("请选择要下载的分P (例如 1-3,5；all 为全部；回车仅下载P1): ").strip()
+            if not choice:
+                return '1'
+            try:
+                parse_page_selection(choice, len(page_list))
+                return choice
+            except ValueError as e:
+                print(f"无效的选择: {str(e)}")
+
+    def _ffmpeg_available(self) -> bool:
+        """检查ffmpeg是否可用"""
+        ffmpeg = find_ffmpeg()
+        return bool(ffmpeg and 'mp4' in ffmpeg['muxers'])
+
+    def download_and_merge_streaming(self, video_url: str, audio_url: str, output_file: str,
+                                     video_backups: Optional[List[str]] = None,
+                                     audio_backups: Optional[List[str]] = None) -> bool:
+        """边下载边合并：视频流和音频流通过命名管道直接送入ffmpeg，只有合并后的文件写入磁盘"""
+        start_time = self.events.stage_start('merge', output_file, engine='stream')
+        success = False
+        try:
+            success = self._download_and_merge_streaming(video_url, audio_url, output_file,
+                                                         video_backups, audio_backups)
+            return success
+        finally:
+            self.events.stage_end('merge', output_file, start_time, success, engine='stream')
+
+    def _download_and_merge_streaming(self, video_url: str, audio_url: str, output_file: str,
+                                      video_backups: Optional[List[str]] = None,
+                                      audio_backups: Optional[List[str]] = None) -> bool:
+        """启动ffmpeg并把两路下载写入命名管道"""
+        import subprocess
+        temp_dir = tempfile.mkdtemp(prefix='bili_merge_')
+        video_fifo = os.path.join(temp_dir, 'video.m4s')
+        audio_fifo = os.path.join(temp_dir, 'audio.m4s')
+        part_file = output_file + '.part'
+        process = None
         try:
-            # 检查ffmpeg是否可用
+            os.mkfifo(video_fifo)
+            os.mkfifo(audio_fifo)
+            
+            cmd = [
+                find_ffmpeg()['path'], '-hide_banner', '-loglevel', 'error',
+                '-i', video_fifo, '-i', audio_fifo,
+                '-c', 'copy',  # 直接复制流，不重新编码
+                '-f', 'mp4', '-y', part_file
+            ]
+            with open(os.path.join(temp_dir, 'ffmpeg.log'), 'w+b') as log:
+                process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=log)
+                
+                print("开始边下载边合并视频和音频...")
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    futures = [
+                        executor.submit(self._stream_to_pipe, [video_url] + (video_backups or []),
+                                        video_fifo, "视频", process, f"{output_file} [视频]"),
+                        executor.submit(self._stream_to_pipe, [audio_url] + (audio_backups or []),
+                                        audio_fifo, "音频", process, f"{output_file} [音频]"),
+                    ]
+                    success = True
+                    for future in as_completed(futures):
+                        if not future.result():
+                            success = False
+                            # 一路失败时结束ffmpeg，另一路写管道会立即出错而不会阻塞
+                            process.kill()
+                
+                returncode = process.wait()
+                if not success:
+                    print("视频或音频下载失败，无法合并")
+                    return False
+                if returncode != 0:
+                    log.seek(0)
+                    print(f"合并失败: {log.read().decode('utf-8', 'replace')}")
+                    return False
+            
+            os.replace(part_file, output_file)
+            print(f"\n合并完成: {output_file}")
+            return True
+            
+        except Exception as e:
+            print(f"边下载边合并时出错: {str(e)}")
+            return False
+        finally:
+            if process and process.poll() is None:
+                process.kill()
+                process.wait()
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _open_fifo_for_write(self, fifo: str, process: 'subprocess.Popen') -> int:
+        """以非阻塞方式等待ffmpeg打开管道的读端，ffmpeg提前退出时不会永久阻塞"""
+        while True:
             try:
-                subprocess.run(['ffmpeg', '-version'], capture_output=True, check=True)
-            except (subprocess.CalledProcessError, FileNotFoundError):
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+                os.set_blocking(fd, True)
+                return fd
+            except OSError as e:
+                if e.errno != errno.ENXIO:
+                    raise
+                if process.poll() is not None:
+                    raise Exception("ffmpeg已退出")
+                time.sleep(0.05)
+
+    def _stream_to_pipe(self, mirrors: List[str], fifo: str, file_type: str, process: 'subprocess.Popen',
+                        item: Optional[str] = None) -> bool:
+        """将一个流按顺序写入命名管道；连接出错时从已写入位置用Range请求在下一个镜像继续，item 为事件中的名称"""
+        position = 0
+        total_size = 0
+        limiter = self._new_download_limiter()
+        tracker = None
+        try:
+            fd = self._open_fifo_for_write(fifo, process)
+        except Exception as e:
+            print(f"\n{file_type}管道打开失败: {str(e)}")
+            return False
+        
+        try:
+            with os.fdopen(fd, 'wb') as pipe:
+                for attempt in range(MIRROR_MAX_SWITCHES + 1):
+                    url = mirrors[attempt % len(mirrors)]
+                    headers = {'Range': f'bytes={position}-'} if position else {}
+                    try:
+                        response = self.session.get(url, headers=headers, stream=True)
+                        try:
+                            response.raise_for_status()
+                            if position and response.status_code != 206:
+                                raise Exception(f"服务器不支持Range请求 (HTTP {response.status_code})")
+                            if not total_size:
+                                total_size = position + int(response.headers.get('content-length', 0))
+                            if tracker is None:
+                                tracker = TransferTracker(self.events, item or fifo, file_type, total_size)
+                            for block in iter_response_blocks(response, self._write_buffer(),
+                                                              on_read=lambda n: self._throttle(limiter, n)):
+                                pipe.write(block)
+                                position += len(block)
+                                tracker.update(len(block))
+                        finally:
+                            response.close()
+                        if total_size and position < total_size:
+                            raise Exception(f"数据不完整: {position}/{total_size} 字节")
+                        tracker.finish(True)
+                        print(f"\n{file_type}流传输完成")
+                        return True
+                    except (BrokenPipeError, OSError) as e:
+                        if isinstance(e, BrokenPipeError) or getattr(e, 'errno', None) == errno.EPIPE:
+                            raise Exception("ffmpeg已停止读取")
+                        print(f"\n{file_type}连接出错 ({str(e)})，尝试其他CDN节点")
+                    except Exception as e:
+                        if process.poll() is not None:
+                            raise
+                        print(f"\n{file_type}连接出错 ({str(e)})，尝试其他CDN节点")
+                raise Exception("所有CDN节点均失败")
+        except Exception as e:
+            if tracker:
+                tracker.finish(False, str(e))
+            print(f"\n{file_type}下载失败: {str(e)}")
+            return False
+
+    def merge_video_audio(self, video_file: str, audio_file: str, output_file: str) -> bool:
+        """合并视频和音频文件，发送合并阶段的开始/结束事件"""
+        start_time = self.events.stage_start('merge', output_file, engine=self.merge_engine)
+        success = False
+        try:
+            success = self._merge_video_audio(video_file, audio_file, output_file)
+            return success
+        finally:
+            self.events.stage_end('merge', output_file, start_time, success, engine=self.merge_engine)
+
+    def _merge_video_audio(self, video_file: str, audio_file: str, output_file: str) -> bool:
+        """按合并方式合并视频和音频文件"""
+        if self.merge_engine in ('auto', 'python'):
+            if self._remux_video_audio(video_file, audio_file, output_file):
+                return True
+            if self.merge_engine == 'python':
+                print(f"视频文件: {video_file}")
+                print(f"音频文件: {audio_file}")
+                return False
+            print("内置合并不可用，改用ffmpeg合并")
+
+        import subprocess
+        try:
+            # 检查ffmpeg是否可用（每个进程只检测一次）
+            ffmpeg = find_ffmpeg()
+            if not ffmpeg:
                 print("未找到ffmpeg，无法自动合并视频和音频")
                 print(f"视频文件: {video_file}")
                 print(f"音频文件: {audio_file}")
@@ -401,7 +2141,7 @@ class BilibiliVideoDownloader:
             
             # 使用ffmpeg合并视频和音频
             cmd = [
-                'ffmpeg', '-i', video_file, '-i', audio_file,
+                ffmpeg['path'], '-i', video_file, '-i', audio_file,
                 '-c', 'copy',  # 直接复制流，不重新编码
                 '-y',  # 覆盖输出文件
                 output_file
@@ -412,13 +2152,7 @@ class BilibiliVideoDownloader:
             
             if result.returncode == 0:
                 print(f"合并完成: {output_file}")
-                # 删除临时文件
-                try:
-                    os.remove(video_file)
-                    os.remove(audio_file)
-                    print("临时文件已删除")
-                except:
-                    print("临时文件删除失败")
+                self._remove_merge_temps(video_file, audio_file)
                 return True
             else:
                 print(f"合并失败: {result.stderr}")
@@ -428,8 +2162,55 @@ class BilibiliVideoDownloader:
             print(f"合并过程中出错: {str(e)}")
             return False
 
-    def download_video_by_bvid(self, input_str: str, quality: Optional[int] = None, download_type: Optional[str] = None) -> bool:
-        """主下载函数"""
+    def submit_merge(self, video_file: str, audio_file: str, output_file: str, callback=None) -> Future:
+        """提交合并任务到后台合并线程池，返回结果为bool的Future；callback(output_file, success) 在合并结束后调用"""
+        with self._merge_executor_lock:
+            if self._merge_executor is None:
+                self._merge_executor = ThreadPoolExecutor(max_workers=max(1, self.merge_workers),
+                                                          thread_name_prefix='merge')
+            future = self._merge_executor.submit(self.merge_video_audio, video_file, audio_file, output_file)
+        if callback:
+            def notify(done: Future):
+                try:
+                    success = done.result()
+                except Exception as e:
+                    print(f"合并过程中出错: {str(e)}")
+                    success = False
+                callback(output_file, success)
+            future.add_done_callback(notify)
+        return future
+
+    def _remux_video_audio(self, video_file: str, audio_file: str, output_file: str) -> bool:
+        """使用内置的DASH remux合并，输入不是分片MP4时返回False"""
+        part_file = output_file + '.part'
+        try:
+            print("正在合并视频和音频(内置remux)...")
+            remux_dash(video_file, audio_file, part_file)
+            os.replace(part_file, output_file)
+        except (RemuxError, OSError) as e:
+            print(f"内置合并失败: {str(e)}")
+            if os.path.exists(part_file):
+                os.remove(part_file)
+            return False
+        print(f"合并完成: {output_file}")
+        self._remove_merge_temps(video_file, audio_file)
+        return True
+
+    def _remove_merge_temps(self, video_file: str, audio_file: str):
+        """删除合并前的临时文件"""
+        try:
+            os.remove(video_file)
+            os.remove(audio_file)
+            print("临时文件已删除")
+        except OSError:
+            print("临时文件删除失败")
+
+    def download_video_by_bvid(self, input_str: str, quality: Optional[int] = None, download_type: Optional[str] = None,
+                               pages: Optional[str] = None, merge_futures: Optional[List[Future]] = None) -> bool:
+        """主下载函数，pages 为分P选择（如 "all"、"1-5"、"1,3"），默认使用URL中的 p 参数或P1
+
+        提供 merge_futures 列表时不等待合并完成，合并任务的Future追加到该列表中，返回值只表示下载结果
+        """
         try:
             # 提取BV号
             bvid = self.extract_bvid(input_str)
@@ -439,15 +2220,36 @@ class BilibiliVideoDownloader:
             
             print(f"正在处理视频: {bvid}")
             
+            # 在任何网络请求之前查询下载记录
+            item_key = None
+            if self.archive is not None and quality and download_type:
+                item_key = DownloadArchive.item_key(bvid, pages if pages is not None else extract_page(input_str),
+                                                    quality, download_type)
+                if item_key in self.archive:
+                    print(f"已在下载记录中，跳过: {bvid}")
+                    return True
+            
             # 获取视频信息
             video_info = self.get_video_info(bvid)
             title = video_info['title']
-            cid = video_info['cid']
             cover_url = video_info['pic']  # 封面图片URL
+            page_list = video_info.get('pages') or [
+                {'page': 1, 'cid': video_info['cid'], 'part': title}
+            ]
             
             print(f"视频标题: {title}")
-            print(f"视频CID: {cid}")
+            print(f"视频CID: {video_info['cid']}")
             print(f"封面URL: {cover_url}")
+            if len(page_list) > 1:
+                print(f"分P数量: {len(page_list)}")
+            
+            # 选择分P（命令行参数优先，其次是URL中的 p 参数）
+            interactive = not download_type
+            if pages is None:
+                pages = extract_page(input_str)
+            if pages is None and interactive and len(page_list) > 1:
+                pages = self.choose_pages(page_list)
+            selected_pages = [page_list[p - 1] for p in parse_page_selection(pages, len(page_list))]
             
             # 选择下载类型
             if not download_type:
@@ -455,46 +2257,145 @@ class BilibiliVideoDownloader:
             
             # 清理文件名
             safe_title = re.sub(r'[\\/*?:"<>|]', "", title)
+            cover_filename = f"{safe_title}_{bvid}_cover.jpg"
             
             # 仅下载封面图片
             if download_type == '4':
-                cover_filename = f"{safe_title}_{bvid}_cover.jpg"
-                return self.download_cover(cover_url, cover_filename)
+                success = self.download_cover(cover_url, cover_filename)
+                if success and item_key:
+                    self.archive.add(item_key)
+                return success
             
-            # 获取播放信息
-            play_info = self.get_video_play_url(bvid, cid)
+            # 仅下载字幕：不需要播放地址，各分P同时进行
+            if download_type == '6':
+                futures = [self._submit_extra(self.download_subtitles, bvid, page['cid'], base_name)
+                           for page, base_name in self._page_jobs(bvid, safe_title, page_list, selected_pages)]
+                success = all([future.result() for future in futures])
+                if success and item_key:
+                    self.archive.add(item_key)
+                return success
             
-            # 选择清晰度
+            # 选择清晰度（播放信息一次返回所有清晰度，交互选择后直接复用）
+            first_play_info = None
             if not quality:
-                accept_quality = play_info.get('accept_quality', [])
+                first_play_info = self.get_video_play_url(bvid, selected_pages[0]['cid'], MAX_QUALITY)
+                accept_quality = first_play_info.get('accept_quality', [])
                 quality = self.choose_quality(accept_quality)
             
-            # 重新获取指定清晰度的播放信息
-            play_info = self.get_video_play_url(bvid, cid, quality)
+            jobs = self._page_jobs(bvid, safe_title, page_list, selected_pages)
+            item_merges = []
+            
+            def run_page(i: int, page: Dict[str, Any], base_name: str) -> bool:
+                # 已完成的分P跳过；合并在后台进行时，合并成功后才写入下载记录
+                page_key = DownloadArchive.page_key(bvid, page['cid'], quality, download_type)
+                if self.archive is not None and page_key in self.archive:
+                    print(f"P{page['page']} 已在下载记录中，跳过")
+                    return True
+                page_merges = [] if merge_futures is not None else None
+                success = self._download_page(bvid, page['cid'], quality, download_type, base_name,
+                                              cover_url if i == 0 else None, cover_filename,
+                                              first_play_info if i == 0 else None, page_merges)
+                if page_merges:
+                    merge_futures.extend(page_merges)
+                    item_merges.extend(page_merges)
+                if success and self.archive is not None:
+                    self.archive.add_when_done(page_key, page_merges or [])
+                return success
+            
+            # 封面每个视频只下载一次，随第一个分P一起下载
+            if len(jobs) == 1:
+                page, base_name = jobs[0]
+                success = run_page(0, page, base_name)
+            else:
+                print(f"开始并行下载 {len(jobs)} 个分P...")
+                with ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+                    futures = [executor.submit(run_page, i, page, base_name)
+                               for i, (page, base_name) in enumerate(jobs)]
+                    results = [future.result() for future in futures]
+                
+                failed = [page['page'] for (page, _), ok in zip(jobs, results) if not ok]
+                success = not failed
+                if failed:
+                    print(f"以下分P下载失败: {', '.join('P%d' % p for p in failed)}")
+                else:
+                    print(f"全部 {len(jobs)} 个分P下载完成")
             
-            # 获取视频和音频URL（优先使用dash格式）
+            if success and item_key:
+                self.archive.add_when_done(item_key, item_merges)
+            return success
+            
+        except Exception as e:
+            print(f"下载过程中出错: {str(e)}")
+            return False
+
+    def _page_jobs(self, bvid: str, safe_title: str, page_list: list, selected_pages: list) -> List[tuple]:
+        """生成 (分P, 文件名前缀) 列表，见 page_jobs"""
+        return page_jobs(bvid, safe_title, page_list, selected_pages)
+
+    def _download_page(self, bvid: str, cid: int, quality: int, download_type: str, base_name: str,
+                       cover_url: Optional[str] = None, cover_filename: Optional[str] = None,
+                       play_info: Optional[Dict[str, Any]] = None,
+                       merge_futures: Optional[List[Future]] = None,
+                       merge_jobs: Optional[List[tuple]] = None) -> bool:
+        """下载单个分P的视频流/音频流，以及与之同时进行的弹幕、字幕"""
+        try:
+            # 一次请求获取所有清晰度的DASH流，在本地选择清晰度
+            if play_info is None:
+                play_info = self.get_video_play_url(bvid, cid, MAX_QUALITY, quality)
+        except Exception as e:
+            print(f"下载过程中出错: {str(e)}")
+            return False
+        
+        extras = []
+        if self.danmaku:
+            duration = (play_info.get('timelength') or 0) / 1000
+            extras.append(self._submit_extra(self.download_danmaku, cid, f"{base_name}.ass", duration))
+        if self.subtitles:
+            extras.append(self._submit_extra(self.download_subtitles, bvid, cid, base_name))
+        try:
+            return self._download_page_streams(bvid, cid, quality, download_type, base_name, cover_url,
+                                               cover_filename, play_info, merge_futures, merge_jobs)
+        finally:
+            # 弹幕/字幕失败时已打印原因，不影响视频和音频的结果
+            for future in extras:
+                future.result()
+
+    def _download_page_streams(self, bvid: str, cid: int, quality: int, download_type: str, base_name: str,
+                               cover_url: Optional[str], cover_filename: Optional[str],
+                               play_info: Dict[str, Any],
+                               merge_futures: Optional[List[Future]] = None,
+                               merge_jobs: Optional[List[tuple]] = None) -> bool:
+        """按下载类型下载单个分P的视频流/音频流"""
+        try:
+            # 获取视频和音频URL（优先使用dash格式），备用地址用于CDN镜像选择
             video_url = None
             audio_url = None
+            video_backups = []
+            audio_backups = []
             
-            if 'dash' in play_info:
+            if play_info.get('dash'):
                 # 使用dash视频流
-                video_streams = play_info['dash']['video']
-                audio_streams = play_info['dash']['audio']
+                video_stream = select_video_stream(play_info['dash'].get('video') or [], quality)
+                audio_stream = select_audio_stream(play_info['dash'].get('audio') or [])
                 
-                if video_streams:
-                    # 选择第一个视频流（通常是最高质量的）
-                    video_url = video_streams[0]['baseUrl']
-                    print(f"视频流URL获取成功")
+                if video_stream:
+                    video_url = video_stream['baseUrl']
+                    video_backups = video_stream.get('backupUrl') or video_stream.get('backup_url') or []
+                    print(f"视频流URL获取成功 (清晰度: {video_stream['id']})")
                     
-                if audio_streams:
-                    # 选择第一个音频流
-                    audio_url = audio_streams[0]['baseUrl']
-                    print(f"音频流URL获取成功")
+                if audio_stream:
+                    audio_url = audio_stream['baseUrl']
+                    audio_backups = audio_stream.get('backupUrl') or audio_stream.get('backup_url') or []
+                    print("音频流URL获取成功")
             else:
+                # 普通格式只包含请求的单一清晰度，清晰度不符时需按指定清晰度重新获取
+                if play_info.get('quality') != quality:
+                    play_info = self.get_video_play_url(bvid, cid, quality)
                 # 回退到普通格式（仅视频，包含音频）
                 durl = play_info['durl']
                 if durl:
                     video_url = durl[0]['url']
+                    video_backups = durl[0].get('backup_url') or []
                     print("注意: 此视频格式不支持单独下载音频")
             
             # 根据下载类型执行下载
@@ -503,111 +2404,603 @@ class BilibiliVideoDownloader:
                     print("无法获取视频URL")
                     return False
                 
-                filename = f"{safe_title}_{bvid}_video.mp4"
+                filename = f"{base_name}_video.mp4"
                 print(f"开始下载视频: {filename}")
-                return self.download_file(video_url, filename, "视频")
+                return self.download_file(video_url, filename, "视频", backup_urls=video_backups)
                 
             elif download_type == '2':  # 仅音频
                 if not audio_url:
                     print("无法获取音频URL")
                     return False
                 
-                filename = f"{safe_title}_{bvid}_audio.m4a"
+                filename = f"{base_name}_audio.m4a"
                 print(f"开始下载音频: {filename}")
-                return self.download_file(audio_url, filename, "音频")
+                return self.download_file(audio_url, filename, "音频", backup_urls=audio_backups)
                 
-            elif download_type == '3':  # 视频+音频
+            elif download_type in ('3', '5'):  # 视频+音频(+封面)
+                cover = cover_url if download_type == '5' else None
+                return self._download_streams_and_merge(video_url, audio_url, base_name, cover, cover_filename,
+                                                        video_backups, audio_backups, merge_futures, merge_jobs)
+            
+            print(f"未知的下载类型: {download_type}")
+            return False
+            
+        except Exception as e:
+            print(f"下载过程中出错: {str(e)}")
+            return False
+
+    def _download_streams_and_merge(self, video_url: Optional[str], audio_url: Optional[str], base_name: str,
+                                    cover_url: Optional[str] = None, cover_filename: Optional[str] = None,
+                                    video_backups: Optional[List[str]] = None,
+                                    audio_backups: Optional[List[str]] = None,
+                                    merge_futures: Optional[List[Future]] = None,
+                                    merge_jobs: Optional[List[tuple]] = None) -> bool:
+        """并发下载视频流、音频流和封面，视频和音频都完成后提交到后台合并线程池
+
+        提供 merge_jobs 列表时不合并，(视频文件, 音频文件, 输出文件) 追加到该列表中由调用方合并
+        """
+        # 视频、音频、封面来自不同的CDN对象，最多3个任务同时进行
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            cover_future = None
+            if cover_url:
+                cover_future = executor.submit(self.download_cover, cover_url,
+                                               cover_filename or f"{base_name}_cover.jpg")
+            
+            try:
                 if not video_url:
                     print("无法获取视频URL")
                     return False
                 if not audio_url:
                     print("无法获取音频URL，将只下载视频")
-                    filename = f"{safe_title}_{bvid}.mp4"
-                    return self.download_file(video_url, filename, "视频")
+                    return self.download_file(video_url, f"{base_name}.mp4", "视频", backup_urls=video_backups)
                 
-                # 下载视频和音频
-                video_filename = f"{safe_title}_{bvid}_video_temp.mp4"
-                audio_filename = f"{safe_title}_{bvid}_audio_temp.m4a"
-                output_filename = f"{safe_title}_{bvid}.mp4"
+                video_filename = f"{base_name}_video_temp.mp4"
+                audio_filename = f"{base_name}_audio_temp.m4a"
+                output_filename = f"{base_name}.mp4"
                 
-                print("开始下载视频部分...")
-                video_success = self.download_file(video_url, video_filename, "视频")
+                if self.stream_merge and merge_jobs is None:
+                    if hasattr(os, 'mkfifo') and self._ffmpeg_available():
+                        return self.download_and_merge_streaming(video_url, audio_url, output_filename,
+                                                                 video_backups, audio_backups)
+                    print("当前环境不支持边下载边合并（需要ffmpeg和命名管道），改用临时文件合并")
                 
-                print("开始下载音频部分...")
-                audio_success = self.download_file(audio_url, audio_filename, "音频")
+                print("开始同时下载视频和音频部分...")
+                video_future = executor.submit(self.download_file, video_url, video_filename, "视频",
+                                               backup_urls=video_backups)
+                audio_future = executor.submit(self.download_file, audio_url, audio_filename, "音频",
+                                               backup_urls=audio_backups)
+                video_success = video_future.result()
+                audio_success = audio_future.result()
                 
                 if video_success and audio_success:
+                    # 封面可能仍在下载，不等待封面直接开始合并
+                    if merge_jobs is not None:
+                        merge_jobs.append((video_filename, audio_filename, output_filename))
+                        return True
                     print("开始合并视频和音频...")
-                    return self.merge_video_audio(video_filename, audio_filename, output_filename)
+                    merge_future = self.submit_merge(video_filename, audio_filename, output_filename)
+                    if merge_futures is not None:
+                        # 批量模式下不等待合并，下载线程继续处理下一项
+                        merge_futures.append(merge_future)
+                        return True
+                    return merge_future.result()
                 else:
                     print("视频或音频下载失败，无法合并")
                     return False
+            finally:
+                if cover_future and not cover_future.result():
+                    print("封面下载失败，视频和音频不受影响")
+
+    def _get_wbi_keys(self):
+        """从 nav 接口获取WBI签名密钥（未登录时也会返回），缓存一段时间"""
+        cached = self._wbi_keys
+        if cached and time.time() - cached[2] < WBI_KEYS_TTL:
+            return cached[0], cached[1]
+        response = self.session.get(f"{self.api_base}/x/web-interface/nav")
+        wbi_img = response.json()['data']['wbi_img']
+        img_key = wbi_img['img_url'].rsplit('/', 1)[-1].split('.')[0]
+        sub_key = wbi_img['sub_url'].rsplit('/', 1)[-1].split('.')[0]
+        self._wbi_keys = (img_key, sub_key, time.time())
+        return img_key, sub_key
+
+    def _fetch_collection_page(self, collection: Dict[str, Any], page: int):
+        """获取列表的一页，返回 (BV号列表, 总页数)"""
+        kind = collection['kind']
+        if kind == 'space':
+            url = f"{self.api_base}/x/space/wbi/arc/search"
+            page_size = 50
+            params = wbi_sign({'mid': collection['mid'], 'pn': page, 'ps': page_size, 'order': 'pubdate'},
+                              *self._get_wbi_keys())
+        elif kind == 'favlist':
+            url = f"{self.api_base}/x/v3/fav/resource/list"
+            page_size = 20
+            params = {'media_id': collection['id'], 'pn': page, 'ps': page_size, 'platform': 'web'}
+        elif kind == 'season':
+            url = f"{self.api_base}/x/polymer/web-space/seasons_archives_list"
+            page_size = 100
+            params = {'mid': collection['mid'], 'season_id': collection['id'],
+                      'page_num': page, 'page_size': page_size}
+        else:
+            url = f"{self.api_base}/x/series/archives"
+            page_size = 100
+            params = {'mid': collection['mid'], 'series_id': collection['id'], 'pn': page, 'ps': page_size}
+        
+        response = self.session.get(url, params=params)
+        response.raise_for_status()
+        data = response.json()
+        if data['code'] != 0:
+            raise Exception(f"获取列表失败: {data.get('message')}")
+        data = data['data'] or {}
+        
+        if kind == 'space':
+            items = (data.get('list') or {}).get('vlist') or []
+            total = data['page']['count']
+        elif kind == 'favlist':
+            # 收藏夹中可能有音频等其他类型的内容，只保留视频
+            items = [m for m in data.get('medias') or [] if m.get('type') == 2]
+            total = data['info']['media_count']
+        elif kind == 'season':
+            items = data.get('archives') or []
+            total = data['page']['total']
+        else:
+            items = data.get('archives') or []
+            total = data['page']['total']
+        pages = max(1, -(-total // page_size))
+        return [item['bvid'] for item in items if item.get('bvid')], pages
+
+    def iter_collection(self, collection: Dict[str, Any]) -> Iterator[str]:
+        """按顺序逐个产出列表中的BV号；第一页之后同时请求多页，只在消费者取用时继续请求，不会一次性枚举全部"""
+        names = {'space': "UP主投稿", 'favlist': "收藏夹", 'season': "合集", 'series': "系列"}
+        name = names[collection['kind']]
+        try:
+            bvids, page_count = self._fetch_collection_page(collection, 1)
+        except Exception as e:
+            print(f"枚举{name}失败: {str(e)}")
+            return
+        print(f"开始枚举{name}，共 {page_count} 页")
+        yield from bvids
+        
+        with ThreadPoolExecutor(max_workers=COLLECTION_PAGE_WORKERS) as executor:
+            pending = {}
+            next_page = 2
+            for page in range(2, page_count + 1):
+                # 保持最多 COLLECTION_PAGE_WORKERS 页在请求中，按页码顺序产出
+                while next_page <= page_count and len(pending) < COLLECTION_PAGE_WORKERS:
+                    pending[next_page] = executor.submit(self._fetch_collection_page, collection, next_page)
+                    next_page += 1
+                try:
+                    bvids, _ = pending.pop(page).result()
+                except Exception as e:
+                    print(f"枚举{name}第 {page} 页失败，停止枚举: {str(e)}")
+                    for future in pending.values():
+                        future.cancel()
+                    return
+                yield from bvids
+
+    def expand_inputs(self, inputs: Iterable[str]) -> Iterator[str]:
+        """将输入中的UP主空间、收藏夹、合集、系列URL展开为BV号，其他输入原样产出（按需展开）"""
+        for input_str in inputs:
+            collection = parse_collection_url(input_str)
+            if collection:
+                yield from self.iter_collection(collection)
+            else:
+                yield input_str
+
+    def download_many(self, inputs: Iterable[str], quality: int = 80, download_type: str = '3',
+                      workers: int = 4, pages: Optional[str] = None) -> List[Dict[str, Any]]:
+        """非交互批量下载，按需消费输入并交给工作线程池，返回每项的下载结果
+
+        合并在后台合并线程池中进行，工作线程下载完一项后立即开始下一项的下载；
+        输入中的空间/收藏夹/合集/系列URL按需展开为BV号
+        """
+        inputs = self.expand_inputs(inputs)
+        results = []
+        pending = {}
+        workers = max(1, workers)
+        
+        def run_item(index: int, input_str: str):
+            start_time = time.time()
+            merge_futures = []
+            try:
+                success = self.download_video_by_bvid(input_str, quality, download_type, pages, merge_futures)
+                error = None if success else "下载失败"
+            except Exception as e:
+                success = False
+                error = str(e)
+            return start_time, success, error, merge_futures
+        
+        def track_item(index: int, input_str: str, download_future: Future) -> Future:
+            """返回在下载和全部合并都结束后完成的Future"""
+            item_future = Future()
             
-            elif download_type == '5':  # 视频+音频+封面
-                # 首先下载封面
-                cover_filename = f"{safe_title}_{bvid}_cover.jpg"
-                cover_success = self.download_cover(cover_url, cover_filename)
-                
-                if not cover_success:
-                    print("封面下载失败，继续下载视频和音频")
-                
-                # 然后下载视频和音频
-                if not video_url:
-                    print("无法获取视频URL")
-                    return False
-                if not audio_url:
-                    print("无法获取音频URL，将只下载视频")
-                    filename = f"{safe_title}_{bvid}.mp4"
-                    return self.download_file(video_url, filename, "视频")
+            def finish(start_time: float, success: bool, error: Optional[str]):
+                item_future.set_result({
+                    'index': index,
+                    'input': input_str,
+                    'success': success,
+                    'error': error,
+                    'elapsed': time.time() - start_time,
+                })
+            
+            def on_downloaded(done: Future):
+                start_time, success, error, merge_futures = done.result()
+                if not merge_futures:
+                    finish(start_time, success, error)
+                    return
+                remaining = [len(merge_futures)]
+                lock = threading.Lock()
                 
-                # 下载视频和音频
-                video_filename = f"{safe_title}_{bvid}_video_temp.mp4"
-                audio_filename = f"{safe_title}_{bvid}_audio_temp.m4a"
-                output_filename = f"{safe_title}_{bvid}.mp4"
+                def on_merged(_):
+                    with lock:
+                        remaining[0] -= 1
+                        if remaining[0]:
+                            return
+                    merged = all(not f.exception() and f.result() for f in merge_futures)
+                    finish(start_time, success and merged, error or (None if merged else "合并失败"))
                 
-                print("开始下载视频部分...")
-                video_success = self.download_file(video_url, video_filename, "视频")
+                for merge_future in merge_futures:
+                    merge_future.add_done_callback(on_merged)
+            
+            download_future.add_done_callback(on_downloaded)
+            return item_future
+        
+        def collect(done):
+            for future in done:
+                pending.pop(future)
+                results.append(future.result())
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for index, input_str in enumerate(inputs):
+                # 待处理任务数（包括等待合并的项）受限，输入流（文件或stdin）不会被一次性读入内存
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = track_item(index, input_str, executor.submit(run_item, index, input_str))
+                pending[future] = index
+            collect(wait(pending).done)
+        
+        results.sort(key=lambda r: r['index'])
+        return results
+
+    def _resolve_item(self, input_str: str, quality: int, download_type: str,
+                      pages: Optional[str] = None) -> List[Dict[str, Any]]:
+        """流水线的解析阶段：获取视频信息和各分P的播放地址，返回下载任务列表（非交互），已在下载记录中的分P不返回"""
+        bvid = self.extract_bvid(input_str)
+        if not bvid:
+            raise Exception(f"无效的BV号或URL: {input_str}")
+        
+        video_info = self.get_video_info(bvid)
+        title = video_info['title']
+        cover_url = video_info['pic']
+        page_list = video_info.get('pages') or [
+            {'page': 1, 'cid': video_info['cid'], 'part': title}
+        ]
+        if pages is None:
+            pages = extract_page(input_str)
+        selected_pages = [page_list[p - 1] for p in parse_page_selection(pages, len(page_list))]
+        print(f"解析完成: {bvid} {title}")
+        
+        safe_title = re.sub(r'[\\/*?:"<>|]', "", title)
+        cover_filename = f"{safe_title}_{bvid}_cover.jpg"
+        if download_type == '4':
+            return [{'cover_only': True, 'subtitles_only': False, 'cover_url': cover_url,
+                     'cover_filename': cover_filename, 'archive_key': None}]
+        
+        jobs = []
+        for i, (page, base_name) in enumerate(self._page_jobs(bvid, safe_title, page_list, selected_pages)):
+            page_key = DownloadArchive.page_key(bvid, page['cid'], quality, download_type)
+            if self.archive is not None and page_key in self.archive:
+                print(f"P{page['page']} 已在下载记录中，跳过")
+                continue
+            jobs.append({
+                'cover_only': False,
+                'subtitles_only': download_type == '6',
+                'archive_key': page_key,
+                'bvid': bvid,
+                'cid': page['cid'],
+                'base_name': base_name,
+                # 封面每个视频只下载一次，随第一个分P一起下载
+                'cover_url': cover_url if i == 0 else None,
+                'cover_filename': cover_filename,
+                # 仅下载字幕时不需要播放地址
+                'play_info': (None if download_type == '6'
+                              else self.get_video_play_url(bvid, page['cid'], MAX_QUALITY, quality)),
+            })
+        return jobs
+
+    def download_pipeline(self, inputs: Iterable[str], quality: int = 80, download_type: str = '3',
+                          pages: Optional[str] = None, resolve_workers: int = 4, download_workers: int = 4,
+                          merge_workers: Optional[int] = None, queue_size: int = 16) -> List[Dict[str, Any]]:
+        """流水线批量下载：解析、下载、合并三个阶段由有界队列连接，各阶段使用独立的线程数
+
+        队列满时上一阶段阻塞等待，输入按需读取（空间/收藏夹等URL按需展开），内存占用与输入数量无关。返回结果与 download_many 相同
+        """
+        inputs = self.expand_inputs(inputs)
+        merge_workers = merge_workers or self.merge_workers
+        resolve_queue = queue.Queue(maxsize=queue_size)
+        download_queue = queue.Queue(maxsize=queue_size)
+        merge_queue = queue.Queue(maxsize=queue_size)
+        results = []
+        lock = threading.Lock()
+        
+        def finish_job(item: Dict[str, Any], success: bool, error: Optional[str] = None,
+                       job: Optional[Dict[str, Any]] = None):
+            """一个分P任务结束，所有任务结束时记录该项的结果；成功的分P和项写入下载记录"""
+            if success and self.archive is not None and job and job['archive_key']:
+                self.archive.add(job['archive_key'])
+            with lock:
+                item['remaining'] -= 1
+                if not success:
+                    item['success'] = False
+                    item['error'] = item['error'] or error or "下载失败"
+                if item['remaining'] > 0:
+                    return
+                if item['success'] and item['archive_key']:
+                    self.archive.add(item['archive_key'])
+                results.append({
+                    'index': item['index'],
+                    'input': item['input'],
+                    'success': item['success'],
+                    'error': item['error'],
+                    'elapsed': time.time() - item['start_time'],
+                })
+        
+        def resolve_stage():
+            while True:
+                entry = resolve_queue.get()
+                if entry is None:
+                    return
+                index, input_str = entry
+                item = {'index': index, 'input': input_str, 'start_time': time.time(),
+                        'remaining': 1, 'success': True, 'error': None, 'archive_key': None}
                 
-                print("开始下载音频部分...")
-                audio_success = self.download_file(audio_url, audio_filename, "音频")
+                # 在任何网络请求之前查询下载记录
+                bvid = self.extract_bvid(input_str)
+                if bvid and self.archive is not None:
+                    item['archive_key'] = DownloadArchive.item_key(
+                        bvid, pages if pages is not None else extract_page(input_str), quality, download_type)
+                    if item['archive_key'] in self.archive:
+                        print(f"已在下载记录中，跳过: {bvid}")
+                        item['archive_key'] = None
+                        finish_job(item, True)
+                        continue
                 
-                if video_success and audio_success:
-                    print("开始合并视频和音频...")
-                    return self.merge_video_audio(video_filename, audio_filename, output_filename)
-                else:
-                    print("视频或音频下载失败，无法合并")
-                    return False
-            
-        except Exception as e:
-            print(f"下载过程中出错: {str(e)}")
-            return False
+                try:
+                    jobs = self._resolve_item(input_str, quality, download_type, pages)
+                except Exception as e:
+                    print(f"解析失败: {input_str}: {str(e)}")
+                    finish_job(item, False, str(e))
+                    continue
+                if not jobs:
+                    # 所有分P都已在下载记录中
+                    finish_job(item, True)
+                    continue
+                with lock:
+                    item['remaining'] = len(jobs)
+                for job in jobs:
+                    download_queue.put((item, job))
+        
+        def download_stage():
+            while True:
+                entry = download_queue.get()
+                if entry is None:
+                    return
+                item, job = entry
+                try:
+                    if job['cover_only']:
+                        finish_job(item, self.download_cover(job['cover_url'], job['cover_filename']), job=job)
+                        continue
+                    if job['subtitles_only']:
+                        finish_job(item, self.download_subtitles(job['bvid'], job['cid'], job['base_name']), job=job)
+                        continue
+                    merge_jobs = []
+                    success = self._download_page(job['bvid'], job['cid'], quality, download_type,
+                                                  job['base_name'], job['cover_url'], job['cover_filename'],
+                                                  job['play_info'], merge_jobs=merge_jobs)
+                    if success and merge_jobs:
+                        merge_queue.put((item, job, merge_jobs[0]))
+                    else:
+                        finish_job(item, success, job=job)
+                except Exception as e:
+                    print(f"下载过程中出错: {str(e)}")
+                    finish_job(item, False, str(e))
+        
+        def merge_stage():
+            while True:
+                entry = merge_queue.get()
+                if entry is None:
+                    return
+                item, job, (video_file, audio_file, output_file) = entry
+                try:
+                    success = self.merge_video_audio(video_file, audio_file, output_file)
+                    finish_job(item, success, None if success else "合并失败", job)
+                except Exception as e:
+                    print(f"合并过程中出错: {str(e)}")
+                    finish_job(item, False, str(e))
+        
+        def start(target, count: int) -> List[threading.Thread]:
+            threads = [threading.Thread(target=target, daemon=True) for _ in range(max(1, count))]
+            for thread in threads:
+                thread.start()
+            return threads
+        
+        stages = [
+            (start(resolve_stage, resolve_workers), resolve_queue),
+            (start(download_stage, download_workers), download_queue),
+            (start(merge_stage, merge_workers), merge_queue),
+        ]
+        for index, input_str in enumerate(inputs):
+            resolve_queue.put((index, input_str))
+        
+        # 按阶段顺序结束：上一阶段的线程全部退出后，下一阶段的队列不会再有新任务
+        for threads, stage_queue in stages:
+            for _ in threads:
+                stage_queue.put(None)
+            for thread in threads:
+                thread.join()
+        
+        results.sort(key=lambda r: r['index'])
+        return results
+
+    def set_progress_callback(self, callback, max_rate: float = 10):
+        """设置进度回调函数 callback(文件名, 已下载大小, 总大小)，基于下载事件实现"""
+        def on_event(event: Dict[str, Any]):
+            if event['type'] == 'progress':
+                callback(event['item'], event['downloaded'], event['total'])
+        
+        if self._progress_callback_listener:
+            self.events.remove_listener(self._progress_callback_listener)
+        self._progress_callback_listener = self.events.add_listener(on_event, max_rate) if callback else None
+
+
+def iter_input_file(path: str) -> Iterator[str]:
+    """逐行读取BV号/URL列表文件（'-' 表示标准输入），忽略空行和 # 注释"""
+    f = sys.stdin if path == '-' else open(path, 'r', encoding='utf-8')
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def iter_batch_inputs(inputs: List[str], input_file: Optional[str]) -> Iterator[str]:
+    """合并命令行参数与输入文件中的下载项"""
+    for input_str in inputs:
+        yield input_str
+    if input_file:
+        yield from iter_input_file(input_file)
+
+
+def print_batch_summary(results: List[Dict[str, Any]]):
+    """打印批量下载的逐项结果汇总"""
+    print("\n" + "=" * 50)
+    print("批量下载结果:")
+    for result in results:
+        mark = "✓" if result['success'] else "✗"
+        line = f"{mark} {result['input']} ({result['elapsed']:.1f}s)"
+        if result['error']:
+            line += f" - {result['error']}"
+        print(line)
+    failed = sum(1 for r in results if not r['success'])
+    print(f"共 {len(results)} 项，成功 {len(results) - failed} 项，失败 {failed} 项")
+
+
+def format_rate(rate: Optional[float]) -> str:
+    """格式化限速值"""
+    return f"{rate / (1024 * 1024):.2f} MB/s" if rate else "不限速"
 
-    def set_progress_callback(self, callback):
-        """设置进度回调函数"""
-        self.progress_callback = callback
-
-    def _download_with_progress(self, url, filename):
-        """带进度显示的下载方法"""
-        if self.progress_callback:
-            # 使用支持进度的下载方式
-            response = requests.get(url, stream=True, headers=self.headers)
-            total_size = int(response.headers.get('content-length', 0))
-
-            downloaded = 0
-            with open(filename, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        self.progress_callback(filename, downloaded, total_size)
-            return True
-        else:
-            # 使用原来的下载方式
-            return self._download_file(url, filename)
+
+def set_rate_limit_interactive(downloader: BilibiliVideoDownloader):
+    """交互式修改全局限速和单个下载的限速"""
+    print(f"当前全局限速: {format_rate(downloader.bandwidth_limiter.rate)}")
+    print(f"当前单个下载限速: {format_rate(downloader.per_download_rate)}")
+    try:
+        rate = input("全局限速 (如 500K、2M，0为不限速，直接回车保持不变): ").strip()
+        per_download = input("单个下载限速 (直接回车保持不变): ").strip()
+        downloader.set_rate_limit(
+            parse_rate(rate) if rate else downloader.bandwidth_limiter.rate,
+            parse_rate(per_download) if per_download else downloader.per_download_rate,
+        )
+    except ValueError as e:
+        print(str(e))
+        return
+    print(f"全局限速: {format_rate(downloader.bandwidth_limiter.rate)}，"
+          f"单个下载限速: {format_rate(downloader.per_download_rate)}")
 
 
 def main():
-    downloader = BilibiliVideoDownloader()
+    parser = argparse.ArgumentParser(description="B站视频下载器 (支持Cookie保存)")
+    parser.add_argument("inputs", nargs="*", help="BV号或视频URL（也可以是UP主空间、收藏夹、合集、系列的URL），提供时以非交互批量模式运行")
+    parser.add_argument("-f", "--input-file", help="从文件读取BV号/URL列表，每行一个，'-' 表示标准输入")
+    parser.add_argument("-q", "--quality", type=int, default=80, help="批量模式的清晰度编号 (默认: 80)")
+    parser.add_argument("-t", "--type", dest="download_type", choices=['1', '2', '3', '4', '5', '6'], default='3',
+                        help="批量模式的下载类型，6 为仅字幕 (默认: 3，视频+音频)")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="批量模式同时下载的视频数 (默认: 4)")
+    parser.add_argument("-p", "--pages", help="多P视频的分P选择，如 all、1-5、1,3,5 (默认: URL中的p参数或P1)")
+    parser.add_argument("-o", "--output-dir", help="下载目录 (默认: 当前目录)")
+    parser.add_argument("-c", "--connections", type=int, default=1,
+                        help="每个文件的分段下载连接数 (默认: 1，即单连接下载)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="批量模式使用解析/下载/合并三阶段流水线，-w 为下载阶段的线程数")
+    parser.add_argument("--resolve-workers", type=int, default=4,
+                        help="流水线模式中同时解析视频信息的线程数 (默认: 4)")
+    parser.add_argument("--limit-rate", type=parse_rate, default=None,
+                        help="所有下载合计的限速，如 500K、2M (默认: 不限速)")
+    parser.add_argument("--limit-rate-per-download", type=parse_rate, default=None,
+                        help="单个文件的限速，如 1M (默认: 不限速)")
+    parser.add_argument("--fsync", choices=FSYNC_POLICIES, default='none',
+                        help="写入同步策略: none 由系统决定、end 下载完成时同步、always 每次写入后同步 (默认: none)")
+    parser.add_argument("--archive", help="下载记录文件，已记录的项跳过，完成的项追加到文件中")
+    parser.add_argument("--danmaku", action="store_true", help="同时下载弹幕并转换为ASS字幕")
+    parser.add_argument("--danmaku-source", choices=DANMAKU_SOURCES, default='protobuf',
+                        help="弹幕来源: protobuf 分段接口、xml 完整弹幕文件 (默认: protobuf)")
+    parser.add_argument("--subtitles", action="store_true", help="同时下载所有字幕轨道 (CC/AI字幕)")
+    parser.add_argument("--subtitle-format", choices=SUBTITLE_FORMATS, default='srt',
+                        help="字幕格式 (默认: srt)")
+    parser.add_argument("--cover-size", type=parse_cover_size,
+                        help="封面尺寸，如 640x360、640x（由图片CDN缩放，减少下载量；默认: 原图）")
+    parser.add_argument("--cover-format", choices=COVER_FORMATS, help="封面格式 (默认: 原图格式)")
+    parser.add_argument("--cover-thumbnails", type=lambda v: [parse_cover_size(s) for s in v.split(',')],
+                        help="额外生成的缩略图尺寸，逗号分隔，如 320x180,160x90（在本地进程池中生成）")
+    parser.add_argument("--no-cache", action="store_true", help="不使用视频信息/播放地址缓存")
+    parser.add_argument("--stream-merge", action="store_true",
+                        help="边下载边通过命名管道送入ffmpeg合并，不写入临时文件 (仅限支持命名管道的系统)")
+    parser.add_argument("--merge-workers", type=int, default=os.cpu_count() or 1,
+                        help="后台同时进行的合并数，合并与下一项的下载同时进行 (默认: CPU核心数)")
+    parser.add_argument("--merge-engine", choices=['auto', 'ffmpeg', 'python'], default='auto',
+                        help="音视频合并方式: auto 优先使用内置remux、失败时回退ffmpeg (默认: auto)")
+    parser.add_argument("--api-base",
+                        help="API/登录/弹幕接口的根地址，用于连接本地测试服务器，如 http://127.0.0.1:8000")
+    args = parser.parse_args()
+
+    bases = {}
+    if args.api_base:
+        bases = {'api_base': args.api_base, 'passport_base': args.api_base, 'comment_base': args.api_base}
+    downloader = BilibiliVideoDownloader(connections=args.connections,
+                                         cache_file=None if args.no_cache else "bilibili_cache.db", **bases)
+    downloader.stream_merge = args.stream_merge
+    downloader.merge_engine = args.merge_engine
+    downloader.merge_workers = args.merge_workers
+    downloader.set_rate_limit(args.limit_rate, args.limit_rate_per_download)
+    downloader.fsync_policy = args.fsync
+    downloader.set_archive(args.archive)
+    downloader.danmaku = args.danmaku
+    downloader.danmaku_source = args.danmaku_source
+    downloader.subtitles = args.subtitles
+    downloader.subtitle_format = args.subtitle_format
+    downloader.set_cover_options(args.cover_size, args.cover_format, args.cover_thumbnails)
+
+    if args.output_dir:
+        # 输入文件按需读取，切换目录前先转换为绝对路径
+        if args.input_file and args.input_file != '-':
+            args.input_file = os.path.abspath(args.input_file)
+        os.makedirs(args.output_dir, exist_ok=True)
+        os.chdir(args.output_dir)
+
+    if args.inputs or args.input_file:
+        if args.pipeline:
+            results = downloader.download_pipeline(
+                iter_batch_inputs(args.inputs, args.input_file),
+                quality=args.quality,
+                download_type=args.download_type,
+                pages=args.pages,
+                resolve_workers=args.resolve_workers,
+                download_workers=args.workers,
+                merge_workers=args.merge_workers,
+            )
+        else:
+            results = downloader.download_many(
+                iter_batch_inputs(args.inputs, args.input_file),
+                quality=args.quality,
+                download_type=args.download_type,
+                workers=args.workers,
+                pages=args.pages,
+            )
+        print_batch_summary(results)
+        return 1 if any(not r['success'] for r in results) else 0
 
     print("=" * 50)
     print("B站视频下载器 (支持Cookie保存)")
@@ -654,24 +3047,36 @@ def main():
         print("\n" + "=" * 30)
         print("1: 下载视频")
         print("2: 查看登录状态")
+        print("3: 设置下载限速")
 
         # 根据登录状态显示不同的退出选项
         if downloader.is_logged_in:
-            print("3: 退出登录")
+            print("4: 退出登录")
+            print("5: 退出程序")
+            menu_range = "1-5"
+        else:
             print("4: 退出程序")
             menu_range = "1-4"
-        else:
-            print("3: 退出程序")
-            menu_range = "1-3"
 
         choice = input(f"请选择 ({menu_range}): ").strip()
 
         if choice == '1':
-            input_str = input("请输入BV号或视频URL: ").strip()
+            input_str = input("请输入BV号、视频URL或空间/收藏夹/合集URL: ").strip()
             if not input_str:
                 print("输入为空，请重新输入")
                 continue
 
+            if parse_collection_url(input_str):
+                # 空间/收藏夹/合集/系列：类型和清晰度只选择一次，应用到所有视频
+                download_type = downloader.choose_download_type()
+                quality = 80
+                if download_type in ['1', '3', '5']:
+                    quality = downloader.choose_quality([127, 126, 120, 116, 112, 80, 64, 32, 16])
+                results = downloader.download_many([input_str], quality, download_type, workers=1)
+                print_batch_summary(results)
+                time.sleep(1)
+                continue
+
             # 开始下载
             success = downloader.download_video_by_bvid(input_str)
 
@@ -695,19 +3100,17 @@ def main():
                     downloader.qr_login()
 
         elif choice == '3':
+            set_rate_limit_interactive(downloader)
+
+        elif choice == '4':
             if downloader.is_logged_in:
                 downloader.logout()
             else:
-                # 未登录时选择3是退出程序
+                # 未登录时选择4是退出程序
                 print("感谢使用，再见!")
                 break
 
-        elif choice == '4' and downloader.is_logged_in:
-            print("感谢使用，再见!")
-            break
-
-        elif choice == '3' and not downloader.is_logged_in:
-            # 这行代码已经在上面处理了，这里只是为了完整性
+        elif choice == '5' and downloader.is_logged_in:
             print("感谢使用，再见!")
             break
 
@@ -716,4 +3119,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
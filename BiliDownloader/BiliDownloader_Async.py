@@ -0,0 +1,487 @@
+import asyncio
+import importlib.util
+import os
+import re
+import time
+from datetime import datetime
+from typing import Optional, Dict, Any, List, Iterable
+
+try:
+    import httpx
+except ImportError:  # 异步后端为可选功能，未安装httpx时同步下载器不受影响
+    httpx = None
+
+from BiliDownloader import (BilibiliVideoDownloader, extract_bvid, extract_page, parse_page_selection, page_jobs,
+                            read_cookie_file, write_cookie_file,
+                            cookie_expiry_times, parse_nav_user_info, select_video_stream, select_audio_stream,
+                            find_ffmpeg, DASH_FNVAL_ALL, MAX_QUALITY, API_BASE, PASSPORT_BASE, READ_SIZE,
+                            WRITE_BLOCK_SIZE)
+from BiliDownloader_Remux import remux_dash, RemuxError
+
+
+class AsyncBilibiliVideoDownloader:
+    """基于 asyncio + httpx 的异步下载器，与 BilibiliVideoDownloader 提供相同的操作（协程版本）"""
+
+    def __init__(self, cookies_file: str = "bilibili_cookies.json", max_api_connections: int = 10,
+                 max_cdn_connections: int = 64, api_base: str = API_BASE, passport_base: str = PASSPORT_BASE):
+        if httpx is None:
+            raise ImportError("异步下载器需要安装httpx: pip install 'httpx[http2]'")
+
+        self.headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            'Referer': 'https://www.bilibili.com/',
+        }
+        self.is_logged_in = False
+        self.cookies = None
+        self.cookie_expires = {}  # 各Cookie的过期时间，保存时写回文件
+        self.verified_time = None  # 最近一次nav接口确认登录有效的时间
+        self.cookies_file = os.path.abspath(cookies_file)
+        self.user_info = None
+        self.api_base = api_base.rstrip('/')
+        self.passport_base = passport_base.rstrip('/')
+
+        # API请求集中在 api.bilibili.com，使用HTTP/2在少量连接上多路复用
+        http2 = importlib.util.find_spec('h2') is not None
+        if not http2:
+            print("未安装h2，API请求将使用HTTP/1.1: pip install 'httpx[http2]'")
+        self.api_client = httpx.AsyncClient(
+            http2=http2,
+            headers=self.headers,
+            limits=httpx.Limits(max_connections=max_api_connections,
+                                max_keepalive_connections=max_api_connections),
+            timeout=httpx.Timeout(30.0),
+        )
+        # CDN下载分散在多个主机，每个流占用一个连接
+        self.cdn_client = httpx.AsyncClient(
+            headers=self.headers,
+            limits=httpx.Limits(max_connections=max_cdn_connections,
+                                max_keepalive_connections=max_cdn_connections),
+            timeout=httpx.Timeout(30.0, read=60.0),
+            follow_redirects=True,
+        )
+
+    async def __aenter__(self):
+        await self.load_cookies()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        """关闭所有HTTP连接"""
+        await self.api_client.aclose()
+        await self.cdn_client.aclose()
+
+    async def load_cookies(self) -> bool:
+        """从文件加载保存的Cookie（与同步下载器共用Cookie文件）
+
+        验证结果在 LOGIN_VERIFY_TTL 内时直接沿用，否则请求nav接口验证，网络错误时沿用保存的登录状态
+        """
+        try:
+            cookie_data = read_cookie_file(self.cookies_file)
+            if not cookie_data:
+                return False
+
+            cookies = cookie_data.get('cookies', {})
+            for name, value in cookies.items():
+                self.api_client.cookies.set(name, value)
+            self.user_info = cookie_data.get('user_info', None)
+            self.is_logged_in = True
+            self.cookies = cookies
+            self.cookie_expires = cookie_data.get('cookie_expires') or {}
+            verified_time = cookie_data.get('verified_time')
+            self.verified_time = datetime.fromisoformat(verified_time) if verified_time else None
+            if (self.verified_time and (datetime.now() - self.verified_time).total_seconds()
+                    < BilibiliVideoDownloader.LOGIN_VERIFY_TTL):
+                print(f"✓ 已从 {self.cookies_file} 恢复登录状态")
+                return True
+
+            try:
+                user_info = await self._fetch_nav_user_info()
+            except Exception as e:
+                print(f"无法验证登录状态，暂时沿用保存的登录状态: {str(e)}")
+                return True
+            if user_info:
+                self.user_info = user_info
+                self.verified_time = datetime.now()
+                self._write_cookie_file()
+                print(f"✓ 已从 {self.cookies_file} 恢复登录状态")
+                return True
+            print("Cookie已失效，需要重新登录")
+            self.is_logged_in = False
+            self.cookies = None
+            self.user_info = None
+            return False
+        except Exception as e:
+            print(f"加载Cookie失败: {str(e)}")
+            return False
+
+    def _write_cookie_file(self):
+        """按当前Cookie、各Cookie的过期时间和验证时间写入Cookie文件"""
+        expires = dict(self.cookie_expires, **cookie_expiry_times(self.api_client.cookies.jar))
+        write_cookie_file(self.cookies_file, self.cookies, self.user_info, expires, self.verified_time)
+
+    async def save_cookies(self) -> bool:
+        """保存Cookie到文件"""
+        try:
+            if not self.cookies:
+                return False
+            if not self.user_info:
+                await self.get_user_info()
+            self._write_cookie_file()
+            print(f"✓ Cookie已保存到 {self.cookies_file}")
+            return True
+        except Exception as e:
+            print(f"保存Cookie失败: {str(e)}")
+            return False
+
+    async def qr_login(self) -> bool:
+        """扫码登录B站"""
+        try:
+            response = await self.api_client.get(f"{self.passport_base}/x/passport-login/web/qrcode/generate")
+            qr_data = response.json()
+            if qr_data['code'] != 0:
+                print("获取二维码失败")
+                return False
+            qrcode_key = qr_data['data']['qrcode_key']
+
+            import qrcode
+            img = qrcode.make(qr_data['data']['url'], box_size=10, border=5)
+            img.save("bilibili_qr.png")
+            print("二维码已生成: bilibili_qr.png")
+            print("请使用B站APP扫描二维码登录")
+            try:
+                img.show()
+            except Exception:
+                pass
+
+            if await self._check_login_status(qrcode_key):
+                await self.save_cookies()
+                return True
+            return False
+        except Exception as e:
+            print(f"登录过程中出错: {str(e)}")
+            return False
+
+    async def _check_login_status(self, qrcode_key: str) -> bool:
+        """轮询扫码状态，登录成功后Cookie由响应写入 api_client"""
+        check_url = f"{self.passport_base}/x/passport-login/web/qrcode/poll"
+        for _ in range(180):  # 最多等待3分钟
+            try:
+                response = await self.api_client.get(check_url, params={'qrcode_key': qrcode_key})
+                status_data = response.json()
+                if status_data['code'] == 0:
+                    data = status_data['data']
+                    if data['code'] == 0:  # 登录成功
+                        print("登录成功!")
+                        self.is_logged_in = True
+                        self.cookies = {cookie.name: cookie.value for cookie in self.api_client.cookies.jar}
+                        user_info = await self.get_user_info()
+                        if user_info:
+                            print(f"欢迎，{user_info['uname']}!")
+                        return True
+                    elif data['code'] == 86038:  # 二维码过期
+                        print("二维码已过期，请重新登录")
+                        return False
+                    elif data['code'] == 86090:  # 二维码已扫描未确认
+                        print("二维码已扫描，请在手机上确认登录")
+                else:
+                    print(f"检查登录状态失败: {status_data['message']}")
+            except Exception as e:
+                print(f"检查登录状态时出错: {str(e)}")
+            await asyncio.sleep(1)
+
+        print("登录超时")
+        return False
+
+    def logout(self) -> bool:
+        """退出登录，清除Cookie并删除Cookie文件"""
+        try:
+            self.is_logged_in = False
+            self.cookies = None
+            self.user_info = None
+            self.cookie_expires = {}
+            self.verified_time = None
+            self.api_client.cookies.clear()
+            self.cdn_client.cookies.clear()
+            if os.path.exists(self.cookies_file):
+                os.remove(self.cookies_file)
+                print("✓ 已退出登录，Cookie文件已删除")
+            else:
+                print("✓ 已退出登录")
+            return True
+        except Exception as e:
+            print(f"退出登录失败: {str(e)}")
+            return False
+
+    async def _fetch_nav_user_info(self) -> Optional[Dict[str, Any]]:
+        """请求nav接口，已登录时返回用户信息，未登录返回None，网络错误时抛出异常"""
+        response = await self.api_client.get(f"{self.api_base}/x/web-interface/nav")
+        response.raise_for_status()
+        return parse_nav_user_info(response.json())
+
+    async def verify_login(self) -> bool:
+        """验证登录状态是否有效"""
+        try:
+            return await self._fetch_nav_user_info() is not None
+        except Exception:
+            return False
+
+    async def get_user_info(self) -> Optional[Dict[str, Any]]:
+        """获取用户信息"""
+        try:
+            user_info = await self._fetch_nav_user_info()
+            if user_info:
+                self.user_info = user_info
+                self.verified_time = datetime.now()
+            return user_info
+        except Exception as e:
+            print(f"获取用户信息失败: {str(e)}")
+            return None
+
+    def extract_bvid(self, input_str: str) -> Optional[str]:
+        """从输入中提取BV号"""
+        return extract_bvid(input_str)
+
+    async def get_video_info(self, bvid: str) -> Dict[str, Any]:
+        """获取视频信息"""
+        try:
+            response = await self.api_client.get(f"{self.api_base}/x/web-interface/view",
+                                                 params={'bvid': bvid})
+            response.raise_for_status()
+            data = response.json()
+
+            if data['code'] == 0:
+                return data['data']
+            else:
+                raise Exception(f"获取视频信息失败: {data['message']}")
+        except Exception as e:
+            raise Exception(f"获取视频信息时出错: {str(e)}")
+
+    async def get_video_play_url(self, bvid: str, cid: str, quality: int = 80) -> Dict[str, Any]:
+        """获取视频播放地址"""
+        params = {
+            'bvid': bvid,
+            'cid': cid,
+            'qn': quality,  # 视频质量
+            'fnval': DASH_FNVAL_ALL,  # dash格式，并请求所有格式和清晰度
+            'fourk': 1,     # 支持4K
+        }
+        try:
+            response = await self.api_client.get(f"{self.api_base}/x/player/playurl", params=params)
+            response.raise_for_status()
+            data = response.json()
+
+            if data['code'] == 0:
+                return data['data']
+            else:
+                raise Exception(f"获取播放地址失败: {data['message']}")
+        except Exception as e:
+            raise Exception(f"获取播放地址时出错: {str(e)}")
+
+    async def download_file(self, url: str, filename: str, file_type: str = "文件") -> bool:
+        """下载文件（先写入 .part 文件，校验大小后重命名）
+
+        数据攒成 WRITE_BLOCK_SIZE 大小的块后在线程池中写入，磁盘延迟不会阻塞事件循环中的其他传输
+        """
+        part_file = filename + '.part'
+        loop = asyncio.get_running_loop()
+        f = None
+        try:
+            f = await loop.run_in_executor(None, open, part_file, 'wb')
+            async with self.cdn_client.stream('GET', url) as response:
+                response.raise_for_status()
+                total_size = int(response.headers.get('content-length', 0))
+                downloaded_size = 0
+                buffer = bytearray()
+                async for chunk in response.aiter_bytes(chunk_size=READ_SIZE):
+                    buffer += chunk
+                    downloaded_size += len(chunk)
+                    if len(buffer) >= WRITE_BLOCK_SIZE:
+                        block, buffer = buffer, bytearray()
+                        await loop.run_in_executor(None, f.write, block)
+                if buffer:
+                    await loop.run_in_executor(None, f.write, buffer)
+                if total_size > 0 and downloaded_size != total_size:
+                    raise Exception(f"数据不完整: {downloaded_size}/{total_size} 字节")
+
+            await loop.run_in_executor(None, f.close)
+            f = None
+            os.replace(part_file, filename)
+            print(f"{file_type}下载完成: {filename}")
+            return True
+        except Exception as e:
+            print(f"{file_type}下载失败: {filename}: {str(e)}")
+            return False
+        finally:
+            if f is not None:
+                f.close()
+
+    async def download_cover(self, cover_url: str, filename: str) -> bool:
+        """下载封面图片"""
+        return await self.download_file(cover_url, filename, "封面")
+
+    async def merge_video_audio(self, video_file: str, audio_file: str, output_file: str) -> bool:
+        """合并视频和音频文件：优先在线程中使用内置remux，失败时使用ffmpeg子进程"""
+        part_file = output_file + '.part'
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, remux_dash, video_file, audio_file, part_file)
+            os.replace(part_file, output_file)
+            print(f"合并完成: {output_file}")
+            self._remove_merge_temps(video_file, audio_file)
+            return True
+        except (RemuxError, OSError) as e:
+            print(f"内置合并失败，改用ffmpeg: {str(e)}")
+            if os.path.exists(part_file):
+                os.remove(part_file)
+
+        # 首次探测ffmpeg需要启动子进程，放到线程中避免阻塞事件循环
+        ffmpeg = await loop.run_in_executor(None, find_ffmpeg)
+        if not ffmpeg:
+            print("未找到ffmpeg，无法自动合并视频和音频")
+            print(f"视频文件: {video_file}")
+            print(f"音频文件: {audio_file}")
+            return False
+
+        cmd = [ffmpeg['path'], '-i', video_file, '-i', audio_file, '-c', 'copy', '-y', output_file]
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            print(f"合并失败: {stderr.decode('utf-8', 'replace')}")
+            return False
+
+        print(f"合并完成: {output_file}")
+        self._remove_merge_temps(video_file, audio_file)
+        return True
+
+    @staticmethod
+    def _remove_merge_temps(video_file: str, audio_file: str):
+        """删除合并前的临时文件"""
+        try:
+            os.remove(video_file)
+            os.remove(audio_file)
+        except OSError:
+            print("临时文件删除失败")
+
+    async def download_video_by_bvid(self, input_str: str, quality: int = 80, download_type: str = '3',
+                                     pages: Optional[str] = None) -> bool:
+        """主下载函数（非交互，需指定清晰度和下载类型），pages 为分P选择（如 "all"、"1-5"），默认使用URL中的 p 参数或P1"""
+        try:
+            bvid = self.extract_bvid(input_str)
+            if not bvid:
+                print(f"无效的BV号或URL: {input_str}")
+                return False
+
+            video_info = await self.get_video_info(bvid)
+            title = video_info['title']
+            cover_url = video_info['pic']
+            page_list = video_info.get('pages') or [{'page': 1, 'cid': video_info['cid'], 'part': title}]
+            if pages is None:
+                pages = extract_page(input_str)
+            selected_pages = [page_list[p - 1] for p in parse_page_selection(pages, len(page_list))]
+            safe_title = re.sub(r'[\\/*?:"<>|]', "", title)
+            cover_filename = f"{safe_title}_{bvid}_cover.jpg"
+            print(f"正在处理视频: {bvid} {title}")
+
+            if download_type == '4':
+                return await self.download_cover(cover_url, cover_filename)
+
+            # 各分P作为并发任务同时下载；类型5的封面每个视频只下载一次，与分P同时进行
+            cover_task = None
+            if download_type == '5':
+                cover_task = asyncio.ensure_future(self.download_cover(cover_url, cover_filename))
+            try:
+                results = await asyncio.gather(*(
+                    self._download_page(bvid, page['cid'], quality, download_type, base_name)
+                    for page, base_name in page_jobs(bvid, safe_title, page_list, selected_pages)
+                ))
+                return all(results)
+            finally:
+                if cover_task and not await cover_task:
+                    print("封面下载失败，视频和音频不受影响")
+
+        except Exception as e:
+            print(f"下载过程中出错: {str(e)}")
+            return False
+
+    async def _download_page(self, bvid: str, cid: int, quality: int, download_type: str, base_name: str) -> bool:
+        """按下载类型下载单个分P的视频流/音频流"""
+        try:
+            # 一次请求获取所有清晰度的DASH流，在本地选择清晰度
+            play_info = await self.get_video_play_url(bvid, cid, MAX_QUALITY)
+            video_url = None
+            audio_url = None
+            if play_info.get('dash'):
+                video_stream = select_video_stream(play_info['dash'].get('video') or [], quality)
+                audio_stream = select_audio_stream(play_info['dash'].get('audio') or [])
+                if video_stream:
+                    video_url = video_stream['baseUrl']
+                if audio_stream:
+                    audio_url = audio_stream['baseUrl']
+            else:
+                if play_info.get('quality') != quality:
+                    play_info = await self.get_video_play_url(bvid, cid, quality)
+                durl = play_info['durl']
+                if durl:
+                    video_url = durl[0]['url']
+
+            if download_type == '1':
+                if not video_url:
+                    print("无法获取视频URL")
+                    return False
+                return await self.download_file(video_url, f"{base_name}_video.mp4", "视频")
+
+            if download_type == '2':
+                if not audio_url:
+                    print("无法获取音频URL")
+                    return False
+                return await self.download_file(audio_url, f"{base_name}_audio.m4a", "音频")
+
+            # 类型3/5: 视频、音频作为并发任务同时下载
+            if not video_url:
+                print("无法获取视频URL")
+                return False
+            if not audio_url:
+                print("无法获取音频URL，将只下载视频")
+                return await self.download_file(video_url, f"{base_name}.mp4", "视频")
+
+            video_filename = f"{base_name}_video_temp.mp4"
+            audio_filename = f"{base_name}_audio_temp.m4a"
+            video_success, audio_success = await asyncio.gather(
+                self.download_file(video_url, video_filename, "视频"),
+                self.download_file(audio_url, audio_filename, "音频"),
+            )
+            if video_success and audio_success:
+                return await self.merge_video_audio(video_filename, audio_filename, f"{base_name}.mp4")
+            print("视频或音频下载失败，无法合并")
+            return False
+
+        except Exception as e:
+            print(f"下载过程中出错: {str(e)}")
+            return False
+
+    async def download_many(self, inputs: Iterable[str], quality: int = 80, download_type: str = '3',
+                            concurrency: int = 16, pages: Optional[str] = None) -> List[Dict[str, Any]]:
+        """异步批量下载，由 concurrency 个工作协程按需消费输入，返回每项的下载结果"""
+        results = []
+        items = enumerate(inputs)
+
+        async def worker():
+            # 所有工作协程共享同一个迭代器，输入不会被一次性展开
+            for index, input_str in items:
+                start_time = time.time()
+                success = await self.download_video_by_bvid(input_str, quality, download_type, pages)
+                results.append({
+                    'index': index,
+                    'input': input_str,
+                    'success': success,
+                    'error': None if success else "下载失败",
+                    'elapsed': time.time() - start_time,
+                })
+
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+        results.sort(key=lambda r: r['index'])
+        return results
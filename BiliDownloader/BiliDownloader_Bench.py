@@ -0,0 +1,326 @@
+import argparse
+import contextlib
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Any, List
+
+import requests
+
+from BiliDownloader import BilibiliVideoDownloader
+from BiliDownloader_MockServer import MockBilibiliServer, MIB
+
+
+PATTERN = os.urandom(1024 * 1024)
+
+
+class _BenchHandler(http.server.BaseHTTPRequestHandler):
+    """返回指定大小的数据，支持Range请求"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        total_size = int(self.path.strip('/').split('?')[0] or 0)
+        start, end = 0, total_size - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else end
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{total_size}')
+        else:
+            self.send_response(200)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+
+        view = memoryview(PATTERN)
+        position = start
+        try:
+            while position <= end:
+                offset = position % len(PATTERN)
+                size = min(len(PATTERN) - offset, end - position + 1)
+                self.wfile.write(view[offset:offset + size])
+                position += size
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def _serve(port_queue):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _BenchHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def legacy_download(session: requests.Session, url: str, filename: str):
+    """改进前的写入方式：每8KB一个bytes对象、一次write"""
+    response = session.get(url, stream=True)
+    response.raise_for_status()
+    with open(filename, 'wb') as f:
+        for chunk in response.iter_content(chunk_size=8192):
+            if chunk:
+                f.write(chunk)
+
+
+def measure(name: str, func, size: int) -> Dict[str, Any]:
+    """运行一次下载，统计耗时和本进程的CPU时间（包括所有线程）"""
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    gb = size / (1024 ** 3)
+    return {
+        'name': name,
+        'wall': wall,
+        'speed': size / (1024 * 1024) / wall,
+        'cpu_per_gb': cpu / gb,
+    }
+
+
+# 在新的解释器中运行，分别计时：导入模块、创建下载器、第一次请求
+_STARTUP_SCRIPT = """
+import json, os, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import BiliDownloader
+imported = time.perf_counter()
+downloader = BiliDownloader.BilibiliVideoDownloader(cookies_file=sys.argv[3], cache_file=None, cdn_stats_file=None)
+created = time.perf_counter()
+downloader.session.get(sys.argv[2]).raise_for_status()
+requested = time.perf_counter()
+print(json.dumps({'import': imported - start, 'init': created - imported, 'first_request': requested - created}))
+"""
+
+
+def startup_benchmark(url: str, work_dir: str, repeat: int) -> int:
+    """测量命令行启动开销：解释器启动到导入完成、构造下载器、第一次请求的耗时（取中位数）"""
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    cookies_file = os.path.join(work_dir, 'cookies.json')
+    samples = []
+    for _ in range(max(1, repeat)):
+        wall_start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT, module_dir, url, cookies_file],
+                                capture_output=True, text=True)
+        wall = time.perf_counter() - wall_start
+        if result.returncode != 0:
+            print(result.stderr)
+            return 1
+        sample = json.loads(result.stdout.strip().splitlines()[-1])
+        sample['process'] = wall
+        samples.append(sample)
+
+    print(f"启动开销，重复 {len(samples)} 次取中位数")
+    names = [('import', "导入模块"), ('init', "创建下载器"), ('first_request', "第一次请求"), ('process', "进程总耗时")]
+    for key, name in names:
+        values = [s[key] * 1000 for s in samples]
+        print(f"{name:<12}{statistics.median(values):>10.1f} ms  (最小 {min(values):.1f} ms)")
+    return 0
+
+
+# 基准测试场景: (名称, 模拟服务器的网络条件)
+SUITE_SCENARIOS = [
+    ("不限速", {}),
+    ("单连接4MB/s+50ms延迟", {'bandwidth': 4 * MIB, 'latency': 0.05}),
+    ("10%限流+2%断线", {'throttle_rate': 0.1, 'drop_rate': 0.02}),
+]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """按最近秩法计算百分位数"""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def _latency_line(name: str, values: List[float], extra: str = '') -> str:
+    if not values:
+        return f"  {name:<22}{'无数据':>10}"
+    return (f"  {name:<22}{percentile(values, 50):>10.3f}{percentile(values, 99):>10.3f}"
+            f"{len(values):>6}{extra}")
+
+
+def _run_scenario(server: MockBilibiliServer, conditions: Dict[str, Any], work_dir: str,
+                  repeat: int, items: int, workers: int, connections: int) -> List[str]:
+    """在一组网络条件下分别测试 download_file、批量 download_video_by_bvid 和 merge_video_audio，返回报告行"""
+    server.reset_stats()
+    server.set_conditions(**dict({'bandwidth': None, 'latency': 0.0, 'throttle_rate': 0.0, 'drop_rate': 0.0},
+                                 **conditions))
+    base = server.api_base
+    # 每个场景使用新的下载器，自适应并发从初始值开始
+    downloader = BilibiliVideoDownloader(cookies_file=os.path.join(work_dir, 'cookies.json'), connections=connections,
+                                         cache_file=None, cdn_stats_file=None,
+                                         api_base=base, passport_base=base, comment_base=base)
+    downloader.merge_engine = 'python'
+    stages = {}
+
+    def on_event(event):
+        if event['type'] == 'stage_end' and event['success']:
+            stages.setdefault(event['stage'], []).append(event['elapsed'])
+
+    downloader.events.add_listener(on_event)
+    lines = []
+    video_size = len(server.media['video'])
+    item_size = video_size + len(server.media['audio'])
+
+    # download_file：单个视频流
+    url = f"{server.cdn_base}/cdn/BV1bench0000/1/video-80.m4s"
+    filename = os.path.join(work_dir, 'file.m4s')
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok = downloader.download_file(url, filename, "视频")
+        if ok:
+            times.append(time.perf_counter() - start)
+            os.remove(filename)
+    speed = f"{video_size / MIB / statistics.median(times):>10.1f} MB/s" if times else ''
+    lines.append(_latency_line("download_file", times, speed))
+
+    # download_video_by_bvid：通过 download_many 批量下载，合并在后台进行
+    bvids = [f"BV1bench{i:04d}" for i in range(items)]
+    stages.clear()
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = downloader.download_many(bvids, quality=80, download_type='3', workers=workers)
+        wall = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+    succeeded = [r for r in results if r['success']]
+    batch = (f"{len(succeeded) / wall * 60:>10.1f} 项/分 {len(succeeded) * item_size / MIB / wall:>8.1f} MB/s "
+             f"成功 {len(succeeded)}/{len(results)}")
+    lines.append(_latency_line("download_video_by_bvid", [r['elapsed'] for r in succeeded], batch))
+    for stage in ('download', 'merge'):
+        lines.append(_latency_line(f"  阶段 {stage}", stages.get(stage, [])))
+
+    # merge_video_audio：内置remux，输入文件每次重新复制（合并后会被删除）
+    source_video = os.path.join(work_dir, 'source_video.m4s')
+    source_audio = os.path.join(work_dir, 'source_audio.m4s')
+    with open(source_video, 'wb') as f:
+        f.write(server.media['video'])
+    with open(source_audio, 'wb') as f:
+        f.write(server.media['audio'])
+    times = []
+    for _ in range(repeat):
+        video_file = os.path.join(work_dir, 'merge_video.m4s')
+        audio_file = os.path.join(work_dir, 'merge_audio.m4s')
+        output_file = os.path.join(work_dir, 'merge.mp4')
+        shutil.copyfile(source_video, video_file)
+        shutil.copyfile(source_audio, audio_file)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ok = downloader.merge_video_audio(video_file, audio_file, output_file)
+        if ok:
+            times.append(time.perf_counter() - start)
+        os.remove(output_file)
+    speed = f"{item_size / MIB / statistics.median(times):>10.1f} MB/s" if times else ''
+    lines.append(_latency_line("merge_video_audio", times, speed))
+
+    stats = server.stats
+    lines.append(f"  服务端: API请求 {stats['api_requests']} (412: {stats['throttled']})，"
+                 f"CDN请求 {stats['cdn_requests']} (断开: {stats['dropped']})，"
+                 f"发送 {stats['bytes_sent'] / MIB:.1f} MB")
+    return lines
+
+
+def suite_benchmark(work_dir: str, size_mb: int, repeat: int, items: int, workers: int, connections: int) -> int:
+    """在本地模拟的B站API/CDN上，按不同网络条件测量吞吐量和各阶段延迟"""
+    with MockBilibiliServer(video_size=size_mb * MIB, audio_size=max(1, size_mb // 8) * MIB, seed=0) as server:
+        print(f"视频 {size_mb} MB，每项 {items} 个视频、{workers} 个并行，{connections} 连接分段，"
+              f"单文件测试重复 {repeat} 次")
+        for name, conditions in SUITE_SCENARIOS:
+            scenario_dir = tempfile.mkdtemp(prefix='scenario_', dir=work_dir)
+            print(f"\n[{name}]")
+            print(f"  {'测试':<22}{'p50(s)':>10}{'p99(s)':>10}{'次数':>6}")
+            for line in _run_scenario(server, conditions, scenario_dir, max(1, repeat), items, workers,
+                                      connections):
+                print(line)
+            shutil.rmtree(scenario_dir, ignore_errors=True)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="下载写入路径基准测试：对比逐块写入与缓冲区复用、预分配、对齐写入；"
+                                                 "--startup 测量启动开销；--suite 在本地模拟服务器上测量吞吐量和延迟")
+    parser.add_argument("-s", "--size", type=int,
+                        help="测试文件大小 (MB，默认: 512，--suite 时为每个视频的大小，默认: 32)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="每种方式重复次数，取最好结果 (默认: 3)")
+    parser.add_argument("-d", "--dir", help="写入目录 (默认: 系统临时目录)")
+    parser.add_argument("--startup", action="store_true",
+                        help="改为测量启动开销：导入模块、创建下载器和第一次请求的耗时")
+    parser.add_argument("--suite", action="store_true",
+                        help="改为在本地模拟的B站API/CDN上运行吞吐量基准测试（不限速、限速+延迟、限流+断线）")
+    parser.add_argument("--items", type=int, default=8, help="--suite 批量下载的视频数 (默认: 8)")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="--suite 同时下载的视频数 (默认: 2)")
+    parser.add_argument("-c", "--connections", type=int, default=4, help="--suite 每个文件的分段连接数 (默认: 4)")
+    args = parser.parse_args()
+
+    if args.suite:
+        work_dir = tempfile.mkdtemp(prefix='bili_bench_', dir=args.dir)
+        try:
+            return suite_benchmark(work_dir, args.size or 32, args.repeat, args.items, args.workers,
+                                   args.connections)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    port_queue = multiprocessing.Queue()
+    # 服务端在独立进程中运行，CPU时间只统计客户端
+    server = multiprocessing.Process(target=_serve, args=(port_queue,), daemon=True)
+    server.start()
+    size = (args.size or 512) * 1024 * 1024
+    port = port_queue.get()
+    url = f"http://127.0.0.1:{port}/{size}"
+    work_dir = tempfile.mkdtemp(prefix='bili_bench_', dir=args.dir)
+    if args.startup:
+        try:
+            return startup_benchmark(f"http://127.0.0.1:{port}/1024", work_dir, args.repeat)
+        finally:
+            server.terminate()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    session = requests.Session()
+    downloader = BilibiliVideoDownloader(cookies_file=os.path.join(work_dir, 'cookies.json'),
+                                         cache_file=None, cdn_stats_file=None)
+    cases = [
+        ("iter_content 8KB", lambda f: legacy_download(session, url, f)),
+        ("download_file 单连接", lambda f: downloader.download_file(url, f, connections=1)),
+        ("download_file 4连接", lambda f: downloader.download_file(url, f, connections=4)),
+    ]
+
+    try:
+        print(f"文件大小: {size // (1024 * 1024)} MB，重复 {args.repeat} 次取最好结果")
+        print(f"{'方式':<24}{'耗时(s)':>10}{'速度(MB/s)':>14}{'CPU(s/GB)':>12}")
+        for name, run in cases:
+            filename = os.path.join(work_dir, 'bench.bin')
+            results = []
+            for _ in range(max(1, args.repeat)):
+                results.append(measure(name, lambda: run(filename), size))
+                if os.path.getsize(filename) != size:
+                    print(f"{name}: 文件大小不正确")
+                    return 1
+                os.remove(filename)
+            best = min(results, key=lambda r: r['cpu_per_gb'])
+            print(f"{name:<24}{best['wall']:>10.2f}{best['speed']:>14.1f}{best['cpu_per_gb']:>12.2f}")
+    finally:
+        server.terminate()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
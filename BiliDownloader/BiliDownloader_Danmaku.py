@@ -0,0 +1,289 @@
+import heapq
+import os
+import pickle
+import tempfile
+import unicodedata
+import xml.etree.ElementTree as ET
+from typing import Optional, Dict, Any, Iterable, Iterator, BinaryIO
+
+
+# 弹幕以元组表示: (出现时间/秒, 模式, 字号, 颜色RGB, 内容)
+# 模式: 1-3 滚动，4 底部，5 顶部，6 逆向滚动，7-9 高级/代码弹幕（不转换）
+SCROLL_MODES = (1, 2, 3)
+REVERSE_MODE = 6
+BOTTOM_MODE = 4
+TOP_MODE = 5
+
+SORT_CHUNK_SIZE = 50000  # 外部排序时每个有序块的弹幕数，内存中最多保留一个块
+
+
+def _decode_varint(data: bytes, offset: int):
+    """从内存中解码一个varint，返回 (值, 新偏移)"""
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, offset
+        shift += 7
+
+
+def _read_field(data: bytes, offset: int):
+    """读取一个protobuf字段，返回 (字段号, 类型, 值, 新偏移)，数据不完整时抛出IndexError"""
+    key, offset = _decode_varint(data, offset)
+    number, wire_type = key >> 3, key & 7
+    if wire_type == 0:
+        value, offset = _decode_varint(data, offset)
+        return number, wire_type, value, offset
+    if wire_type == 2:
+        length, offset = _decode_varint(data, offset)
+    elif wire_type == 1:
+        length = 8
+    elif wire_type == 5:
+        length = 4
+    else:
+        raise ValueError(f"不支持的protobuf字段类型: {wire_type}")
+    if offset + length > len(data):
+        raise IndexError("protobuf字段不完整")
+    return number, wire_type, data[offset:offset + length], offset + length
+
+
+def _parse_elem(data: bytes) -> tuple:
+    """解析一条 DanmakuElem 消息（字段 2 时间/毫秒、3 模式、4 字号、5 颜色、7 内容）"""
+    fields = {2: 0, 3: 1, 4: 25, 5: 0xFFFFFF, 7: b''}
+    offset = 0
+    end = len(data)
+    while offset < end:
+        number, _, value, offset = _read_field(data, offset)
+        if number in fields:
+            fields[number] = value
+    return fields[2] / 1000, fields[3], fields[4], fields[5], fields[7].decode('utf-8', 'replace')
+
+
+def iter_protobuf_comments(chunks: Iterable[bytes]) -> Iterator[tuple]:
+    """逐块解析 seg.so 返回的 DmSegMobileReply（字段1为重复的 DanmakuElem，其他字段如 state 跳过），不需要读入整个响应"""
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        offset = 0
+        while True:
+            try:
+                number, wire_type, value, position = _read_field(buffer, offset)
+            except IndexError:
+                break  # 字段不完整，等待下一块数据
+            if number == 1 and wire_type == 2:
+                yield _parse_elem(value)
+            offset = position
+        buffer = buffer[offset:]
+    if buffer:
+        raise ValueError("protobuf数据被截断")
+
+
+def iter_xml_comments(stream: BinaryIO) -> Iterator[tuple]:
+    """逐条解析XML格式弹幕（<d p="时间,模式,字号,颜色,...">内容</d>），已处理的元素立即释放"""
+    context = ET.iterparse(stream, events=('start', 'end'))
+    root = None
+    for event, elem in context:
+        if root is None:
+            root = elem
+        if event != 'end' or elem.tag != 'd':
+            continue
+        try:
+            p = elem.get('p', '').split(',')
+            comment = (float(p[0]), int(p[1]), int(p[2]), int(p[3]), elem.text or '')
+        except (ValueError, IndexError):
+            comment = None
+        elem.clear()
+        root.clear()
+        if comment:
+            yield comment
+
+
+def _iter_chunk_file(f: BinaryIO) -> Iterator[tuple]:
+    """读取外部排序写出的一个有序块"""
+    while True:
+        try:
+            yield from pickle.load(f)
+        except EOFError:
+            return
+
+
+def sort_comments(comments: Iterable[tuple], chunk_size: int = SORT_CHUNK_SIZE) -> Iterator[tuple]:
+    """按出现时间排序弹幕：超过 chunk_size 时将有序块写入临时文件再归并，内存占用与弹幕总数无关"""
+    chunk = []
+    files = []
+    try:
+        for comment in comments:
+            chunk.append(comment)
+            if len(chunk) >= chunk_size:
+                chunk.sort(key=lambda c: c[0])
+                f = tempfile.TemporaryFile()
+                # 分批写入，读取时同样按批读回，避免一次反序列化整个块
+                for i in range(0, len(chunk), 1000):
+                    pickle.dump(chunk[i:i + 1000], f, pickle.HIGHEST_PROTOCOL)
+                f.seek(0)
+                files.append(f)
+                chunk = []
+        chunk.sort(key=lambda c: c[0])
+        if not files:
+            yield from chunk
+            return
+        runs = [_iter_chunk_file(f) for f in files] + [iter(chunk)]
+        yield from heapq.merge(*runs, key=lambda c: c[0])
+    finally:
+        for f in files:
+            f.close()
+
+
+def _text_width(text: str, font_size: float) -> float:
+    """估算文字宽度：全角字符为一个字号宽，其余为半个字号"""
+    width = 0.0
+    for char in text:
+        width += 1.0 if unicodedata.east_asian_width(char) in ('W', 'F') else 0.5
+    return width * font_size
+
+
+def _ass_time(seconds: float) -> str:
+    """格式化为ASS时间 H:MM:SS.cc"""
+    centiseconds = int(round(max(seconds, 0) * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def _ass_text(text: str) -> str:
+    """转义ASS中有特殊含义的字符"""
+    text = text.replace('\\', '＼').replace('{', '｛').replace('}', '｝')
+    return text.replace('\r', '').replace('\n', ' ').replace('/n', ' ')
+
+
+class DanmakuLayout:
+    """弹幕轨道分配：每条轨道只记录最后一条弹幕，每条弹幕检查一遍轨道，总耗时与弹幕数呈线性关系"""
+
+    def __init__(self, width: int, height: int, font_scale: float, scroll_duration: float,
+                 fixed_duration: float, display_area: float = 1.0):
+        self.width = width
+        self.height = height
+        self.font_scale = font_scale
+        self.lane_height = 25 * font_scale
+        self.scroll_duration = scroll_duration
+        self.fixed_duration = fixed_duration
+        lanes = max(1, int(height * display_area // self.lane_height))
+        self._scroll = [None] * lanes  # (出现时间, 宽度)
+        self._top = [0.0] * lanes      # 消失时间
+        self._bottom = [0.0] * lanes
+
+    def _scroll_free(self, lane: Optional[tuple], start: float, width: float) -> bool:
+        if lane is None:
+            return True
+        last_start, last_width = lane
+        last_speed = (self.width + last_width) / self.scroll_duration
+        speed = (self.width + width) / self.scroll_duration
+        # 上一条的尾部已经完全进入屏幕，且新弹幕在上一条离开屏幕前追不上它
+        if start - last_start < last_width / last_speed:
+            return False
+        return start + self.width / speed >= last_start + self.scroll_duration
+
+    def place_scroll(self, start: float, width: float) -> Optional[int]:
+        """为滚动弹幕分配轨道，返回轨道号，所有轨道都被占用时返回None"""
+        for index, lane in enumerate(self._scroll):
+            if self._scroll_free(lane, start, width):
+                self._scroll[index] = (start, width)
+                return index
+        return None
+
+    def place_fixed(self, start: float, top: bool) -> Optional[int]:
+        """为顶部/底部弹幕分配轨道"""
+        lanes = self._top if top else self._bottom
+        for index, end in enumerate(lanes):
+            if end <= start:
+                lanes[index] = start + self.fixed_duration
+                return index
+        return None
+
+    def event(self, comment: tuple) -> Optional[str]:
+        """排版一条弹幕，返回ASS的Dialogue行；没有空闲轨道或不支持的弹幕返回None"""
+        start, mode, size, color, text = comment
+        text = _ass_text(text)
+        if not text.strip():
+            return None
+        font_size = size * self.font_scale
+        text_width = _text_width(text, font_size)
+
+        if mode in SCROLL_MODES or mode == REVERSE_MODE:
+            lane = self.place_scroll(start, text_width)
+            if lane is None:
+                return None
+            y = lane * self.lane_height
+            x1, x2 = self.width, -text_width
+            if mode == REVERSE_MODE:
+                x1, x2 = x2, x1
+            tags = f"\\move({x1:.0f},{y:.0f},{x2:.0f},{y:.0f})"
+            end = start + self.scroll_duration
+        elif mode in (TOP_MODE, BOTTOM_MODE):
+            lane = self.place_fixed(start, mode == TOP_MODE)
+            if lane is None:
+                return None
+            if mode == TOP_MODE:
+                tags = f"\\an8\\pos({self.width // 2},{lane * self.lane_height:.0f})"
+            else:
+                tags = f"\\an2\\pos({self.width // 2},{self.height - lane * self.lane_height:.0f})"
+            end = start + self.fixed_duration
+        else:
+            return None
+
+        if size != 25:
+            tags += f"\\fs{font_size:.0f}"
+        if color != 0xFFFFFF:
+            tags += f"\\c&H{color & 0xFF:02X}{(color >> 8) & 0xFF:02X}{(color >> 16) & 0xFF:02X}&"
+            if color == 0:
+                tags += "\\3c&HFFFFFF&"  # 黑色弹幕使用白色描边
+        return f"Dialogue: 2,{_ass_time(start)},{_ass_time(end)},Danmaku,,0,0,0,,{{{tags}}}{text}\n"
+
+
+def write_ass(comments: Iterable[tuple], output_file: str, width: int = 1920, height: int = 1080,
+              font_name: str = "Microsoft YaHei", font_scale: Optional[float] = None,
+              scroll_duration: float = 8.0, fixed_duration: float = 4.0, display_area: float = 1.0,
+              opacity: float = 0.8) -> Dict[str, Any]:
+    """将按时间排序的弹幕逐条排版并写入ASS文件，没有空闲轨道的弹幕丢弃；返回 {'total', 'written', 'dropped'}"""
+    layout = DanmakuLayout(width, height, font_scale or height / 720, scroll_duration, fixed_duration,
+                           display_area)
+    alpha = f"{int(round((1 - opacity) * 255)):02X}"
+    stats = {'total': 0, 'written': 0, 'dropped': 0}
+
+    part_file = output_file + '.part'
+    try:
+        with open(part_file, 'w', encoding='utf-8-sig', newline='\n', buffering=1024 * 1024) as f:
+            f.write(
+                "[Script Info]\n"
+                "ScriptType: v4.00+\n"
+                f"PlayResX: {width}\n"
+                f"PlayResY: {height}\n"
+                "WrapStyle: 2\n"
+                "ScaledBorderAndShadow: yes\n\n"
+                "[V4+ Styles]\n"
+                "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+                "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, "
+                "Shadow, Alignment, MarginL, MarginR, MarginV, Encoding\n"
+                f"Style: Danmaku,{font_name},{layout.lane_height:.0f},&H{alpha}FFFFFF,&H{alpha}FFFFFF,"
+                f"&H{alpha}000000,&H{alpha}000000,1,0,0,0,100,100,0,0,1,1.5,0,7,0,0,0,1\n\n"
+                "[Events]\n"
+                "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n"
+            )
+            for comment in comments:
+                stats['total'] += 1
+                line = layout.event(comment)
+                if line is None:
+                    stats['dropped'] += 1
+                    continue
+                f.write(line)
+                stats['written'] += 1
+    except BaseException:
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+    os.replace(part_file, output_file)
+    return stats
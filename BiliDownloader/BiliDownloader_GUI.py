@@ -12,7 +12,7 @@ from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QThread
 from PyQt5.QtGui import QFont, QPalette, QColor
 
 # 导入B站下载器类
-from BiliDownloader import BilibiliVideoDownloader
+from BiliDownloader import BilibiliVideoDownloader, format_eta, COVER_FORMATS
 
 
 class DownloadWorker(QThread):
@@ -20,18 +20,38 @@ class DownloadWorker(QThread):
     progress_signal = pyqtSignal(str, int)  # 文件名, 进度百分比
     log_signal = pyqtSignal(str)  # 日志消息
     finished_signal = pyqtSignal(bool, str)  # 成功状态, 消息
-    file_progress_signal = pyqtSignal(str, int, int)  # 文件名, 已下载大小, 总大小
+    file_progress_signal = pyqtSignal(str, 'qint64', 'qint64')  # 文件名, 已下载大小, 总大小（字节，可超过2GB）
+    speed_signal = pyqtSignal(str, float, float)  # 文件名, 速度(字节/秒), 剩余时间(秒，-1为未知)
 
-    def __init__(self, downloader, input_str, quality, download_type, download_path):
+    def __init__(self, downloader, input_str, quality, download_type, download_path, pages=None):
         super().__init__()
         self.downloader = downloader
         self.input_str = input_str
+        self.pages = pages
         self.quality = quality
         self.download_type = download_type
         self.download_path = download_path
         self.is_running = True
 
+    def on_download_event(self, event):
+        """下载事件监听器（在下载线程中调用），转换为Qt信号"""
+        if event['type'] == 'progress':
+            total = event['total']
+            if total > 0:
+                self.progress_signal.emit(event['item'], int(event['downloaded'] * 100 / total))
+            self.file_progress_signal.emit(event['item'], event['downloaded'], total)
+            eta = event['eta']
+            self.speed_signal.emit(event['item'], event['speed'], -1.0 if eta is None else eta)
+        elif event['type'] == 'stage_end':
+            if event['stage'] == 'merge':
+                status = "完成" if event['success'] else "失败"
+                self.log_signal.emit(f"合并{status}: {event['item']} (用时 {event['elapsed']:.1f}s)")
+            elif event['success']:
+                speed = event['average_speed'] / (1024 * 1024)
+                self.log_signal.emit(f"{event['file_type']}下载完成: {event['item']} (平均 {speed:.1f} MB/s)")
+
     def run(self):
+        self.downloader.events.add_listener(self.on_download_event, max_rate=10)
         try:
             # 保存原始工作目录
             original_dir = os.getcwd()
@@ -48,7 +68,8 @@ class DownloadWorker(QThread):
             success = self.downloader.download_video_by_bvid(
                 self.input_str,
                 self.quality,
-                self.download_type
+                self.download_type,
+                self.pages
             )
 
             # 恢复原始目录
@@ -61,6 +82,8 @@ class DownloadWorker(QThread):
 
         except Exception as e:
             self.finished_signal.emit(False, f"下载过程中出错: {str(e)}")
+        finally:
+            self.downloader.events.remove_listener(self.on_download_event)
 
     def get_download_type_name(self):
         """获取下载类型名称"""
@@ -69,7 +92,8 @@ class DownloadWorker(QThread):
             '2': '仅音频',
             '3': '视频+音频',
             '4': '仅封面',
-            '5': '视频+音频+封面'
+            '5': '视频+音频+封面',
+            '6': '仅字幕'
         }
         return type_map.get(self.download_type, '未知类型')
 
@@ -257,6 +281,14 @@ class BiliDownloaderGUI(QMainWindow):
         url_row.addWidget(self.url_input)
         input_layout.addLayout(url_row)
 
+        # 分P选择
+        pages_row = QHBoxLayout()
+        pages_row.addWidget(QLabel("分P选择:"))
+        self.pages_input = QLineEdit()
+        self.pages_input.setPlaceholderText("多P视频: all 为全部，或如 1-5,8 (留空使用URL中的p参数或P1)")
+        pages_row.addWidget(self.pages_input)
+        input_layout.addLayout(pages_row)
+
         # 登录状态
         login_row = QHBoxLayout()
         login_row.addWidget(QLabel("登录状态:"))
@@ -326,11 +358,15 @@ class BiliDownloaderGUI(QMainWindow):
         self.type_all = QRadioButton("视频+音频+封面")
         self.download_type_group.addButton(self.type_all, 5)
 
+        self.type_subtitles = QRadioButton("仅字幕")
+        self.download_type_group.addButton(self.type_subtitles, 6)
+
         type_layout.addWidget(self.type_video)
         type_layout.addWidget(self.type_audio)
         type_layout.addWidget(self.type_both)
         type_layout.addWidget(self.type_cover)
         type_layout.addWidget(self.type_all)
+        type_layout.addWidget(self.type_subtitles)
 
         type_group.setLayout(type_layout)
         layout.addWidget(type_group)
@@ -371,10 +407,81 @@ class BiliDownloaderGUI(QMainWindow):
         self.auto_merge.setChecked(True)
         advanced_layout.addWidget(self.auto_merge)
 
+        self.stream_merge = QCheckBox("边下载边合并 (不写入临时文件，需要ffmpeg，Windows不支持)")
+        self.stream_merge.setChecked(False)
+        advanced_layout.addWidget(self.stream_merge)
+
+        self.download_danmaku = QCheckBox("同时下载弹幕 (转换为ASS字幕)")
+        self.download_danmaku.setChecked(False)
+        advanced_layout.addWidget(self.download_danmaku)
+
+        self.download_subtitles = QCheckBox("同时下载字幕 (CC/AI字幕，SRT格式)")
+        self.download_subtitles.setChecked(False)
+        advanced_layout.addWidget(self.download_subtitles)
+
+        merge_engine_row = QHBoxLayout()
+        merge_engine_row.addWidget(QLabel("合并方式:"))
+        self.merge_engine_combo = QComboBox()
+        self.merge_engine_combo.addItem("自动 (优先内置，失败时使用ffmpeg)", 'auto')
+        self.merge_engine_combo.addItem("内置 (不需要ffmpeg)", 'python')
+        self.merge_engine_combo.addItem("ffmpeg", 'ffmpeg')
+        merge_engine_row.addWidget(self.merge_engine_combo)
+        merge_engine_row.addStretch()
+        advanced_layout.addLayout(merge_engine_row)
+
+        # 封面由图片CDN缩放/转码后下载，减少下载量
+        cover_row = QHBoxLayout()
+        cover_row.addWidget(QLabel("封面格式:"))
+        self.cover_format_combo = QComboBox()
+        self.cover_format_combo.addItem("原图", None)
+        for fmt in COVER_FORMATS:
+            self.cover_format_combo.addItem(fmt.upper(), fmt)
+        cover_row.addWidget(self.cover_format_combo)
+        cover_row.addWidget(QLabel("封面宽度:"))
+        self.cover_width_spin = QSpinBox()
+        self.cover_width_spin.setRange(0, 4096)
+        self.cover_width_spin.setSingleStep(160)
+        self.cover_width_spin.setSpecialValueText("原图")
+        self.cover_width_spin.setToolTip("封面宽度（像素），高度按比例缩放，0为原图大小")
+        cover_row.addWidget(self.cover_width_spin)
+        cover_row.addStretch()
+        advanced_layout.addLayout(cover_row)
+
         self.show_progress = QCheckBox("显示详细进度")
         self.show_progress.setChecked(True)
         advanced_layout.addWidget(self.show_progress)
 
+        connections_row = QHBoxLayout()
+        connections_row.addWidget(QLabel("分段下载连接数:"))
+        self.connections_spin = QSpinBox()
+        self.connections_spin.setRange(1, 32)
+        self.connections_spin.setValue(1)
+        self.connections_spin.setToolTip("每个文件同时使用的连接数，1为单连接下载")
+        connections_row.addWidget(self.connections_spin)
+        connections_row.addStretch()
+        advanced_layout.addLayout(connections_row)
+
+        # 限速修改后立即生效，包括正在进行的下载
+        rate_row = QHBoxLayout()
+        rate_row.addWidget(QLabel("全局限速 (MB/s):"))
+        self.rate_limit_spin = QDoubleSpinBox()
+        self.rate_limit_spin.setRange(0, 1000)
+        self.rate_limit_spin.setDecimals(1)
+        self.rate_limit_spin.setSpecialValueText("不限速")
+        self.rate_limit_spin.setToolTip("所有下载合计的速度上限，0为不限速")
+        self.rate_limit_spin.valueChanged.connect(self.apply_rate_limit)
+        rate_row.addWidget(self.rate_limit_spin)
+        rate_row.addWidget(QLabel("单个下载限速 (MB/s):"))
+        self.per_download_rate_spin = QDoubleSpinBox()
+        self.per_download_rate_spin.setRange(0, 1000)
+        self.per_download_rate_spin.setDecimals(1)
+        self.per_download_rate_spin.setSpecialValueText("不限速")
+        self.per_download_rate_spin.setToolTip("每个文件的速度上限，0为不限速")
+        self.per_download_rate_spin.valueChanged.connect(self.apply_rate_limit)
+        rate_row.addWidget(self.per_download_rate_spin)
+        rate_row.addStretch()
+        advanced_layout.addLayout(rate_row)
+
         advanced_group.setLayout(advanced_layout)
         layout.addWidget(advanced_group)
 
@@ -404,8 +511,10 @@ class BiliDownloaderGUI(QMainWindow):
         self.progress_percent = QLabel("0%")
         self.progress_percent.setStyleSheet("font-weight: bold; color: #3498db;")
         self.progress_size = QLabel("0 MB / 0 MB")
+        self.progress_speed = QLabel("")
         progress_detail_layout.addWidget(self.progress_percent)
         progress_detail_layout.addStretch()
+        progress_detail_layout.addWidget(self.progress_speed)
         progress_detail_layout.addWidget(self.progress_size)
         progress_layout.addLayout(progress_detail_layout)
 
@@ -492,6 +601,12 @@ class BiliDownloaderGUI(QMainWindow):
             else:
                 self.log_output("退出登录失败")
 
+    def apply_rate_limit(self):
+        """应用限速设置，对正在进行的下载立即生效"""
+        mb = 1024 * 1024
+        self.downloader.set_rate_limit(self.rate_limit_spin.value() * mb,
+                                       self.per_download_rate_spin.value() * mb)
+
     def start_download(self):
         """开始下载"""
         # 验证输入
@@ -500,6 +615,9 @@ class BiliDownloaderGUI(QMainWindow):
             QMessageBox.warning(self, "输入错误", "请输入BV号或视频URL")
             return
 
+        # 获取分P选择
+        pages = self.pages_input.text().strip() or None
+
         # 获取下载类型
         download_type = str(self.download_type_group.checkedId())
 
@@ -538,6 +656,16 @@ class BiliDownloaderGUI(QMainWindow):
                 QMessageBox.warning(self, "目录错误", f"无法创建下载目录: {str(e)}")
                 return
 
+        # 设置分段下载连接数和合并方式
+        self.downloader.connections = self.connections_spin.value()
+        self.downloader.stream_merge = self.stream_merge.isChecked()
+        self.downloader.danmaku = self.download_danmaku.isChecked()
+        self.downloader.subtitles = self.download_subtitles.isChecked()
+        self.downloader.merge_engine = self.merge_engine_combo.currentData()
+        cover_width = self.cover_width_spin.value()
+        self.downloader.set_cover_options((cover_width, None) if cover_width else None,
+                                          self.cover_format_combo.currentData())
+
         # 重置进度显示
         self.reset_progress_display()
 
@@ -555,12 +683,13 @@ class BiliDownloaderGUI(QMainWindow):
 
         # 在工作线程中执行下载
         self.download_thread = DownloadWorker(
-            self.downloader, url, quality, download_type, download_path
+            self.downloader, url, quality, download_type, download_path, pages
         )
         self.download_thread.progress_signal.connect(self.update_progress)
         self.download_thread.log_signal.connect(self.log_output)
         self.download_thread.finished_signal.connect(self.download_finished)
         self.download_thread.file_progress_signal.connect(self.update_file_progress)
+        self.download_thread.speed_signal.connect(self.update_speed)
         self.download_thread.start()
 
     def reset_progress_display(self):
@@ -568,6 +697,7 @@ class BiliDownloaderGUI(QMainWindow):
         self.progress_bar.setValue(0)
         self.progress_percent.setText("0%")
         self.progress_size.setText("0 MB / 0 MB")
+        self.progress_speed.setText("")
         self.current_file_label.setText("当前文件: 无")
         self.current_file = ""
 
@@ -588,6 +718,11 @@ class BiliDownloaderGUI(QMainWindow):
             total_mb = total / (1024 * 1024)
             self.progress_size.setText(f"{downloaded_mb:.1f} MB / {total_mb:.1f} MB")
 
+    def update_speed(self, filename, speed, eta):
+        """更新下载速度和剩余时间"""
+        speed_mb = speed / (1024 * 1024)
+        self.progress_speed.setText(f"{speed_mb:.1f} MB/s  剩余 {format_eta(eta if eta >= 0 else None)}")
+
     def log_output(self, message):
         """输出日志消息"""
         timestamp = time.strftime("%H:%M:%S")
@@ -647,6 +782,7 @@ class BiliDownloaderGUI(QMainWindow):
         if reply == QMessageBox.Yes:
             # 清除输入字段
             self.url_input.clear()
+            self.pages_input.clear()
             self.download_dir.setText(os.getcwd())
             self.filename_template.clear()
 
@@ -655,7 +791,16 @@ class BiliDownloaderGUI(QMainWindow):
             self.quality_combo.setCurrentIndex(0)
             self.overwrite_files.setChecked(False)
             self.auto_merge.setChecked(True)
+            self.stream_merge.setChecked(False)
+            self.download_danmaku.setChecked(False)
+            self.download_subtitles.setChecked(False)
+            self.merge_engine_combo.setCurrentIndex(0)
+            self.cover_format_combo.setCurrentIndex(0)
+            self.cover_width_spin.setValue(0)
             self.show_progress.setChecked(True)
+            self.connections_spin.setValue(1)
+            self.rate_limit_spin.setValue(0)
+            self.per_download_rate_spin.setValue(0)
 
             # 重置登录状态
             self.login_status.setText("未登录")
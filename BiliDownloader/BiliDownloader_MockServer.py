@@ -0,0 +1,450 @@
+import argparse
+import email.utils
+import http.server
+import json
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+import zlib
+from typing import Optional, Dict, Any, List
+from urllib.parse import urlparse, parse_qs
+
+
+# 本地模拟的B站API与CDN：视频信息、播放地址、nav、扫码登录接口，以及支持Range请求的DASH文件，
+# 可设置单连接带宽、延迟、412限流和断开连接，用于离线测试和吞吐量基准测试
+
+MIB = 1024 * 1024
+VIDEO_QUALITIES = (80, 64, 32)
+AUDIO_ID = 30280
+AVC_CODEC_ID = 7
+WRITE_CHUNK = 64 * 1024
+COOKIE_TTL = 180 * 24 * 3600
+WBI_IMG_KEY = "7cd084941338484aae1ad9425b84077c"
+WBI_SUB_KEY = "4932caff0ff746eab6f01bf08b70ac45"
+_PATTERN = bytes(range(256)) * (WRITE_CHUNK // 256)  # mdat和封面的填充数据
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    """构造box"""
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def _full_box(box_type: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    """构造带version/flags的box"""
+    return _box(box_type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+_MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def build_fragmented_mp4(handler: bytes, size: int, fragments: int, timescale: int = 1000) -> bytes:
+    """生成单轨分片MP4（ftyp、moov、每秒一个moof/mdat分片），总大小约为 size，内容为填充数据"""
+    fragments = max(1, fragments)
+    duration = fragments * timescale
+    video = handler == b'vide'
+
+    mvhd = _full_box(b'mvhd', 0, 0, struct.pack('>IIII', 0, 0, timescale, duration)
+                     + struct.pack('>IH10x', 0x10000, 0x100) + _MATRIX + bytes(24) + struct.pack('>I', 2))
+    tkhd = _full_box(b'tkhd', 0, 3, struct.pack('>IIIII8xHHH2x', 0, 0, 1, 0, duration, 0, 0, 0 if video else 0x100)
+                     + _MATRIX + struct.pack('>II', (1920 << 16) if video else 0, (1080 << 16) if video else 0))
+    mdhd = _full_box(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, timescale, duration, 0x55C4, 0))
+    hdlr = _full_box(b'hdlr', 0, 0, struct.pack('>I4s12x', 0, handler) + b'MockHandler\x00')
+    media_header = (_full_box(b'vmhd', 0, 1, bytes(8)) if video else _full_box(b'smhd', 0, 0, bytes(4)))
+    dinf = _box(b'dinf', _full_box(b'dref', 0, 0, struct.pack('>I', 1) + _full_box(b'url ', 0, 1, b'')))
+    stbl = _box(b'stbl', b''.join([
+        _full_box(b'stsd', 0, 0, struct.pack('>I', 0)),
+        _full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+        _full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+        _full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+        _full_box(b'stco', 0, 0, struct.pack('>I', 0)),
+    ]))
+    trak = _box(b'trak', tkhd + _box(b'mdia', mdhd + hdlr + _box(b'minf', media_header + dinf + stbl)))
+    mvex = _box(b'mvex', _full_box(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, timescale, 0, 0)))
+    header = _box(b'ftyp', b'iso5' + struct.pack('>I', 512) + b'iso5iso6mp41') + _box(b'moov', mvhd + trak + mvex)
+
+    sample_size = max(1, (size - len(header)) // fragments - 120)
+    parts = [header]
+    for index in range(fragments):
+        # tfhd: default-base-is-moof；trun: data-offset + 每个样本的时长和大小，数据紧跟在moof之后的mdat中
+        def moof(data_offset: int) -> bytes:
+            traf = _box(b'traf', _full_box(b'tfhd', 0, 0x020000, struct.pack('>I', 1))
+                        + _full_box(b'tfdt', 1, 0, struct.pack('>Q', index * timescale))
+                        + _full_box(b'trun', 0, 0x301, struct.pack('>Iiii', 1, data_offset, timescale, sample_size)))
+            return _box(b'moof', _full_box(b'mfhd', 0, 0, struct.pack('>I', index + 1)) + traf)
+
+        fragment = moof(len(moof(0)) + 8)
+        repeat, rest = divmod(sample_size, len(_PATTERN))
+        parts.append(fragment + struct.pack('>I4s', 8 + sample_size, b'mdat') + _PATTERN * repeat + _PATTERN[:rest])
+    return b''.join(parts)
+
+
+class _MockHandler(http.server.BaseHTTPRequestHandler):
+    """API与CDN共用的请求处理，server.mock 为所属的 MockBilibiliServer"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        # 客户端主动断开（如下载器切换镜像）属于正常情况，不打印错误
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        mock = self.server.mock
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        try:
+            if self.server.role == 'cdn':
+                mock._handle_cdn(self, parsed.path)
+            else:
+                mock._handle_api(self, parsed.path, query)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def send_json(self, data: Dict[str, Any], status: int = 200, cookies: Optional[List[str]] = None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for cookie in cookies or []:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def abort(self):
+        """模拟连接中断：不发送剩余数据直接关闭连接"""
+        self.close_connection = True
+        try:
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class MockBilibiliServer:
+    """本地B站API/CDN模拟服务器，API与CDN使用不同端口（下载器按主机区分API和CDN的并发控制）
+
+    bandwidth 为每个连接的速率上限（字节/秒，None为不限速），latency 为每个请求的首字节延迟（秒），
+    throttle_rate 为API请求返回412的概率，drop_rate 为CDN响应中途断开的概率
+    """
+
+    def __init__(self, video_size: int = 32 * MIB, audio_size: int = 4 * MIB, fragment_size: int = MIB,
+                 pages: int = 1, bandwidth: Optional[float] = None, latency: float = 0.0,
+                 throttle_rate: float = 0.0, drop_rate: float = 0.0, qr_polls: int = 2,
+                 seed: Optional[int] = None, host: str = '127.0.0.1', api_port: int = 0, cdn_port: int = 0):
+        self.pages = max(1, pages)
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.drop_rate = drop_rate
+        self.qr_polls = qr_polls
+        self.host = host
+        self._ports = (api_port, cdn_port)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._servers = []
+        self._threads = []
+        self._qr_keys = {}  # qrcode_key -> 已轮询次数
+        self._sessions = set()  # 已登录的SESSDATA
+        self.stats = {'api_requests': 0, 'cdn_requests': 0, 'bytes_sent': 0, 'throttled': 0, 'dropped': 0}
+
+        fragments = max(1, -(-video_size // fragment_size))
+        self.duration = fragments
+        self.media = {
+            'video': build_fragmented_mp4(b'vide', video_size, fragments),
+            'audio': build_fragmented_mp4(b'soun', audio_size, fragments),
+            'cover': b'\xff\xd8\xff\xe0' + _PATTERN[:16 * 1024] + b'\xff\xd9',
+        }
+
+    def start(self) -> 'MockBilibiliServer':
+        """在后台线程中启动API和CDN服务"""
+        for role, port in zip(('api', 'cdn'), self._ports):
+            server = http.server.ThreadingHTTPServer((self.host, port), _MockHandler)
+            server.daemon_threads = True
+            server.mock = self
+            server.role = role
+            thread = threading.Thread(target=server.serve_forever, name=f"mock-{role}", daemon=True)
+            thread.start()
+            self._servers.append(server)
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        """停止服务"""
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._servers = []
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    @property
+    def api_base(self) -> str:
+        """API根地址，传给下载器的 api_base/passport_base/comment_base"""
+        return f"http://{self.host}:{self._servers[0].server_address[1]}"
+
+    @property
+    def cdn_base(self) -> str:
+        return f"http://{self.host}:{self._servers[1].server_address[1]}"
+
+    def set_conditions(self, **conditions):
+        """运行中修改网络条件：bandwidth、latency、throttle_rate、drop_rate"""
+        for name, value in conditions.items():
+            if name not in ('bandwidth', 'latency', 'throttle_rate', 'drop_rate'):
+                raise ValueError(f"未知的网络条件: {name}")
+            setattr(self, name, value)
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self.stats:
+                self.stats[key] = 0
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _chance(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def cid_for(self, bvid: str, page: int = 1) -> int:
+        """由BV号生成固定的cid"""
+        return (zlib.crc32(bvid.encode()) % 10 ** 8) * 100 + page
+
+    # ---------- API ----------
+
+    def _handle_api(self, handler: _MockHandler, path: str, query: Dict[str, str]):
+        self._count('api_requests')
+        if self.latency:
+            time.sleep(self.latency)
+        if self._chance(self.throttle_rate):
+            self._count('throttled')
+            handler.send_json({'code': -412, 'message': "请求过于频繁，请稍后再试", 'ttl': 1}, status=412)
+            return
+
+        routes = {
+            '/x/web-interface/nav': self._api_nav,
+            '/x/web-interface/view': self._api_view,
+            '/x/player/playurl': self._api_playurl,
+            '/x/player/wbi/playurl': self._api_playurl,
+            '/x/passport-login/web/qrcode/generate': self._api_qr_generate,
+            '/x/passport-login/web/qrcode/poll': self._api_qr_poll,
+        }
+        route = routes.get(path.rstrip('/'))
+        if route is None:
+            handler.send_json({'code': -404, 'message': "啥都木有", 'ttl': 1}, status=404)
+            return
+        result = route(handler, query)
+        data, cookies = result if isinstance(result, tuple) else (result, None)
+        handler.send_json(data, cookies=cookies)
+
+    def _logged_in(self, handler: _MockHandler) -> bool:
+        match = re.search(r'(?:^|;\s*)SESSDATA=([^;]+)', handler.headers.get('Cookie', ''))
+        return bool(match) and match.group(1) in self._sessions
+
+    def _api_nav(self, handler: _MockHandler, query: Dict[str, str]) -> Dict[str, Any]:
+        wbi_img = {'img_url': f"https://i0.hdslb.com/bfs/wbi/{WBI_IMG_KEY}.png",
+                   'sub_url': f"https://i0.hdslb.com/bfs/wbi/{WBI_SUB_KEY}.png"}
+        if not self._logged_in(handler):
+            return {'code': -101, 'message': "账号未登录", 'ttl': 1, 'data': {'isLogin': False, 'wbi_img': wbi_img}}
+        return {'code': 0, 'message': "0", 'ttl': 1, 'data': {
+            'isLogin': True, 'mid': 10000, 'uname': "测试用户", 'face': f"{self.cdn_base}/cdn/cover/face.jpg",
+            'vipStatus': 0, 'wbi_img': wbi_img,
+        }}
+
+    def _api_view(self, handler: _MockHandler, query: Dict[str, str]) -> Dict[str, Any]:
+        bvid = query.get('bvid', '')
+        if not re.fullmatch(r'BV[0-9A-Za-z]{10}', bvid):
+            return {'code': -400, 'message': "请求错误", 'ttl': 1}
+        pages = [{'cid': self.cid_for(bvid, p), 'page': p, 'part': f"P{p}", 'duration': self.duration}
+                 for p in range(1, self.pages + 1)]
+        return {'code': 0, 'message': "0", 'ttl': 1, 'data': {
+            'bvid': bvid, 'aid': zlib.crc32(bvid.encode()), 'videos': self.pages,
+            'title': f"测试视频 {bvid}", 'pic': f"{self.cdn_base}/cdn/cover/{bvid}.jpg",
+            'duration': self.duration * self.pages, 'cid': pages[0]['cid'], 'pages': pages,
+        }}
+
+    def _api_playurl(self, handler: _MockHandler, query: Dict[str, str]) -> Dict[str, Any]:
+        bvid, cid = query.get('bvid', ''), query.get('cid', '')
+        if not bvid or not cid:
+            return {'code': -400, 'message': "请求错误", 'ttl': 1}
+        quality = int(query.get('qn') or VIDEO_QUALITIES[0])
+        available = [qn for qn in VIDEO_QUALITIES if qn <= quality] or [VIDEO_QUALITIES[-1]]
+
+        def stream(name: str, stream_id: int, bandwidth: int) -> Dict[str, Any]:
+            url = f"{self.cdn_base}/cdn/{bvid}/{cid}/{name}-{stream_id}.m4s"
+            return {'id': stream_id, 'baseUrl': url, 'base_url': url,
+                    'backupUrl': [url + '?mirror=1'], 'backup_url': [url + '?mirror=1'],
+                    'bandwidth': bandwidth, 'codecid': AVC_CODEC_ID if name == 'video' else 0,
+                    'mimeType': f"{name}/mp4", 'codecs': 'avc1.640032' if name == 'video' else 'mp4a.40.2'}
+
+        video_bandwidth = len(self.media['video']) * 8 // self.duration
+        audio_bandwidth = len(self.media['audio']) * 8 // self.duration
+        return {'code': 0, 'message': "0", 'ttl': 1, 'data': {
+            'quality': available[0], 'format': 'dash', 'timelength': self.duration * 1000,
+            'accept_quality': list(VIDEO_QUALITIES),
+            'accept_description': ["高清 1080P", "高清 720P", "清晰 480P"],
+            'dash': {
+                'duration': self.duration,
+                'video': [stream('video', qn, video_bandwidth) for qn in available],
+                'audio': [stream('audio', AUDIO_ID, audio_bandwidth)],
+            },
+        }}
+
+    def _api_qr_generate(self, handler: _MockHandler, query: Dict[str, str]) -> Dict[str, Any]:
+        key = uuid.uuid4().hex
+        with self._lock:
+            self._qr_keys[key] = 0
+        return {'code': 0, 'message': "0", 'ttl': 1, 'data': {
+            'url': f"https://passport.bilibili.com/h5-app/passport/login/scan?qrcode_key={key}",
+            'qrcode_key': key,
+        }}
+
+    def _api_qr_poll(self, handler: _MockHandler, query: Dict[str, str]):
+        key = query.get('qrcode_key', '')
+        with self._lock:
+            polls = self._qr_keys.get(key)
+            if polls is not None:
+                self._qr_keys[key] = polls + 1
+        if polls is None:
+            return {'code': 0, 'message': "0", 'data': {'code': 86038, 'message': "二维码已失效", 'url': ''}}
+        # 前几次轮询依次返回未扫码、已扫码未确认，之后登录成功
+        if polls < self.qr_polls:
+            code, message = (86101, "未扫码") if polls < self.qr_polls // 2 else (86090, "二维码已扫码未确认")
+            return {'code': 0, 'message': "0", 'data': {'code': code, 'message': message, 'url': ''}}
+
+        sessdata = uuid.uuid4().hex
+        with self._lock:
+            self._sessions.add(sessdata)
+            del self._qr_keys[key]
+        expires = email.utils.formatdate(time.time() + COOKIE_TTL, usegmt=True)
+        cookies = [f"{name}={value}; Path=/; Expires={expires}" + ("; HttpOnly" if name == 'SESSDATA' else '')
+                   for name, value in (('SESSDATA', sessdata), ('bili_jct', uuid.uuid4().hex),
+                                       ('DedeUserID', '10000'))]
+        data = {'code': 0, 'message': "0", 'data': {
+            'code': 0, 'message': "", 'refresh_token': uuid.uuid4().hex, 'timestamp': int(time.time() * 1000),
+            'url': f"https://passport.biligame.com/crossDomain?SESSDATA={sessdata}",
+        }}
+        return data, cookies
+
+    # ---------- CDN ----------
+
+    def _handle_cdn(self, handler: _MockHandler, path: str):
+        self._count('cdn_requests')
+        if self.latency:
+            time.sleep(self.latency)
+        if path.startswith('/cdn/cover/'):
+            data = self.media['cover']
+        elif re.fullmatch(r'/cdn/[^/]+/\d+/video-\d+\.m4s', path):
+            data = self.media['video']
+        elif re.fullmatch(r'/cdn/[^/]+/\d+/audio-\d+\.m4s', path):
+            data = self.media['audio']
+        else:
+            handler.send_response(404)
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return
+
+        total = len(data)
+        start, end = 0, total - 1
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', handler.headers.get('Range', '').strip())
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), total - 1) if match.group(2) else total - 1
+            else:
+                start = max(0, total - int(match.group(2)))
+            if start > end:
+                handler.send_response(416)
+                handler.send_header('Content-Range', f'bytes */{total}')
+                handler.send_header('Content-Length', '0')
+                handler.end_headers()
+                return
+            handler.send_response(206)
+            handler.send_header('Content-Range', f'bytes {start}-{end}/{total}')
+        else:
+            handler.send_response(200)
+        handler.send_header('Content-Type', 'image/jpeg' if path.startswith('/cdn/cover/') else 'video/mp4')
+        handler.send_header('Accept-Ranges', 'bytes')
+        handler.send_header('Content-Length', str(end - start + 1))
+        handler.end_headers()
+
+        # 按概率在响应中途的随机位置断开连接
+        stop = end + 1
+        if self._chance(self.drop_rate):
+            with self._lock:
+                stop = start + self._random.randrange(end - start + 1)
+        self._send_limited(handler, memoryview(data)[start:stop])
+        if stop <= end:
+            self._count('dropped')
+            handler.abort()
+
+    def _send_limited(self, handler: _MockHandler, view: memoryview):
+        """分块发送数据，按当前的 bandwidth 限制单个连接的速率"""
+        started = time.monotonic()
+        sent = 0
+        while sent < len(view):
+            chunk = view[sent:sent + WRITE_CHUNK]
+            handler.wfile.write(chunk)
+            sent += len(chunk)
+            self._count('bytes_sent', len(chunk))
+            rate = self.bandwidth
+            if rate:
+                delay = started + sent / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地B站API/CDN模拟服务器，用于离线测试和基准测试")
+    parser.add_argument("--host", default='127.0.0.1', help="监听地址 (默认: 127.0.0.1)")
+    parser.add_argument("--api-port", type=int, default=8000, help="API端口 (默认: 8000)")
+    parser.add_argument("--cdn-port", type=int, default=8001, help="CDN端口 (默认: 8001)")
+    parser.add_argument("--video-size", type=int, default=32, help="视频文件大小 (MB，默认: 32)")
+    parser.add_argument("--audio-size", type=int, default=4, help="音频文件大小 (MB，默认: 4)")
+    parser.add_argument("--pages", type=int, default=1, help="每个视频的分P数 (默认: 1)")
+    parser.add_argument("--bandwidth", type=float, default=0, help="每个连接的速率上限 (MB/s，默认: 不限速)")
+    parser.add_argument("--latency", type=float, default=0, help="每个请求的延迟 (毫秒，默认: 0)")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="API请求返回412的概率 (默认: 0)")
+    parser.add_argument("--drop-rate", type=float, default=0, help="CDN响应中途断开的概率 (默认: 0)")
+    parser.add_argument("--seed", type=int, help="随机数种子")
+    args = parser.parse_args()
+
+    server = MockBilibiliServer(video_size=args.video_size * MIB, audio_size=args.audio_size * MIB,
+                                pages=args.pages, bandwidth=args.bandwidth * MIB or None,
+                                latency=args.latency / 1000, throttle_rate=args.throttle_rate,
+                                drop_rate=args.drop_rate, seed=args.seed, host=args.host,
+                                api_port=args.api_port, cdn_port=args.cdn_port)
+    server.start()
+    print(f"API: {server.api_base}")
+    print(f"CDN: {server.cdn_base}")
+    print(f"示例: python BiliDownloader.py BV1xx411c7mD --api-base {server.api_base} -t 3")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
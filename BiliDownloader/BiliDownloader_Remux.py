@@ -0,0 +1,269 @@
+import heapq
+import os
+import struct
+from typing import Optional, Dict, Any, List, Tuple, BinaryIO
+
+
+class RemuxError(Exception):
+    """输入文件不是可直接拼接的单轨分片MP4（fMP4）时抛出，调用方可回退到ffmpeg"""
+
+
+_COPY_BUFFER = 1024 * 1024
+
+
+def _iter_boxes(f: BinaryIO, start: int, end: int):
+    """遍历文件中 [start, end) 范围内的box，返回 (类型, 偏移, 头部长度, 总长度)"""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack('>I4s', header[:8])
+        header_size = 8
+        if size == 1:
+            if len(header) < 16:
+                raise RemuxError("box头部不完整")
+            size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise RemuxError(f"box长度无效: {box_type!r} @ {offset}")
+        yield box_type, offset, header_size, size
+        offset += size
+
+
+def _children(data: bytes, start: int, end: int) -> List[Tuple[bytes, int, int, int]]:
+    """解析内存中 [start, end) 范围内的子box，返回 (类型, 偏移, 头部长度, 总长度) 列表"""
+    boxes = []
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size or offset + size > end:
+            raise RemuxError(f"box长度无效: {box_type!r}")
+        boxes.append((box_type, offset, header_size, size))
+        offset += size
+    return boxes
+
+
+def _find(data: bytes, start: int, end: int, path: List[bytes]) -> Optional[Tuple[int, int, int]]:
+    """按路径查找子box，返回 (偏移, 头部长度, 总长度)"""
+    for box_type, offset, header_size, size in _children(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return offset, header_size, size
+            return _find(data, offset + header_size, offset + size, path[1:])
+    return None
+
+
+def _box(box_type: bytes, payload: bytes) -> bytes:
+    """构造box"""
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+class _FragmentedTrack:
+    """单轨分片MP4文件的索引：ftyp、moov及每个moof/mdat分片的位置和解码时间"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ftyp = None
+        self.moov = None
+        self.fragments = []  # (解码时间/秒, moof偏移, moof长度, mdat偏移, mdat长度)
+        self._parse()
+
+    def _parse(self):
+        file_size = os.path.getsize(self.path)
+        with open(self.path, 'rb') as f:
+            pending_moof = None
+            # sidx/mfra等索引在分片重新排列后失效，不写入输出文件
+            for box_type, offset, header_size, size in _iter_boxes(f, 0, file_size):
+                if box_type == b'ftyp':
+                    f.seek(offset)
+                    self.ftyp = f.read(size)
+                elif box_type == b'moov':
+                    f.seek(offset)
+                    self.moov = f.read(size)
+                    self._parse_moov()
+                elif box_type == b'moof':
+                    if self.moov is None:
+                        raise RemuxError("moof出现在moov之前")
+                    f.seek(offset)
+                    pending_moof = (offset, size, self._fragment_time(f.read(size)))
+                elif box_type == b'mdat':
+                    if pending_moof is None:
+                        raise RemuxError("不是分片MP4（mdat之前没有moof）")
+                    moof_offset, moof_size, decode_time = pending_moof
+                    self.fragments.append((decode_time, moof_offset, moof_size, offset, size))
+                    pending_moof = None
+        if self.moov is None or not self.fragments:
+            raise RemuxError(f"{self.path} 不是分片MP4")
+
+    def _parse_moov(self):
+        moov = self.moov
+        traks = [b for b in _children(moov, 8, len(moov)) if b[0] == b'trak']
+        if len(traks) != 1:
+            raise RemuxError(f"输入文件应只包含一个轨道，实际为 {len(traks)} 个")
+        _, trak_offset, trak_header, trak_size = traks[0]
+        self.trak = moov[trak_offset:trak_offset + trak_size]
+
+        mvhd = _find(moov, 8, len(moov), [b'mvhd'])
+        mdhd = _find(self.trak, trak_header, len(self.trak), [b'mdia', b'mdhd'])
+        hdlr = _find(self.trak, trak_header, len(self.trak), [b'mdia', b'hdlr'])
+        if not (mvhd and mdhd and hdlr):
+            raise RemuxError("moov缺少mvhd/mdhd/hdlr")
+        self.mvhd = moov[mvhd[0]:mvhd[0] + mvhd[2]]
+        self.movie_timescale = self._timescale(self.mvhd, 8)
+        self.timescale = self._timescale(self.trak, mdhd[0] + mdhd[1])
+        self.handler = self.trak[hdlr[0] + hdlr[1] + 8:hdlr[0] + hdlr[1] + 12]
+
+        mvex = _find(moov, 8, len(moov), [b'mvex'])
+        if not mvex:
+            raise RemuxError("moov缺少mvex，不是分片MP4")
+        self.trex = None
+        self.mehd_seconds = None
+        for box_type, offset, header_size, size in _children(moov, mvex[0] + mvex[1], mvex[0] + mvex[2]):
+            if box_type == b'trex':
+                self.trex = moov[offset:offset + size]
+            elif box_type == b'mehd':
+                version = moov[offset + header_size]
+                fmt = '>Q' if version == 1 else '>I'
+                duration = struct.unpack_from(fmt, moov, offset + header_size + 4)[0]
+                self.mehd_seconds = duration / self.movie_timescale
+        if self.trex is None:
+            raise RemuxError("mvex缺少trex")
+        self.extra = [moov[o:o + s] for t, o, h, s in _children(moov, 8, len(moov))
+                      if t not in (b'mvhd', b'trak', b'mvex')]
+
+    @staticmethod
+    def _timescale(data: bytes, fullbox_payload: int) -> int:
+        """读取mvhd/mdhd的timescale，fullbox_payload 为version字节的偏移"""
+        version = data[fullbox_payload]
+        offset = fullbox_payload + (20 if version == 1 else 12)
+        timescale = struct.unpack_from('>I', data, offset)[0]
+        if not timescale:
+            raise RemuxError("timescale为0")
+        return timescale
+
+    def _fragment_time(self, moof: bytes) -> float:
+        """读取分片的tfdt解码时间（秒）"""
+        traf = _find(moof, 8, len(moof), [b'traf'])
+        if not traf:
+            raise RemuxError("moof缺少traf")
+        tfhd = _find(moof, traf[0] + traf[1], traf[0] + traf[2], [b'tfhd'])
+        if tfhd and struct.unpack_from('>I', moof, tfhd[0] + tfhd[1])[0] & 0x000001:
+            # 绝对的base-data-offset在移动分片位置后会失效
+            raise RemuxError("分片使用了绝对数据偏移(base-data-offset)")
+        tfdt = _find(moof, traf[0] + traf[1], traf[0] + traf[2], [b'tfdt'])
+        if not tfdt:
+            raise RemuxError("分片缺少tfdt")
+        version = moof[tfdt[0] + tfdt[1]]
+        fmt = '>Q' if version == 1 else '>I'
+        return struct.unpack_from(fmt, moof, tfdt[0] + tfdt[1] + 4)[0] / self.timescale
+
+
+def _set_track_id(box: bytes, track_id: int) -> bytes:
+    """修改trak（tkhd）或trex中的track_ID"""
+    data = bytearray(box)
+    if data[4:8] == b'trex':
+        struct.pack_into('>I', data, 12, track_id)
+        return bytes(data)
+    tkhd = _find(data, 8, len(data), [b'tkhd'])
+    if not tkhd:
+        raise RemuxError("trak缺少tkhd")
+    payload = tkhd[0] + tkhd[1]
+    offset = payload + (20 if data[payload] == 1 else 12)
+    struct.pack_into('>I', data, offset, track_id)
+    return bytes(data)
+
+
+def _build_moov(video: _FragmentedTrack, audio: _FragmentedTrack) -> bytes:
+    """合并两个单轨moov：视频为轨道1，音频为轨道2"""
+    mvhd = bytearray(video.mvhd)
+    struct.pack_into('>I', mvhd, len(mvhd) - 4, 3)  # next_track_ID
+
+    mvex_payload = b''
+    durations = [d for d in (video.mehd_seconds, audio.mehd_seconds) if d is not None]
+    if durations:
+        fragment_duration = int(round(max(durations) * video.movie_timescale))
+        mvex_payload += _box(b'mehd', struct.pack('>I', 1 << 24) + struct.pack('>Q', fragment_duration))
+    mvex_payload += _set_track_id(video.trex, 1) + _set_track_id(audio.trex, 2)
+
+    payload = (bytes(mvhd) + _set_track_id(video.trak, 1) + _set_track_id(audio.trak, 2)
+               + _box(b'mvex', mvex_payload) + b''.join(video.extra))
+    return _box(b'moov', payload)
+
+
+def _patch_moof(moof: bytes, sequence_number: int, track_id: int) -> bytes:
+    """修改分片的序号(mfhd)和轨道号(tfhd)，长度不变，trun中相对moof的数据偏移仍然有效"""
+    data = bytearray(moof)
+    mfhd = _find(data, 8, len(data), [b'mfhd'])
+    if mfhd:
+        struct.pack_into('>I', data, mfhd[0] + mfhd[1] + 4, sequence_number)
+    for box_type, offset, header_size, size in _children(data, 8, len(data)):
+        if box_type == b'traf':
+            tfhd = _find(data, offset + header_size, offset + size, [b'tfhd'])
+            if tfhd:
+                struct.pack_into('>I', data, tfhd[0] + tfhd[1] + 4, track_id)
+    return bytes(data)
+
+
+def _copy_range(src: BinaryIO, dst: BinaryIO, offset: int, size: int):
+    """按块复制文件中的一段数据"""
+    src.seek(offset)
+    remaining = size
+    while remaining > 0:
+        chunk = src.read(min(_COPY_BUFFER, remaining))
+        if not chunk:
+            raise RemuxError("输入文件被截断")
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+
+def remux_dash(video_file: str, audio_file: str, output_file: str) -> Dict[str, Any]:
+    """将B站DASH的单轨视频和音频分片MP4按box级别直接拼接为一个MP4（不重新编码，不依赖ffmpeg）
+
+    输入结构异常（box被截断、缺少必需字段等）时抛出 RemuxError，调用方可回退到ffmpeg
+    """
+    try:
+        return _remux_dash(video_file, audio_file, output_file)
+    except (struct.error, IndexError, KeyError, ValueError) as e:
+        raise RemuxError(f"无法解析MP4结构: {type(e).__name__}: {e}") from e
+
+
+def _remux_dash(video_file: str, audio_file: str, output_file: str) -> Dict[str, Any]:
+    video = _FragmentedTrack(video_file)
+    audio = _FragmentedTrack(audio_file)
+    if video.handler != b'vide' or audio.handler != b'soun':
+        raise RemuxError(f"轨道类型不匹配: {video.handler!r}/{audio.handler!r}")
+    if (audio.movie_timescale != video.movie_timescale
+            and _find(audio.trak, 8, len(audio.trak), [b'edts'])):
+        # 编辑列表的时长以影片timescale为单位，两者不同时需要重新换算
+        raise RemuxError("音频轨道的编辑列表与视频的影片timescale不一致")
+
+    # 按解码时间交错排列两路分片，播放器可以边读边播
+    fragments = heapq.merge(
+        ((frag[0], 0) + frag[1:] for frag in video.fragments),
+        ((frag[0], 1) + frag[1:] for frag in audio.fragments),
+    )
+
+    with open(video_file, 'rb') as vf, open(audio_file, 'rb') as af, open(output_file, 'wb') as out:
+        out.write(video.ftyp or _box(b'ftyp', b'iso5' + struct.pack('>I', 512) + b'iso5iso6mp41'))
+        out.write(_build_moov(video, audio))
+        sources = (vf, af)
+        for sequence_number, (_, index, moof_offset, moof_size, mdat_offset, mdat_size) in enumerate(fragments, 1):
+            src = sources[index]
+            src.seek(moof_offset)
+            out.write(_patch_moof(src.read(moof_size), sequence_number, index + 1))
+            _copy_range(src, out, mdat_offset, mdat_size)
+
+    return {
+        'video_fragments': len(video.fragments),
+        'audio_fragments': len(audio.fragments),
+    }